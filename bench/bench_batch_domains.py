@@ -0,0 +1,135 @@
+# file: bench_batch_domains.py
+
+import sys
+import argparse
+import random
+import string
+import time
+
+try:
+    from crunchbase_orgs.src.load_organizations import LoadOrganizations
+    from crunchbase_orgs.src.batch_domains import classify_emails
+except ModuleNotFoundError:
+    from crunchbase_orgs.load_organizations import LoadOrganizations
+    from crunchbase_orgs.batch_domains import classify_emails
+
+
+class BenchBatchDomains:
+    """
+    Compare per-license domain handling (get_domain_from(), the ISP check
+    and shorten()) against classify_emails() on a synthetic email column,
+    and check that both give the same results.
+    Run from the repository root as, e.g.:
+    python3 -m bench.bench_batch_domains -n 1000000
+    """
+    def __init__(self, ct_emails=1000000, seed=0):
+        self.ct_emails = ct_emails
+        self.ct_company_domains = 50000
+        self.isp_ratio = 0.3
+        self.bad_ratio = 0.01
+        self.rng = random.Random(seed)
+        self.lo = LoadOrganizations()
+        self.emails = []
+
+    def get_c_l_args(self, argv=None):
+        """Get command line arguments"""
+        parser = argparse.ArgumentParser()
+        parser.add_argument('-n', '--emails', type=int, default=self.ct_emails,
+                            help='number of emails')
+        parser.add_argument('-d', '--domains', type=int,
+                            default=self.ct_company_domains,
+                            help='number of distinct company domains')
+        parser.add_argument('--isp_ratio', type=float, default=self.isp_ratio,
+                            help='share of emails with an ISP domain')
+        parser.add_argument('--bad_ratio', type=float, default=self.bad_ratio,
+                            help='share of malformed emails')
+        args = parser.parse_args(argv)
+        self.ct_emails = args.emails
+        self.ct_company_domains = args.domains
+        self.isp_ratio = args.isp_ratio
+        self.bad_ratio = args.bad_ratio
+
+    def make_word(self, min_len=3, max_len=10):
+        return ''.join(self.rng.choice(string.ascii_lowercase)
+                       for _ in range(self.rng.randint(min_len, max_len)))
+
+    def make_emails(self):
+        """
+        Make an email column with the configured share of ISP and
+            malformed addresses
+        :return: None
+        Called by: main()
+        """
+        tlds = sorted(self.lo.tlds)
+        company_domains = ['{}.{}'.format(self.make_word(), self.rng.choice(tlds))
+                           for _ in range(self.ct_company_domains)]
+        bad_emails = ['no_at_sign.example.com', '@example.com',
+                      'someone@localhost', 'someone@.com', 'a@b@c']
+        for _ in range(self.ct_emails):
+            roll = self.rng.random()
+            if roll < self.bad_ratio:
+                self.emails.append(self.rng.choice(bad_emails))
+                continue
+            if roll < self.bad_ratio + self.isp_ratio:
+                domain = self.rng.choice(self.lo.isp_domains)
+            else:
+                domain = self.rng.choice(company_domains)
+            self.emails.append('{}@{}'.format(self.make_word(), domain))
+
+    def run_scalar(self):
+        """
+        The per-license work done by handle_company_and_email() and
+            retrieve_pick()
+        :return: list of (domain, bad_email, is_isp, short_domain)
+        Called by: main()
+        """
+        results = []
+        for email in self.emails:
+            domain = self.lo.get_domain_from(email)
+            is_isp = bool(domain) and domain in self.lo.isp_domains
+            short_domain = self.lo.shorten(domain) \
+                if domain and not is_isp else None
+            results.append((domain, domain is None, is_isp, short_domain))
+        return results
+
+    def run_batch(self):
+        """
+        :return: classify_emails() output, as for run_scalar()
+        Called by: main()
+        """
+        frame = classify_emails(self.emails, self.lo.isp_domains,
+                                self.lo.shorten)
+        return list(zip(frame['domain'], frame['bad_email'].tolist(),
+                        frame['is_isp'].tolist(), frame['short_domain']))
+
+    def main(self):
+        self.get_c_l_args()
+        self.lo.get_isp_domain_dict()
+        self.lo.get_tld_domain_dict()
+        self.make_emails()
+
+        start = time.perf_counter()
+        scalar_results = self.run_scalar()
+        scalar_secs = time.perf_counter() - start
+
+        start = time.perf_counter()
+        batch_results = self.run_batch()
+        batch_secs = time.perf_counter() - start
+
+        print('{} emails, {} ISP domains'.format(self.ct_emails,
+                                                 len(self.lo.isp_domains)))
+        print('scalar: {:.3f} s ({:.0f} emails/s)'.
+              format(scalar_secs, self.ct_emails / scalar_secs))
+        print('batch:  {:.3f} s ({:.0f} emails/s)'.
+              format(batch_secs, self.ct_emails / batch_secs))
+        print('speedup: {:.1f}x'.format(scalar_secs / batch_secs))
+        mismatches = sum(1 for scalar, batch in zip(scalar_results,
+                                                    batch_results)
+                         if scalar != batch)
+        if mismatches:
+            print('{} results differ'.format(mismatches), file=sys.stderr)
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    BenchBatchDomains().main()
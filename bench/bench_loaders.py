@@ -0,0 +1,440 @@
+# file: bench_loaders.py
+
+import os
+import sys
+import argparse
+import datetime
+import json
+import resource
+import subprocess
+import threading
+import time
+from psycopg2.pool import ThreadedConnectionPool
+
+try:
+    from common.src.pg_stats import pg_stats, StatsConnection
+except ModuleNotFoundError:
+    from common.pg_stats import pg_stats, StatsConnection
+
+try:
+    from bench.bench_lookup_indexes import BenchLookupIndexes
+except ModuleNotFoundError:
+    from bench_lookup_indexes import BenchLookupIndexes
+
+try:
+    from mock_apis.src.fake_data import FakeData
+    from mock_apis.src.mock_servers import MockServers
+except ModuleNotFoundError:
+    from mock_apis.fake_data import FakeData
+    from mock_apis.mock_servers import MockServers
+
+try:
+    from mktplc_export_lics.src.load_licenses import LoadLicenses
+    from crunchbase_orgs.src import load_organizations
+except ModuleNotFoundError:
+    from mktplc_export_lics.load_licenses import LoadLicenses
+    from crunchbase_orgs import load_organizations
+
+try:
+    from chimp.src.import_and_add_subscribers import ImportAndAddSubscribers
+except ModuleNotFoundError:
+    from chimp.import_and_add_subscribers import ImportAndAddSubscribers
+
+
+class BenchLoaders:
+    """
+    End to end throughput of the loaders, on FakeData licenses and
+    Crunchbase responses, and a local PostgreSQL. For each number of
+    licenses, seeds empty tables in a scratch schema, then runs each phase
+    in its own child process (so that peak RSS is the phase's own):
+        licenses: LoadLicenses.store_licenses(), run 0's export
+        licenses_rerun: the same, run 1's export, into the tables as
+            'licenses' left them; --update_ratio of the licenses changed
+        organizations: LoadOrganizations.get_each_license() over run 0's
+            licenses, against a mock Crunchbase in the child process
+        subscribers: refresh_aj_contact_list(), then
+            ImportAndAddSubscribers.read_from_pg() over aj_contact_list
+    Each phase's rows/s, statements issued, peak RSS and p50 / p99
+    per-record latency are printed, and appended as a JSON line, with the
+    git commit, to the results file; with --compare, each is also set
+    against the last result for the same phase and settings from another
+    commit.
+    Set DBHOST, DBNAME, DBUSER and DBPASSWD, then run from the repository
+    root as, e.g.:
+    python3 -m bench.bench_loaders -l 1000 10000 100000 --update_ratio 0.1
+    """
+    phases = ('licenses', 'licenses_rerun', 'organizations', 'subscribers')
+
+    def __init__(self):
+        self.argv = []
+        self.ct_licenses_list = [10000]
+        self.ct_licenses = None  # of the current child
+        self.ct_companies = None
+        self.isp_ratio = 0.2
+        self.duplicate_ratio = 0.05
+        self.update_ratio = 0.1
+        self.cb_hit_ratio = 0.7
+        self.cb_latency = 'fixed:0'
+        self.cb_sleep_secs = 0
+        self.seed = 0
+        self.phases_to_run = list(self.phases)
+        self.phase = None  # set in a child
+        self.results_file = 'bench_loaders_results.jsonl'
+        self.compare = False
+        self.bench = BenchLookupIndexes()  # schema, seeding, db settings
+
+    def get_c_l_args(self, argv=None):
+        """Get command line arguments"""
+        parser = argparse.ArgumentParser()
+        parser.add_argument('-l', '--licenses', type=int, nargs='+',
+                            default=self.ct_licenses_list,
+                            help='numbers of licenses to run with')
+        parser.add_argument('-c', '--companies', type=int, default=None,
+                            help='distinct companies (default: licenses / 2)')
+        parser.add_argument('--isp_ratio', type=float, default=self.isp_ratio)
+        parser.add_argument('--duplicate_ratio', type=float,
+                            default=self.duplicate_ratio)
+        parser.add_argument('--update_ratio', type=float,
+                            default=self.update_ratio)
+        parser.add_argument('--cb_hit_ratio', type=float,
+                            default=self.cb_hit_ratio)
+        parser.add_argument('--cb_latency', type=str, default=self.cb_latency,
+                            help='mock Crunchbase latency, as for '
+                                 'mock_servers.py')
+        parser.add_argument('--cb_sleep_secs', type=float,
+                            default=self.cb_sleep_secs,
+                            help="LoadOrganizations' pause every 25 licenses "
+                                 "(it is SLEEP_SECS in production)")
+        parser.add_argument('-s', '--seed', type=int, default=self.seed)
+        parser.add_argument('-p', '--phases', type=str, nargs='+',
+                            choices=self.phases, default=self.phases_to_run)
+        parser.add_argument('-r', '--results_file', type=str,
+                            default=self.results_file,
+                            help='append results here, one JSON object per '
+                                 'line')
+        parser.add_argument('--compare', action='store_true',
+                            help='compare with earlier results of another '
+                                 'commit')
+        parser.add_argument('--bench_schema', type=str,
+                            default='bench_loaders',
+                            help='schema to seed; dropped first if it exists')
+        parser.add_argument('--phase', type=str, default=None,
+                            help=argparse.SUPPRESS)  # set in child processes
+        parser.add_argument('--child_licenses', type=int, default=None,
+                            help=argparse.SUPPRESS)
+        args = parser.parse_args(argv)
+        self.argv = sys.argv[1:] if argv is None else list(argv)
+        self.ct_licenses_list = args.licenses
+        self.ct_companies = args.companies
+        self.isp_ratio = args.isp_ratio
+        self.duplicate_ratio = args.duplicate_ratio
+        self.update_ratio = args.update_ratio
+        self.cb_hit_ratio = args.cb_hit_ratio
+        self.cb_latency = args.cb_latency
+        self.cb_sleep_secs = args.cb_sleep_secs
+        self.seed = args.seed
+        self.phases_to_run = [phase for phase in self.phases
+                              if phase in args.phases]
+        self.results_file = args.results_file
+        self.compare = args.compare
+        self.bench.schema = args.bench_schema
+        self.phase = args.phase
+        self.ct_licenses = args.child_licenses
+
+    def get_fake_data(self):
+        return FakeData(seed=self.seed,
+                        ct_companies=self.ct_companies or
+                        max(1, self.ct_licenses // 2),
+                        isp_ratio=self.isp_ratio,
+                        cb_hit_ratio=self.cb_hit_ratio,
+                        duplicate_ratio=self.duplicate_ratio,
+                        update_ratio=self.update_ratio)
+
+    def get_pool(self):
+        """
+        :return: a pool of instrumented connections, searching the bench
+                     schema
+        Called by: run_phase()
+        """
+        migrate = self.bench.migrate
+        migrate.get_env_vars()
+        pg_conn_string = ("host = '{}' dbname = '{}' user = '{}' " +
+                          "password = '{}'").format(migrate.db_host,
+                                                    migrate.db_name,
+                                                    migrate.db_user,
+                                                    migrate.db_password)
+        return ThreadedConnectionPool(
+            1, 4, pg_conn_string, connection_factory=StatsConnection,
+            options='-c search_path={},public'.format(self.bench.schema))
+
+    @staticmethod
+    def time_per_record(method, per_record, ix_arg=1):
+        """
+        :param method: a bound method, called once or more per record
+        :param per_record: list to add each call's time to, at the record's
+                               index
+        :param ix_arg: position of the record index among method's args;
+                           None to use one more slot per call
+        :return: method, timed
+        Called by: bench_licenses(), bench_organizations()
+        """
+        def timed(*args):
+            start = time.perf_counter()
+            result = method(*args)
+            secs = time.perf_counter() - start
+            if ix_arg is None:
+                per_record.append(secs)
+            else:
+                per_record[args[ix_arg]] += secs
+            return result
+        return timed
+
+    def bench_licenses(self, pool, run):
+        """
+        Store one run's export, timing each record's share of each tier
+        :return: (records, per-record secs, extra results)
+        Called by: run_phase()
+        """
+        ll = LoadLicenses()
+        ll.pg_pool = pool
+        ll.mkt_data = self.get_fake_data().licenses(self.ct_licenses, run=run)
+        per_record = [0.0] * len(ll.mkt_data)
+        for name in ('get_billing_contact', 'get_technical_contact',
+                     'get_addons_key', 'get_partner_details_key',
+                     'get_lcd_key', 'get_license_id'):
+            setattr(ll, name, self.time_per_record(getattr(ll, name),
+                                                   per_record))
+        ll.store_licenses()
+        return len(ll.mkt_data), per_record, {
+            'license_inserts': ll.ct_insert_license,
+            'license_updates': ll.ct_update_license,
+            'lcd_inserts': ll.ct_insert_lcd, 'lcd_updates': ll.ct_update_lcd}
+
+    def bench_organizations(self, pool):
+        """
+        Look up run 0's licenses in a mock Crunchbase, served from a thread
+        :return: (records, per-record secs, extra results)
+        Called by: run_phase()
+        """
+        mock = MockServers()
+        mock.get_c_l_args(['-p', '0', '-s', str(self.seed),
+                           '-l', str(self.ct_licenses),
+                           '-c', str(self.get_fake_data().ct_companies),
+                           '--isp_ratio', str(self.isp_ratio),
+                           '--cb_hit_ratio', str(self.cb_hit_ratio),
+                           '--cb_latency', self.cb_latency])
+        mock.setup_server()
+        threading.Thread(target=mock.httpd.serve_forever, daemon=True).start()
+        load_organizations.SLEEP_SECS = self.cb_sleep_secs
+        lo = load_organizations.LoadOrganizations()
+        lo.api_key = 'bench'
+        lo.base_url = 'http://{}:{}'.format(*mock.httpd.server_address[:2])
+        lo.url = lo.base_url + lo.api_endpoint
+        lo.pg_pool = pool
+        licenses = self.get_fake_data().licenses(self.ct_licenses)
+        lo.license_queue = load_organizations.queue.Queue()
+        lo.license_queue.put([(item['contactDetails']['technicalContact']
+                               ['email'], item['contactDetails']['company'])
+                              for item in licenses])
+        lo.license_queue.put(None)
+        per_record = []
+        lo.handle_company_and_email = self.time_per_record(
+            lo.handle_company_and_email, per_record, ix_arg=None)
+        try:
+            lo.get_each_license()
+        finally:
+            mock.httpd.shutdown()
+        return len(licenses), per_record, {
+            'cb_requests': mock.httpd.cb_faults.ct_requests,
+            'repeat_domains': lo.repeat_domains, 'isps': lo.ct_isps,
+            'orgs_stored': lo.ct_stored}
+
+    def bench_subscribers(self, pool):
+        """
+        Refresh aj_contact_list, then read it as import_and_add_subscribers.py
+            does, giving each record its chunk's time / chunk size
+        :return: (records, per-record secs, extra results)
+        Called by: run_phase()
+        """
+        conn = pool.getconn()
+        cursor = conn.cursor()
+        start = time.perf_counter()
+        cursor.execute('SELECT refresh_aj_contact_list(TRUE);')
+        ct_contacts = cursor.fetchone()[0]
+        conn.commit()
+        cursor.close()
+        refresh_secs = time.perf_counter() - start
+        chimp = ImportAndAddSubscribers()
+        chimp.pg_conn = conn
+        chimp.list_ids = ['bench_list']
+        per_record = []
+        start = time.perf_counter()
+        for _, chunk in chimp.read_from_pg():
+            now = time.perf_counter()
+            per_record.extend([(now - start) / len(chunk['members'])] *
+                              len(chunk['members']))
+            start = now
+        pool.putconn(conn)
+        return len(per_record), per_record, {
+            'contacts_refreshed': ct_contacts, 'refresh_secs': refresh_secs}
+
+    def run_phase(self):
+        """
+        In a child process: run self.phase, and print its results as JSON
+        :return: None
+        Called by: main()
+        """
+        pool = self.get_pool()
+        start = time.perf_counter()
+        if self.phase == 'licenses':
+            ct_records, per_record, extra = self.bench_licenses(pool, 0)
+        elif self.phase == 'licenses_rerun':
+            ct_records, per_record, extra = self.bench_licenses(pool, 1)
+        elif self.phase == 'organizations':
+            ct_records, per_record, extra = self.bench_organizations(pool)
+        else:
+            ct_records, per_record, extra = self.bench_subscribers(pool)
+        secs = time.perf_counter() - start
+        ct_queries = pg_stats.ct_calls()
+        pool.closeall()
+        per_record.sort()
+        result = {'records': ct_records, 'secs': round(secs, 3),
+                  'rows_per_sec': round(ct_records / secs, 1) if secs else None,
+                  'queries': ct_queries,
+                  'queries_per_record': round(ct_queries / ct_records, 2)
+                  if ct_records else None,
+                  # ru_maxrss is in kilobytes on Linux
+                  'peak_rss_mb': round(resource.getrusage(
+                      resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+                  'p50_ms': round(BenchLookupIndexes.percentile(
+                      per_record, 50) * 1000, 3),
+                  'p99_ms': round(BenchLookupIndexes.percentile(
+                      per_record, 99) * 1000, 3)}
+        result.update(extra)
+        result['top_statements'] = pg_stats.top(5)
+        print(json.dumps(result))
+
+    def setup_schema(self):
+        """
+        Make empty pn_* and aj_* tables in the bench schema, and migrate it
+        :return: None
+        Called by: main()
+        """
+        migrate = self.bench.migrate
+        migrate.get_env_vars()
+        conn = migrate.connect()
+        cursor = conn.cursor()
+        cursor.execute('DROP SCHEMA IF EXISTS {0} CASCADE; CREATE SCHEMA {0}; '
+                       'SET search_path TO {0}, public;'.
+                       format(self.bench.schema))
+        code_dir = os.path.dirname(self.bench.tables_file)
+        for file_name in ('create_tables_licenses.sql',
+                          'create_tables_aj_contact_list.sql',
+                          'create_tables_chimp.sql'):
+            self.bench.create_from(cursor, os.path.join(code_dir, file_name))
+        conn.commit()
+        migrate.apply_pending(conn)
+        cursor.close()
+        conn.close()
+
+    def drop_schema(self):
+        conn = self.bench.migrate.connect()
+        cursor = conn.cursor()
+        cursor.execute('DROP SCHEMA IF EXISTS {} CASCADE;'.
+                       format(self.bench.schema))
+        conn.commit()
+        cursor.close()
+        conn.close()
+
+    def get_settings(self, ct_licenses):
+        """:return: what makes two results comparable"""
+        return {'licenses': ct_licenses, 'companies': self.ct_companies,
+                'isp_ratio': self.isp_ratio,
+                'duplicate_ratio': self.duplicate_ratio,
+                'update_ratio': self.update_ratio,
+                'cb_hit_ratio': self.cb_hit_ratio,
+                'cb_latency': self.cb_latency,
+                'cb_sleep_secs': self.cb_sleep_secs, 'seed': self.seed}
+
+    @staticmethod
+    def get_commit():
+        try:
+            return subprocess.check_output(
+                ['git', 'rev-parse', '--short', 'HEAD'],
+                stderr=subprocess.DEVNULL).decode().strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
+
+    def find_baseline(self, record):
+        """
+        :return: the last record in the results file for the same phase and
+                     settings as record, from another commit; or None
+        Called by: report()
+        """
+        baseline = None
+        try:
+            with open(self.results_file) as infile:
+                for line in infile:
+                    earlier = json.loads(line)
+                    if earlier['phase'] == record['phase'] and \
+                            earlier['settings'] == record['settings'] and \
+                            earlier['commit'] != record['commit']:
+                        baseline = earlier
+        except FileNotFoundError:
+            pass
+        return baseline
+
+    def report(self, record):
+        """
+        Print one phase's results (against a baseline, with --compare), and
+            append them to the results file
+        :return: None
+        Called by: main()
+        """
+        baseline = self.find_baseline(record) if self.compare else None
+        result = record['result']
+        line = '{:<15} {:>8} records {:>9.1f} rows/s {:>8} queries ' \
+               '{:>7.1f} MB p50 {:.3f} ms p99 {:.3f} ms'. \
+            format(record['phase'], result['records'],
+                   result['rows_per_sec'] or 0, result['queries'],
+                   result['peak_rss_mb'], result['p50_ms'], result['p99_ms'])
+        print(line)
+        if baseline:
+            base = baseline['result']
+            print('{:<15} vs {}: rows/s {:+.1%}, queries {:+d}, '
+                  'p99 {:+.1%}'.format(
+                      '', baseline['commit'],
+                      (result['rows_per_sec'] or 0) /
+                      (base['rows_per_sec'] or 1) - 1,
+                      result['queries'] - base['queries'],
+                      result['p99_ms'] / (base['p99_ms'] or 1) - 1))
+        with open(self.results_file, 'a') as outfile:
+            print(json.dumps(record, sort_keys=True), file=outfile)
+
+    def main(self):
+        self.get_c_l_args()
+        if self.phase:
+            self.run_phase()
+            return
+        commit = self.get_commit()
+        started = datetime.datetime.now().isoformat()
+        for ct_licenses in self.ct_licenses_list:
+            print('{} licenses:'.format(ct_licenses), file=sys.stderr)
+            self.setup_schema()
+            try:
+                for phase in self.phases_to_run:
+                    output = subprocess.check_output(
+                        [sys.executable, '-m', 'bench.bench_loaders'] +
+                        self.argv + ['--phase', phase,
+                                     '--child_licenses', str(ct_licenses)])
+                    self.report({'commit': commit, 'started': started,
+                                 'phase': phase,
+                                 'settings': self.get_settings(ct_licenses),
+                                 'result': json.loads(
+                                     output.decode().splitlines()[-1])})
+            finally:
+                self.drop_schema()
+
+
+if __name__ == '__main__':
+    BenchLoaders().main()
@@ -0,0 +1,270 @@
+# file: bench_lookup_indexes.py
+
+import os
+import sys
+import argparse
+import random
+import statistics
+import time
+
+try:
+    from db.migrate import Migrate
+except ModuleNotFoundError:
+    from migrate import Migrate
+
+try:
+    from crunchbase_orgs.src.load_organizations import LoadOrganizations
+except ModuleNotFoundError:
+    from crunchbase_orgs.load_organizations import LoadOrganizations
+
+
+class BenchLookupIndexes:
+    """
+    Time the loaders' lookup queries on a seeded copy of the pn_* tables,
+    before and after the pending migrations in db/migrations/, and write a
+    report of both.
+    The copy is made in its own schema, BENCH_SCHEMA (dropped at the end
+    unless --keep), so the pn_* tables themselves are not touched; the
+    uuid-ossp extension must be installed.
+    Set DBHOST, DBNAME, DBUSER and DBPASSWD, then run from the repository
+    root as, e.g.:
+    python3 -m bench.bench_lookup_indexes -o 20000 -c 50000 -r report.md
+    bench/lookup_indexes_report.md holds the report of such a run.
+    """
+    tables_file = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                               '..', 'db', 'code', 'create_tables_licenses.sql')
+    # (name, query, how to make its parameters from an org number and
+    # self.lcd_ids), from load_organizations.py
+    queries = [
+        ('get_organization_id', LoadOrganizations.org_id_query,
+         lambda n, lcd_ids: ('org {}'.format(n),)),
+        ('get_license_contact_details_id_list',
+         LoadOrganizations.lcd_ids_query,
+         lambda n, lcd_ids: ('org {}'.format(n),)),
+        ('do_store_part_2', LoadOrganizations.link_licenses_query,
+         lambda n, lcd_ids: (None, lcd_ids[n])),
+        ('remove_company_from_orgs', LoadOrganizations.remove_org_query,
+         lambda n, lcd_ids: ('org {}'.format(n), 'org {}'.format(n))),
+        ('get_licensed_companies',
+         LoadOrganizations.licensed_companies_query,
+         lambda n, lcd_ids: (['org {}'.format(n + k) for k in range(20)],)),
+    ]
+
+    def __init__(self, ct_orgs=20000, ct_contacts=50000, reps=200, seed=0):
+        self.ct_orgs = ct_orgs
+        self.ct_contacts = ct_contacts  # one license contact details each
+        self.licenses_per_lcd = 2
+        self.reps = reps
+        self.schema = 'bench_lookup_indexes'
+        self.keep = False
+        self.report_file = None
+        self.rng = random.Random(seed)
+        self.lcd_ids = {}  # org number -> id of a lcd with its company
+        self.migrate = Migrate()
+
+    def get_c_l_args(self, argv=None):
+        """Get command line arguments"""
+        parser = argparse.ArgumentParser()
+        parser.add_argument('-o', '--orgs', type=int, default=self.ct_orgs,
+                            help='number of organizations')
+        parser.add_argument('-c', '--contacts', type=int,
+                            default=self.ct_contacts,
+                            help='number of contacts, and of license contact '
+                                 'details')
+        parser.add_argument('-n', '--reps', type=int, default=self.reps,
+                            help='times to run each query, before and after')
+        parser.add_argument('-s', '--bench_schema', type=str,
+                            default=self.schema,
+                            help='schema to seed; dropped first if it exists')
+        parser.add_argument('-k', '--keep', action='store_true',
+                            help='keep the seeded schema afterwards')
+        parser.add_argument('-r', '--report_file', type=str, default=None,
+                            help='also write the report to REPORT_FILE')
+        args = parser.parse_args(argv)
+        self.ct_orgs = args.orgs
+        self.ct_contacts = args.contacts
+        self.reps = args.reps
+        self.schema = args.bench_schema
+        self.keep = args.keep
+        self.report_file = args.report_file
+
+    def seed(self, conn):
+        """
+        Create the pn_* tables in self.schema, as create_tables_licenses.sql
+            does (without its DROPs, which search_path could aim elsewhere),
+            and fill them
+        :param conn: to the db, with search_path set to self.schema
+        :return: None
+        Called by: run()
+        """
+        cursor = conn.cursor()
+        self.create_from(cursor, self.tables_file)
+        cursor.execute(
+            "INSERT INTO pn_organizations (name, domain, pgres_last_updated) "
+            "SELECT 'org ' || i, 'org' || i || '.com', now() "
+            "FROM generate_series(1, %s) i;", (self.ct_orgs,))
+        cursor.execute(
+            "INSERT INTO pn_contacts (email, pgres_last_updated) "
+            "SELECT 'contact' || i || '@org' || (1 + i %% %s) || '.com', now() "
+            "FROM generate_series(1, %s) i;", (self.ct_orgs, self.ct_contacts))
+        cursor.execute(
+            "INSERT INTO pn_addons (key, name) "
+            "VALUES ('bench.addon', 'Bench addon');")
+        # companies repeat across regions, as they do in Marketplace data
+        cursor.execute(
+            "INSERT INTO pn_license_contact_details (company, country, "
+            "region, tech_contact_id, pgres_last_updated) "
+            "SELECT 'org ' || (1 + n %% %s), 'US', 'R' || n, id, now() "
+            "FROM (SELECT id, row_number() OVER () AS n "
+            "FROM pn_contacts) c;", (self.ct_orgs,))
+        cursor.execute(
+            "INSERT INTO pn_licenses (license_id, addons_id, "
+            "license_contact_details_id, addon_key, hosting, last_updated, "
+            "license_type, maint_start_date, maint_end_date, status, tier, "
+            "pgres_last_updated) "
+            "SELECT 'L' || n || '-' || k, a.id, lcd.id, a.key, 'Server', "
+            "now()::date, 'EVALUATION', now(), now() + interval '30 days', "
+            "'active', '10 Users', now() "
+            "FROM (SELECT id, row_number() OVER () AS n "
+            "FROM pn_license_contact_details) lcd, "
+            "generate_series(1, %s) k, pn_addons a;",
+            (self.licenses_per_lcd,))
+        # link half the licenses to their organizations
+        cursor.execute(
+            "UPDATE pn_licenses l SET organizations_id = o.id "
+            "FROM pn_license_contact_details lcd, pn_organizations o "
+            "WHERE lcd.id = l.license_contact_details_id "
+            "AND o.name = lcd.company AND l.license_id LIKE '%-1';")
+        cursor.execute(
+            "SELECT substr(company, 5)::int, min(id::text) "
+            "FROM pn_license_contact_details GROUP BY company;")
+        self.lcd_ids = dict(cursor.fetchall())
+        conn.commit()
+        cursor.close()
+        self.analyze(conn)
+
+    @staticmethod
+    def create_from(cursor, sql_file):
+        """
+        Run a db/code/create_*.sql file, less its top level DROPs
+        :param cursor: on a connection with search_path set to the schema
+                           to create in
+        :param sql_file: path of the file
+        :return: None
+        Called by: seed(), CheckQueryPlans.seed()
+        """
+        with open(sql_file) as infile:
+            cursor.execute(''.join(line for line in infile
+                                   if not line.startswith('DROP ')))
+
+    @staticmethod
+    def analyze(conn):
+        """
+        Update the planner statistics of the seeded tables
+        Called by: seed(), run()
+        """
+        cursor = conn.cursor()
+        for table in ('pn_organizations', 'pn_contacts',
+                      'pn_license_contact_details', 'pn_licenses'):
+            cursor.execute('ANALYZE {};'.format(table))
+        conn.commit()
+        cursor.close()
+
+    def time_queries(self, conn):
+        """
+        Run each query self.reps times with random organizations, rolling
+            back after each run
+        :param conn: to the db, with search_path set to self.schema
+        :return: dict of query name -> (median ms, p99 ms)
+        Called by: run()
+        """
+        timings = {}
+        cursor = conn.cursor()
+        for name, query, make_params in self.queries:
+            secs = []
+            for _ in range(self.reps):
+                params = make_params(self.rng.randint(1, self.ct_orgs),
+                                     self.lcd_ids)
+                start = time.perf_counter()
+                cursor.execute(query, params)
+                if cursor.description:
+                    cursor.fetchall()
+                secs.append(time.perf_counter() - start)
+                conn.rollback()
+            secs.sort()
+            timings[name] = (statistics.median(secs) * 1000,
+                             self.percentile(secs, 99) * 1000)
+        cursor.close()
+        return timings
+
+    @staticmethod
+    def percentile(sorted_values, pct):
+        """
+        :param sorted_values: in ascending order
+        :param pct: e.g. 99
+        :return: the nearest-rank pct percentile; 0.0 if there are no values
+        Called by: time_queries(), BenchLoaders.run_phase()
+        """
+        if not sorted_values:
+            return 0.0
+        return sorted_values[min(len(sorted_values) - 1,
+                                 int(len(sorted_values) * pct / 100))]
+
+    def make_report(self, before, after, versions):
+        """
+        :return: the report, as a markdown table
+        Called by: run()
+        """
+        lines = ['Lookup queries on {} organizations, {} license contact '
+                 'details, {} licenses; {} runs each'.
+                 format(self.ct_orgs, self.ct_contacts,
+                        self.ct_contacts * self.licenses_per_lcd, self.reps),
+                 'Migrations applied: {}'.format(', '.join(versions) or
+                                                 'none pending'),
+                 '',
+                 '| query | before p50 ms | before p99 ms | after p50 ms '
+                 '| after p99 ms | speedup (p50) |',
+                 '|---|---:|---:|---:|---:|---:|']
+        for name, _, _ in self.queries:
+            (before_p50, before_p99), (after_p50, after_p99) = \
+                before[name], after[name]
+            lines.append('| {} | {:.3f} | {:.3f} | {:.3f} | {:.3f} | {:.1f}x |'.
+                         format(name, before_p50, before_p99, after_p50,
+                                after_p99, before_p50 / after_p50))
+        return '\n'.join(lines)
+
+    def run(self):
+        self.migrate.get_env_vars()
+        conn = self.migrate.connect()
+        cursor = conn.cursor()
+        try:
+            cursor.execute('DROP SCHEMA IF EXISTS {0} CASCADE; '
+                           'CREATE SCHEMA {0}; '
+                           'SET search_path TO {0}, public;'.
+                           format(self.schema))
+            conn.commit()
+            print('Seeding {}...'.format(self.schema), file=sys.stderr)
+            self.seed(conn)
+            before = self.time_queries(conn)
+            versions = self.migrate.apply_pending(conn)
+            self.analyze(conn)
+            after = self.time_queries(conn)
+            report = self.make_report(before, after, versions)
+            print(report)
+            if self.report_file:
+                with open(self.report_file, 'w') as outfile:
+                    print(report, file=outfile)
+        finally:
+            conn.rollback()
+            if not self.keep:
+                cursor.execute('DROP SCHEMA IF EXISTS {} CASCADE;'.
+                               format(self.schema))
+                conn.commit()
+            cursor.close()
+            conn.close()
+
+
+if __name__ == '__main__':
+    bench = BenchLookupIndexes()
+    bench.get_c_l_args()
+    bench.run()
@@ -0,0 +1,162 @@
+# file: bench_token_index.py
+
+import sys
+import argparse
+import itertools
+import random
+import string
+import time
+
+try:
+    from crunchbase_orgs.src.token_index import TokenIndex
+except ModuleNotFoundError:
+    from crunchbase_orgs.token_index import TokenIndex
+
+
+class BenchTokenIndex:
+    """
+    Compare candidate generation for company names using
+    TokenIndex.batch_candidates() against TokenIndex.candidates() called
+    per company, as get_index_candidates() falls back to, and against the
+    list scan that pick_by_matches() implies: every company's word list
+    against every organization's word list.
+    Run from the repository root as, e.g.:
+    python3 -m bench.bench_token_index -o 20000 -c 2000
+    """
+    suffixes = ['inc', 'llc', 'ltd', 'gmbh', 'corp', 'group', 'labs',
+                'software', 'systems', 'technologies']
+
+    def __init__(self, ct_orgs=20000, ct_companies=2000, seed=0):
+        self.ct_orgs = ct_orgs
+        self.ct_companies = ct_companies
+        self.scan_limit = None
+        self.rng = random.Random(seed)
+        self.vocabulary = []
+        self.org_names = []
+        self.companies = []
+
+    def get_c_l_args(self, argv=None):
+        """Get command line arguments"""
+        parser = argparse.ArgumentParser()
+        parser.add_argument('-o', '--orgs', type=int, default=self.ct_orgs,
+                            help='number of known organizations')
+        parser.add_argument('-c', '--companies', type=int,
+                            default=self.ct_companies,
+                            help='number of license companies to match')
+        parser.add_argument('-l', '--scan_limit', type=int, default=None,
+                            help='time the list scan on only the first '
+                                 'SCAN_LIMIT companies (it is slow)')
+        args = parser.parse_args(argv)
+        self.ct_orgs = args.orgs
+        self.ct_companies = args.companies
+        self.scan_limit = args.scan_limit
+
+    def make_word(self):
+        return ''.join(self.rng.choice(string.ascii_lowercase)
+                       for _ in range(self.rng.randint(3, 9)))
+
+    def make_data(self):
+        """
+        Make organization names from a Zipf-like vocabulary, and company
+            names that are variations on some of them
+        :return: None
+        Called by: main()
+        """
+        self.vocabulary = [self.make_word() for _ in range(self.ct_orgs // 2)]
+        cum_weights = list(itertools.accumulate(
+            1 / (rank + 1) for rank in range(len(self.vocabulary))))
+        for _ in range(self.ct_orgs):
+            words = self.rng.choices(self.vocabulary, cum_weights=cum_weights,
+                                     k=self.rng.randint(1, 3))
+            if self.rng.random() < 0.5:
+                words.append(self.rng.choice(self.suffixes))
+            self.org_names.append(' '.join(words).title())
+        for _ in range(self.ct_companies):
+            words = self.rng.choice(self.org_names).lower().split()
+            if self.rng.random() < 0.3:
+                words = words[:-1] or words
+            if self.rng.random() < 0.3:
+                words.append(self.rng.choice(self.suffixes))
+            self.companies.append(' '.join(words))
+
+    def scan_candidates(self, company, response_word_lists, limit=10):
+        """
+        Score every organization by the number of company words found in
+            its word list, as pick_by_matches() counts them
+        Called by: time_scan()
+        """
+        company_word_list = company.lower().split(' ')
+        scores = []
+        for ix, response_word_list in enumerate(response_word_lists):
+            ct_word_matches = len([item for item in company_word_list
+                                   if item in response_word_list])
+            if ct_word_matches:
+                scores.append((ct_word_matches, ix))
+        scores.sort(reverse=True)
+        return scores[:limit]
+
+    def time_scan(self, companies):
+        response_word_lists = [name.lower().split() for name in self.org_names]
+        start = time.perf_counter()
+        for company in companies:
+            self.scan_candidates(company, response_word_lists)
+        return time.perf_counter() - start
+
+    def time_index(self):
+        start = time.perf_counter()
+        token_index = TokenIndex()
+        for ix, name in enumerate(self.org_names):
+            token_index.add(ix, {'properties': {'name': name}})
+        token_index.finalize()
+        build_secs = time.perf_counter() - start
+        start = time.perf_counter()
+        per_company = {company: token_index.candidates(company)
+                       for company in self.companies}
+        per_company_secs = time.perf_counter() - start
+        start = time.perf_counter()
+        batch = token_index.batch_candidates(self.companies)
+        query_secs = time.perf_counter() - start
+        if batch != per_company:
+            print('batch_candidates() and candidates() disagree',
+                  file=sys.stderr)
+        lower_names = set(name.lower() for name in self.org_names)
+        found = sum(1 for company in self.companies
+                    if any(self.org_names[org_key].lower() == company
+                           for org_key, _ in batch[company]))
+        ct_exact = sum(1 for company in self.companies
+                       if company in lower_names)
+        return build_secs, per_company_secs, query_secs, found, ct_exact
+
+    def main(self):
+        self.get_c_l_args()
+        self.make_data()
+        scan_companies = self.companies[:self.scan_limit] \
+            if self.scan_limit else self.companies
+        scan_secs = self.time_scan(scan_companies)
+        build_secs, per_company_secs, query_secs, found, ct_exact = \
+            self.time_index()
+        scan_rate = len(scan_companies) / scan_secs if scan_secs else 0
+        per_company_rate = self.ct_companies / per_company_secs \
+            if per_company_secs else 0
+        index_rate = self.ct_companies / query_secs if query_secs else 0
+        print('{} organizations, {} companies'.format(self.ct_orgs,
+                                                      self.ct_companies))
+        print('list scan:          {:10.0f} companies/s ({} companies in {:.3f} s)'.
+              format(scan_rate, len(scan_companies), scan_secs))
+        print('candidates():       {:10.0f} companies/s (index built in '
+              '{:.3f} s, queried per company in {:.3f} s)'.
+              format(per_company_rate, build_secs, per_company_secs))
+        print('batch_candidates(): {:10.0f} companies/s (batch queried in '
+              '{:.3f} s)'.format(index_rate, query_secs))
+        if per_company_rate:
+            print('speedup over candidates(): {:10.1f}x'.
+                  format(index_rate / per_company_rate))
+        if scan_rate:
+            print('speedup over list scan:    {:10.1f}x'.
+                  format(index_rate / scan_rate))
+        print('{} of {} exact-name companies have their organization among '
+              'the candidates'.format(found, ct_exact), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    BenchTokenIndex().main()
@@ -0,0 +1,304 @@
+# file: check_query_plans.py
+
+import os
+import sys
+import argparse
+import json
+
+try:
+    from bench.bench_lookup_indexes import BenchLookupIndexes
+except ModuleNotFoundError:
+    from bench_lookup_indexes import BenchLookupIndexes
+
+try:
+    from mktplc_export_lics.src.load_licenses import LoadLicenses
+    from crunchbase_orgs.src.load_organizations import LoadOrganizations
+except ModuleNotFoundError:
+    from mktplc_export_lics.load_licenses import LoadLicenses
+    from crunchbase_orgs.load_organizations import LoadOrganizations
+
+try:
+    from chimp.src.import_and_add_subscribers import ImportAndAddSubscribers
+except ModuleNotFoundError:
+    from chimp.import_and_add_subscribers import ImportAndAddSubscribers
+
+
+class CheckQueryPlans:
+    """
+    Plan regression check for the loaders' hot queries: seed a copy of the
+    pn_* and aj_* tables at realistic row counts (in its own schema, as
+    bench_lookup_indexes.py does), apply the migrations, run EXPLAIN
+    (FORMAT JSON) on each query, and fail if a plan scans a table of more
+    than --small_table_rows rows sequentially, or costs more than the
+    query's budget.
+    The queries are the loaders' own, from their class attributes, so the
+    check follows any change to them.
+    Exits with status 1 if any query fails.
+    Set DBHOST, DBNAME, DBUSER and DBPASSWD, then run from the repository
+    root as, e.g.:
+    python3 -m bench.check_query_plans -o 20000 -c 50000
+    """
+    code_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            '..', 'db', 'code')
+    # no row has this id; the plan for one that does is the same
+    some_uuid = '00000000-0000-0000-0000-000000000000'
+    # Parameter values name rows that seed() makes.
+    # (name, query, parameters, cost budget or None, tables it may scan)
+    queries = [
+        # load_licenses.py
+        ('LoadLicenses.get_contact_id, get_id',
+         LoadLicenses.contact_id_query,
+         ('contact17@org18.com',), 50, ()),
+        ('LoadLicenses.is_contact_item_duplicate',
+         LoadLicenses.contact_query,
+         ('contact17@org18.com',), 50, ()),
+        ('LoadLicenses.update_tech_contact, update_bill_contact',
+         LoadLicenses.update_contact_query,
+         ('contact17@org18.com',) + (None,) * 8 + ('contact17@org18.com',),
+         50, ()),
+        ('LoadLicenses.get_addons_id',
+         LoadLicenses.addons_id_query,
+         ('bench.addon',), 50, ()),
+        ('LoadLicenses.get_partner_details_id',
+         LoadLicenses.partner_details_id_query,
+         ('Bench partner',), 50, ()),
+        ('LoadLicenses.get_lcd_id',
+         LoadLicenses.lcd_id_query,
+         ('org 18', 'US', 'R17'), 50, ()),
+        ('LoadLicenses.is_lcd_item_duplicate',
+         LoadLicenses.lcd_query,
+         ('org 18', 'US', 'R17'), 50, ()),
+        ('LoadLicenses.update_lcd',
+         LoadLicenses.update_lcd_query,
+         (None, None, None, 'org 18', 'US', 'R17'), 50, ()),
+        ('LoadLicenses.get_organizations_id',
+         LoadLicenses.organizations_id_query,
+         ('L17-1',), 50, ()),
+        ('LoadLicenses.is_license_id_item_duplicate',
+         LoadLicenses.license_duplicate_query,
+         ('L17-1', 'L17-1') + (None,) * 12 + ('10 Users',), 50, ()),
+        ('LoadLicenses.update_license',
+         LoadLicenses.update_license_query,
+         ('L17-1',) + (None,) * 14 + ('L17-1',), 50, ()),
+        # load_organizations.py
+        ('LoadOrganizations.get_organization_id',
+         LoadOrganizations.org_id_query,
+         ('org 17',), 50, ()),
+        ('LoadOrganizations.is_item_different',
+         LoadOrganizations.org_by_domain_query,
+         ('org17.com',), 50, ()),
+        ('LoadOrganizations.get_license_contact_details_id_list',
+         LoadOrganizations.lcd_ids_query,
+         ('org 17',), 50, ()),
+        ('LoadOrganizations.do_store_part_2',
+         LoadOrganizations.link_licenses_query,
+         (None, some_uuid), 50, ()),
+        ('LoadOrganizations.remove_company_from_orgs',
+         LoadOrganizations.remove_org_query,
+         ('org 17', 'org 17'), 200, ()),
+        ('LoadOrganizations.get_licensed_companies',
+         LoadOrganizations.licensed_companies_query,
+         (['org {}'.format(n) for n in range(1, 501)],), 20000, ()),
+    ]
+
+    def __init__(self):
+        self.bench = BenchLookupIndexes()
+        self.small_table_rows = 1000  # seq scans of smaller tables are fine
+        self.cost_scale = 1.0
+        self.existing_schema = None
+        self.ct_failed = 0
+
+    def get_c_l_args(self, argv=None):
+        """Get command line arguments"""
+        parser = argparse.ArgumentParser()
+        parser.add_argument('-o', '--orgs', type=int,
+                            default=self.bench.ct_orgs,
+                            help='number of organizations')
+        parser.add_argument('-c', '--contacts', type=int,
+                            default=self.bench.ct_contacts,
+                            help='number of contacts, and of license contact '
+                                 'details')
+        parser.add_argument('-s', '--bench_schema', type=str,
+                            default=self.bench.schema,
+                            help='schema to seed; dropped first if it exists')
+        parser.add_argument('-k', '--keep', action='store_true',
+                            help='keep the seeded schema afterwards')
+        parser.add_argument('-e', '--existing_schema', type=str, default=None,
+                            help='check the tables in EXISTING_SCHEMA, as they '
+                                 'are, rather than seeding a copy')
+        parser.add_argument('--small_table_rows', type=int,
+                            default=self.small_table_rows,
+                            help='allow sequential scans of tables with at '
+                                 'most this many rows')
+        parser.add_argument('--cost_scale', type=float, default=self.cost_scale,
+                            help='multiply every cost budget by COST_SCALE')
+        args = parser.parse_args(argv)
+        self.bench.ct_orgs = args.orgs
+        self.bench.ct_contacts = args.contacts
+        self.bench.schema = args.bench_schema
+        self.bench.keep = args.keep
+        self.existing_schema = args.existing_schema
+        self.small_table_rows = args.small_table_rows
+        self.cost_scale = args.cost_scale
+
+    def get_queries(self):
+        """
+        :return: self.queries, and the queries the loaders build at run time
+        Called by: main()
+        """
+        queries = list(self.queries)
+        lo = LoadOrganizations()
+        lo.setup_sql_update_org()
+        queries.append(('LoadOrganizations.do_update', lo.sql_update_org,
+                        (None,) * 17 + ('org17.com',), 50, ()))
+        # the subscriber reader reads all of aj_contact_list, and the sync
+        # state of each list, by design
+        chimp = ImportAndAddSubscribers()
+        chimp.list_ids = ['list_a', 'list_b']
+        chimp.list_filters = {'list_b': 'trial_exp >= current_date'}
+        chimp.delta = True
+        query, data_tuple = chimp.build_reader_query()
+        queries.append(('ImportAndAddSubscribers.build_reader_query', query,
+                        data_tuple, None,
+                        ('aj_contact_list', 'aj_chimp_sync_state')))
+        return queries
+
+    def seed(self, conn):
+        """
+        Seed the pn_* tables as bench_lookup_indexes.py does, then
+            aj_contact_list from them, and a MailChimp sync state for
+            list_a
+        :param conn: to the db, with search_path set to the bench schema
+        :return: None
+        Called by: main()
+        """
+        self.bench.seed(conn)
+        cursor = conn.cursor()
+        cursor.execute("INSERT INTO pn_partner_details (name, type) "
+                       "VALUES ('Bench partner', 'RESELLER');")
+        for file_name in ('create_tables_aj_contact_list.sql',
+                          'create_tables_chimp.sql'):
+            self.bench.create_from(cursor,
+                                   os.path.join(self.code_dir, file_name))
+        cursor.execute('SELECT refresh_aj_contact_list(TRUE);')
+        cursor.execute("INSERT INTO aj_chimp_sync_state (list_id, "
+                       "email_address, payload_hash, pushed_at) "
+                       "SELECT 'list_a', lower(email_address), "
+                       "md5(status || '|' || "
+                       "to_char(trial_exp, 'YYYY-MM-DD')), now() "
+                       "FROM aj_contact_list;")
+        for table in ('pn_partner_details', 'aj_contact_list',
+                      'aj_chimp_sync_state'):
+            cursor.execute('ANALYZE {};'.format(table))
+        conn.commit()
+        cursor.close()
+
+    @staticmethod
+    def get_table_rows(conn):
+        """
+        :return: dict of table name -> planner row estimate, for the tables
+                     of the current schema
+        Called by: main()
+        """
+        cursor = conn.cursor()
+        cursor.execute('SELECT c.relname, c.reltuples FROM pg_class c ' +
+                       'JOIN pg_namespace n ON n.oid = c.relnamespace ' +
+                       "WHERE n.nspname = current_schema() " +
+                       "AND c.relkind = 'r';")
+        table_rows = dict(cursor.fetchall())
+        cursor.close()
+        return table_rows
+
+    @staticmethod
+    def walk_plan(plan):
+        """
+        :param plan: a plan node from EXPLAIN (FORMAT JSON)
+        :return: it and each node under it
+        Called by: check_query()
+        """
+        yield plan
+        for sub_plan in plan.get('Plans', []):
+            yield from CheckQueryPlans.walk_plan(sub_plan)
+
+    def check_query(self, conn, table_rows, query_spec):
+        """
+        EXPLAIN one query, and judge its plan
+        :param conn: to the db
+        :param table_rows: as from get_table_rows()
+        :param query_spec: an item of get_queries()
+        :return: (total cost, list of problems found)
+        Called by: main()
+        """
+        name, query, params, budget, seq_scan_ok = query_spec
+        cursor = conn.cursor()
+        cursor.execute('EXPLAIN (FORMAT JSON) ' + query, params)
+        plan = cursor.fetchone()[0]
+        if isinstance(plan, str):  # older psycopg2 leave json as text
+            plan = json.loads(plan)
+        plan = plan[0]['Plan']
+        cursor.close()
+        conn.rollback()
+        problems = []
+        for node in self.walk_plan(plan):
+            table = node.get('Relation Name')
+            if node['Node Type'] == 'Seq Scan' and table not in seq_scan_ok \
+                    and table_rows.get(table, 0) > self.small_table_rows:
+                problems.append('seq scan on {} ({:.0f} rows)'.
+                                format(table, table_rows[table]))
+        if budget is not None and \
+                plan['Total Cost'] > budget * self.cost_scale:
+            problems.append('cost {:.1f} over budget {:.1f}'.
+                            format(plan['Total Cost'],
+                                   budget * self.cost_scale))
+        return plan['Total Cost'], problems
+
+    @staticmethod
+    def report_query(name, cost, problems):
+        """
+        Print one query's result
+        Called by: main()
+        """
+        print('{:<6} {:>10.1f}  {}'.format('FAIL' if problems else 'ok', cost,
+                                          name))
+        for problem in problems:
+            print('{:>19}{}'.format('', problem))
+
+    def main(self):
+        self.get_c_l_args()
+        self.bench.migrate.get_env_vars()
+        conn = self.bench.migrate.connect()
+        cursor = conn.cursor()
+        schema = self.existing_schema or self.bench.schema
+        try:
+            if not self.existing_schema:
+                cursor.execute('DROP SCHEMA IF EXISTS {0} CASCADE; '
+                               'CREATE SCHEMA {0};'.format(schema))
+            cursor.execute('SET search_path TO {}, public;'.format(schema))
+            conn.commit()
+            if not self.existing_schema:
+                print('Seeding {}...'.format(schema), file=sys.stderr)
+                self.seed(conn)
+                self.bench.migrate.apply_pending(conn)
+                self.bench.analyze(conn)
+            table_rows = self.get_table_rows(conn)
+            print('{:<6} {:>10}  {}'.format('', 'cost', 'query'))
+            for query_spec in self.get_queries():
+                cost, problems = self.check_query(conn, table_rows,
+                                                  query_spec)
+                self.report_query(query_spec[0], cost, problems)
+                if problems:
+                    self.ct_failed += 1
+        finally:
+            conn.rollback()
+            if not self.existing_schema and not self.bench.keep:
+                cursor.execute('DROP SCHEMA IF EXISTS {} CASCADE;'.
+                               format(schema))
+                conn.commit()
+            cursor.close()
+            conn.close()
+        print('{} queries failed'.format(self.ct_failed), file=sys.stderr)
+        sys.exit(1 if self.ct_failed else 0)
+
+
+if __name__ == '__main__':
+    CheckQueryPlans().main()
@@ -5,15 +5,47 @@
 import os
 import sys
 import argparse
+import heapq
+import io
+import itertools
+import json
+import tarfile
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from mailchimp3 import MailChimp
+from mailchimp3.mailchimpclient import MailChimpError
 import psycopg2
+from psycopg2.extras import execute_values
+import requests
+
+try:
+    from common.src.pg_stats import pg_stats, StatsConnection
+except ModuleNotFoundError:
+    from common.pg_stats import pg_stats, StatsConnection
+
+try:
+    from common.src.metrics import Metrics
+except ModuleNotFoundError:
+    from common.metrics import Metrics
+
+try:
+    from common.src.profiling import Profiler
+except ModuleNotFoundError:
+    from common.profiling import Profiler
 
 
 class ImportAndAddSubscribers:
     """
     Import subscriber emails from a test db and upsert them to
-    a MailChimp List
+    one or more MailChimp Lists
     """
+    # per-member errors that resending will not fix; any other error is
+    # retried, up to max_member_attempts times
+    permanent_error_patterns = ('looks fake or invalid', 'compliance state',
+                                'permanently deleted', 'is already a list member',
+                                'is not a valid', 'merge field',
+                                'invalid resource')
+
     def __init__(self):
         """
         Called by: main()
@@ -24,9 +56,37 @@ class ImportAndAddSubscribers:
         self.pg_user = ''
         self.pg_passwd = ''
         self.pg_conn = None
+        self.state_conn = None  # writes aj_chimp_sync_state, aj_chimp_dead_letter
         self.chimpkey = ''
         self.mc_client = None
-        self.list_id = ''
+        self.list_ids = []
+        self.list_filters = {}  # list id -> SQL predicate on aj_contact_list
+        self.mc_base_url = None
+        self.use_batch_ops = False
+        self.ops_per_batch = 100  # each operation carries up to 500 members
+        self.poll_secs = 10
+        self.workers = 1  # update_members() calls in flight
+        self.max_retries = 5  # per chunk, on 429 responses
+        self.backoff_secs = 2
+        self.ct_throttled = 0
+        self.delta = False
+        self.refresh = None  # None, 'incremental' or 'full'
+        self.pending_hashes = {}  # (list id, lower case email) -> payload hash
+        self.ct_marked_pushed = 0
+        self.max_member_attempts = 4
+        # keyed by (list id, lower case email)
+        self.member_payloads = {}  # member, until settled
+        self.member_attempts = {}  # failures so far
+        self.retry_queue = []  # heap of (time due, seq, key)
+        self.retry_seq = itertools.count()
+        self.ct_requeued = 0
+        self.ct_dead_lettered = 0
+        self.ttl_created = 0
+        self.ttl_updated = 0
+        self.ttl_errors = 0
+        self.list_totals = {}  # list id -> [created, updated, errors]
+        self.metrics = Metrics('import_and_add_subscribers')
+        self.profiler = Profiler('import_and_add_subscribers')
 
     def get_c_l_args(self, argv=None):
         """
@@ -34,9 +94,79 @@ class ImportAndAddSubscribers:
         Called by: main()
         """
         parser = argparse.ArgumentParser()
-        parser.add_argument("list_id", help='A MailChimp List ID')
+        parser.add_argument("list_ids", nargs='+', metavar='list_id',
+                            help='A MailChimp List ID; aj_contact_list is '
+                                 'read once for all the lists given')
+        parser.add_argument('-f', '--filter', nargs=2, action='append',
+                            default=[], metavar=('LIST_ID', 'PREDICATE'),
+                            help='send LIST_ID only the aj_contact_list rows '
+                                 'for which the SQL PREDICATE is true, e.g. '
+                                 '"trial_exp >= now()"; repeat for each list')
+        parser.add_argument('-b', '--batch_operations', action='store_true',
+                            help='submit all upserts as MailChimp batch '
+                                 'operations and poll for the results')
+        parser.add_argument('--ops_per_batch', type=int,
+                            default=self.ops_per_batch,
+                            help='operations (of up to 500 members each) '
+                                 'per batch request')
+        parser.add_argument('--poll_secs', type=float, default=self.poll_secs,
+                            help='seconds between batch status checks')
+        parser.add_argument('--mc_base_url', type=str, default=None,
+                            help='send MailChimp requests to MC_BASE_URL, '
+                                 'e.g. a mock server')
+        parser.add_argument('-d', '--delta', action='store_true',
+                            help='push only members that are new, or whose '
+                                 'status or TRIALEXP changed, since '
+                                 'MailChimp last confirmed them')
+        parser.add_argument('-r', '--refresh', action='store_const',
+                            const='incremental',
+                            help='first bring aj_contact_list up to date with '
+                                 'the pn_* tables changed since its last '
+                                 'refresh')
+        parser.add_argument('--full_refresh', action='store_const',
+                            const='full', dest='refresh',
+                            help='first rebuild aj_contact_list from the '
+                                 'pn_* tables')
+        parser.add_argument('-m', '--max_member_attempts', type=int,
+                            default=self.max_member_attempts,
+                            help='send a member that keeps failing at most '
+                                 'this many times before dead-lettering it')
+        parser.add_argument('-w', '--workers', type=int, default=self.workers,
+                            help='keep up to WORKERS update_members calls '
+                                 'in flight (MailChimp allows up to 10 '
+                                 'simultaneous connections per key)')
+        parser.add_argument('--pg_stats', type=int, default=None,
+                            metavar='TOP_N',
+                            help='at exit, print the TOP_N SQL statements by '
+                                 'total time, with call counts and rows')
+        parser.add_argument('--pg_stats_json', type=str, default=None,
+                            help='at exit, write the stats of every SQL '
+                                 'statement to PG_STATS_JSON')
+        parser.add_argument('--metrics_file', type=str, default=None,
+                            help='write phase timings and member counts to '
+                                 'METRICS_FILE (a .prom file in the '
+                                 'node_exporter textfile directory), during '
+                                 'and after the run')
+        Profiler.add_arguments(parser)
         args = parser.parse_args(argv)
-        self.list_id = args.list_id
+        pg_stats.report_at_exit(args.pg_stats, args.pg_stats_json)
+        self.metrics.textfile = args.metrics_file
+        self.profiler.set_from_args(args)
+        self.list_ids = list(dict.fromkeys(args.list_ids))
+        for list_id, predicate in args.filter:
+            if list_id not in self.list_ids:
+                parser.error('--filter names list {}, which is not among the '
+                             'lists given'.format(list_id))
+            self.list_filters[list_id] = predicate
+        self.list_totals = {list_id: [0, 0, 0] for list_id in self.list_ids}
+        self.use_batch_ops = args.batch_operations
+        self.ops_per_batch = args.ops_per_batch
+        self.poll_secs = args.poll_secs
+        self.mc_base_url = args.mc_base_url
+        self.workers = max(1, args.workers)
+        self.delta = args.delta
+        self.refresh = args.refresh
+        self.max_member_attempts = max(1, args.max_member_attempts)
 
     def get_env_vars(self):
         """
@@ -65,6 +195,8 @@ class ImportAndAddSubscribers:
         Called by: main()
         """
         self.mc_client = MailChimp(self.chimpkey)
+        if self.mc_base_url:
+            self.mc_client.base_url = self.mc_base_url.rstrip('/') + '/3.0/'
 
     def connect_pg(self):
         """
@@ -75,36 +207,115 @@ class ImportAndAddSubscribers:
         pg_conn_string = "host = '{}' dbname = '{}' user = '{}' password = '{}'".\
             format(self.pg_host, self.pg_test_name, self.pg_user, self.pg_passwd)
 
-        self.pg_conn = psycopg2.connect(pg_conn_string)
+        self.pg_conn = psycopg2.connect(pg_conn_string,
+                                        connection_factory=StatsConnection)
+        self.state_conn = psycopg2.connect(pg_conn_string,
+                                           connection_factory=StatsConnection)
+
+    def refresh_contact_list(self):
+        """
+        Run refresh_aj_contact_list() (db/code/create_tables_aj_contact_list.sql)
+        :return: None
+        Called by: main()
+        """
+        start = time.perf_counter()
+        with self.state_conn.cursor() as state_cur:
+            state_cur.execute('SELECT refresh_aj_contact_list(%s);',
+                              (self.refresh == 'full',))
+            ct_contacts = state_cur.fetchone()[0]
+        self.state_conn.commit()
+        self.metrics.observe('refresh', time.perf_counter() - start)
+        print('Refreshed aj_contact_list ({}): {} contacts recomputed'.
+              format(self.refresh, ct_contacts), file=sys.stderr)
+
+    def build_reader_query(self):
+        """
+        Build one query over aj_contact_list for all the lists: a push_<k>
+            column per list is true when the row goes to self.list_ids[k],
+            i.e. it satisfies that list's filter and, in delta mode, its
+            payload hash differs from the one last confirmed for that list
+        :return: (query, data tuple)
+        Called by: read_from_pg()
+        """
+        ct_lists = len(self.list_ids)
+        if self.delta:  # list ids are query parameters: escape literal '%'
+            filters = [self.list_filters.get(list_id, 'TRUE').replace('%', '%%')
+                       for list_id in self.list_ids]
+        else:
+            filters = [self.list_filters.get(list_id, 'TRUE')
+                       for list_id in self.list_ids]
+        # the filters are evaluated where only aj_contact_list is in scope
+        inner = ("SELECT email_address, status, trial_exp, " +
+                 "md5(coalesce(status, '') || '|' || " +
+                 "to_char(trial_exp, 'YYYY-MM-DD')) AS payload_hash, " +
+                 ', '.join("coalesce(({}), FALSE) AS m_{}".format(item, k)
+                           for k, item in enumerate(filters)) +
+                 " FROM aj_contact_list")
+        if self.delta:
+            push_cols = ', '.join(
+                "c.m_{0} AND s_{0}.payload_hash IS DISTINCT FROM "
+                "c.payload_hash AS push_{0}".format(k) for k in range(ct_lists))
+            joins = ' '.join(
+                "LEFT JOIN aj_chimp_sync_state s_{0} ON s_{0}.list_id = %s "
+                "AND s_{0}.email_address = lower(c.email_address)".format(k)
+                for k in range(ct_lists))
+            data_tuple = tuple(self.list_ids)
+        else:
+            push_cols = ', '.join("c.m_{0} AS push_{0}".format(k)
+                                  for k in range(ct_lists))
+            joins = ''
+            data_tuple = None
+        query = ("SELECT * FROM (" +
+                 "SELECT c.email_address, c.status, c.trial_exp, " +
+                 "c.payload_hash, " + push_cols + " " +
+                 "FROM (" + inner + ") c " + joins +
+                 ") d WHERE " +
+                 ' OR '.join('d.push_{}'.format(k) for k in range(ct_lists)) +
+                 " ORDER BY d.email_address;")
+        return query, data_tuple
 
     # up to 500 rows will be accepted by MailChimp at a time
-    def read_from_pg(self):
+    def read_from_pg(self, chunk_size=500):
         """
-        Read data from Postgresql to be upserted to MailChimp List
-        :return: The data read, in a format accepted by MailChimp API
+        Read data from Postgresql to be upserted to MailChimp Lists.
+        Streams aj_contact_list through one server-side (named) cursor, so
+            the table is scanned once however many chunks, and lists, it
+            feeds. Each row is routed to every list it matches.
+        In delta mode, keeps the payload hashes of the rows read in
+            self.pending_hashes until MailChimp confirms them.
+        :param chunk_size: members per chunk
+        :return: (list id, chunk) pairs, the chunk in a format accepted by
+                     MailChimp API
         Called by: main()
         """
-        chunk_size = 2
-        limit = chunk_size
-        offset = 0
-        query = ("SELECT email_address, status, trial_exp " +
-                 "FROM aj_contact_list " +
-                 "ORDER BY email_address LIMIT %s OFFSET %s;")
+        query, data_tuple = self.build_reader_query()
+        pg_cur = self.pg_conn.cursor(name='aj_contact_list_reader')
+        pg_cur.itersize = chunk_size
+        pg_cur.execute(query, data_tuple)
+        members_lists = {list_id: [] for list_id in self.list_ids}
         while True:
-            data = (limit, offset)
-            pg_cur = self.pg_conn.cursor()
-            pg_cur.execute(query, data)
-            members_list = []
-            for record in pg_cur:
+            records = pg_cur.fetchmany(chunk_size)
+            if not records:
+                break
+            for record in records:
                 list_item = {'email_address': record[0], 'status': record[1],
                              'merge_fields': {'TRIALEXP': record[2].strftime('%Y-%m-%d')}}
-                members_list.append(list_item)
-            pg_cur.close()
-            if not members_list:
-                break
-            pg_data_dict = {'members': members_list, 'update_existing': True}
-            yield pg_data_dict
-            offset += chunk_size
+                for list_id, push in zip(self.list_ids, record[4:]):
+                    if not push:
+                        continue
+                    members_lists[list_id].append(list_item)
+                    if self.delta:
+                        self.pending_hashes[(list_id, record[0].lower())] = \
+                            record[3]
+                    if len(members_lists[list_id]) == chunk_size:
+                        yield list_id, {'members': members_lists[list_id],
+                                        'update_existing': True}
+                        members_lists[list_id] = []
+        pg_cur.close()
+        for list_id, members_list in members_lists.items():
+            if members_list:
+                yield list_id, {'members': members_list,
+                                'update_existing': True}
 
     def disconnect_pg(self):
         """
@@ -113,6 +324,360 @@ class ImportAndAddSubscribers:
         Called by: main()
         """
         self.pg_conn.close()
+        self.state_conn.close()
+
+    def tally_response(self, list_id, response):
+        """
+        Add the counts from one batch subscribe response to the totals,
+            settle the members it confirms (in delta mode, marking them
+            pushed), and requeue or dead-letter the members it rejects
+        :param list_id: the list the chunk was sent to
+        :param response: from update_members(), or from a batch operation
+        :return: None
+        Called by: push_sequentially(), push_concurrently(),
+                   read_batch_results()
+        """
+        self.ttl_created += response['total_created']
+        self.ttl_updated += response['total_updated']
+        self.ttl_errors += response['error_count']
+        list_totals = self.list_totals[list_id]
+        list_totals[0] += response['total_created']
+        list_totals[1] += response['total_updated']
+        list_totals[2] += response['error_count']
+        confirmed = response['new_members'] + response['updated_members']
+        if self.delta:
+            self.mark_pushed(list_id, confirmed)
+        for member in confirmed:
+            key = (list_id, member['email_address'].lower())
+            self.member_payloads.pop(key, None)
+            self.member_attempts.pop(key, None)
+        self.handle_member_errors(list_id, response['errors'])
+        if self.metrics.is_due():
+            self.export_metrics()
+
+    def is_transient(self, error):
+        """
+        :param error: one item of a batch subscribe response's 'errors'
+        :return: False if resending the member cannot succeed
+        Called by: handle_member_errors()
+        """
+        message = (error.get('error') or '').lower()
+        return not any(pattern in message
+                       for pattern in self.permanent_error_patterns)
+
+    def handle_member_errors(self, list_id, errors):
+        """
+        Queue each transiently failed member for a later chunk, with
+            exponential backoff; dead-letter the permanent failures, and
+            members that have failed self.max_member_attempts times
+        :param list_id: the list the members were sent to
+        :param errors: the 'errors' of a batch subscribe response, or
+                           errors made up for a failed operation
+        :return: None
+        Called by: tally_response(), read_batch_results()
+        """
+        dead_letters = []
+        for error in errors:
+            key = (list_id, (error.get('email_address') or '').lower())
+            member = self.member_payloads.get(key)
+            if member is None:  # not one of ours, or already settled
+                continue
+            attempts = self.member_attempts.get(key, 0) + 1
+            self.member_attempts[key] = attempts
+            if self.is_transient(error) and attempts < self.max_member_attempts:
+                due = time.time() + self.backoff_secs * 2 ** (attempts - 1)
+                heapq.heappush(self.retry_queue,
+                               (due, next(self.retry_seq), key))
+                self.ct_requeued += 1
+                continue
+            dead_letters.append(key + (error.get('error_code'),
+                                       error.get('error'), attempts,
+                                       json.dumps(member)))
+            del self.member_payloads[key]
+            del self.member_attempts[key]
+            self.pending_hashes.pop(key, None)
+        if dead_letters:
+            self.store_dead_letters(dead_letters)
+
+    def store_dead_letters(self, rows):
+        """
+        :param rows: (list id, email, error code, error, attempts,
+                         member as JSON) tuples
+        :return: None
+        Called by: handle_member_errors()
+        """
+        query = ("INSERT INTO aj_chimp_dead_letter " +
+                 "(list_id, email_address, error_code, error, attempts, " +
+                 "member, failed_at) " +
+                 "VALUES %s " +
+                 "ON CONFLICT (list_id, email_address) DO UPDATE " +
+                 "SET error_code = EXCLUDED.error_code, " +
+                 "error = EXCLUDED.error, attempts = EXCLUDED.attempts, " +
+                 "member = EXCLUDED.member, failed_at = EXCLUDED.failed_at;")
+        with self.state_conn.cursor() as state_cur:
+            execute_values(state_cur, query, rows,
+                           template='(%s, %s, %s, %s, %s, %s, now())')
+        self.state_conn.commit()
+        self.ct_dead_lettered += len(rows)
+
+    def with_retries(self, pg_data_iter, chunk_size=500):
+        """
+        Pass the chunks through, remembering their members until they are
+            settled, and put in a chunk of requeued members whenever some
+            are due
+        :param pg_data_iter: as returned by read_from_pg()
+        :param chunk_size: most members per chunk of requeued members
+        :return: (list id, chunk) pairs, as yielded by read_from_pg()
+        Called by: main()
+        """
+        for list_id, item in pg_data_iter:
+            yield from self.due_retries(chunk_size)
+            for member in item['members']:
+                self.member_payloads[(list_id,
+                                      member['email_address'].lower())] = member
+            yield list_id, item
+
+    def wait_for_retries(self, chunk_size=500):
+        """
+        Once all chunks have been pushed: sleep until the next requeued
+            members are due, and yield them
+        Called by: main()
+        """
+        if self.retry_queue:
+            time.sleep(max(0.0, self.retry_queue[0][0] - time.time()))
+        yield from self.due_retries(chunk_size)
+
+    def due_retries(self, chunk_size):
+        """
+        :return: (list id, chunk) pairs of the requeued members whose
+                     time has come
+        Called by: with_retries(), wait_for_retries()
+        """
+        members_lists = {}
+        now = time.time()
+        while self.retry_queue and self.retry_queue[0][0] <= now:
+            _, _, key = heapq.heappop(self.retry_queue)
+            member = self.member_payloads.get(key)
+            if member is None:  # queued twice, and settled in between
+                continue
+            members = members_lists.setdefault(key[0], [])
+            members.append(member)
+            if len(members) == chunk_size:
+                yield key[0], {'members': members, 'update_existing': True}
+                members_lists[key[0]] = []
+        for list_id, members in members_lists.items():
+            if members:
+                yield list_id, {'members': members, 'update_existing': True}
+
+    def mark_pushed(self, list_id, members):
+        """
+        Record the payload hashes of members MailChimp has confirmed, so
+            later delta runs skip them until they change. Members that
+            errored are not recorded, and are read again next run.
+        :param list_id: the list the members were sent to
+        :param members: member records from a batch subscribe response
+        :return: None
+        Called by: tally_response()
+        """
+        rows = []
+        for member in members:
+            key = (list_id, member['email_address'].lower())
+            payload_hash = self.pending_hashes.pop(key, None)
+            if payload_hash is not None:
+                rows.append(key + (payload_hash,))
+        if not rows:
+            return
+        query = ("INSERT INTO aj_chimp_sync_state " +
+                 "(list_id, email_address, payload_hash, pushed_at) " +
+                 "VALUES %s " +
+                 "ON CONFLICT (list_id, email_address) DO UPDATE " +
+                 "SET payload_hash = EXCLUDED.payload_hash, " +
+                 "pushed_at = EXCLUDED.pushed_at;")
+        with self.state_conn.cursor() as state_cur:
+            execute_values(state_cur, query, rows,
+                           template='(%s, %s, %s, now())')
+        self.state_conn.commit()
+        self.ct_marked_pushed += len(rows)
+
+    def push_sequentially(self, pg_data_iter):
+        """
+        Upsert each chunk with its own update_members() call
+        :param pg_data_iter: as returned by read_from_pg()
+        :return: None
+        Called by: main()
+        """
+        while True:
+            try:
+                list_id, item = next(pg_data_iter)
+            except StopIteration:
+                break
+            response = self.update_members(list_id, item)
+            self.tally_response(list_id, response)
+
+    def push_concurrently(self, pg_data_iter):
+        """
+        Keep up to self.workers update_members() calls in flight, reading
+            the next chunks from PostgreSQL while earlier ones are sent;
+            chunks for different lists go out side by side.
+            Responses are tallied here, in the calling thread, so the
+            totals need no lock.
+        :param pg_data_iter: as returned by read_from_pg()
+        :return: None
+        Called by: main()
+        """
+        in_flight = {}  # future -> list id
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for list_id, item in pg_data_iter:
+                if len(in_flight) >= self.workers:
+                    done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        self.tally_response(in_flight.pop(future),
+                                            future.result())
+                future = executor.submit(self.update_members, list_id, item)
+                in_flight[future] = list_id
+            for future, list_id in in_flight.items():
+                self.tally_response(list_id, future.result())
+
+    def update_members(self, list_id, item):
+        """
+        Batch subscribe one chunk, backing off and retrying while MailChimp
+            answers 429 Too Many Requests
+        :param list_id: the list to send the chunk to
+        :param item: one chunk, as yielded by read_from_pg()
+        :return: the update_members() response
+        Called by: push_sequentially(), push_concurrently()
+        """
+        start = time.perf_counter()
+        for attempt in range(self.max_retries + 1):
+            try:
+                response = self.mc_client.lists.update_members(list_id, item)
+                self.metrics.observe('mailchimp_batch',
+                                     time.perf_counter() - start)
+                return response
+            except MailChimpError as err:
+                response = err.args[0].get('response') \
+                    if err.args and isinstance(err.args[0], dict) else None
+                if response is None or response.status_code != 429 or \
+                        attempt == self.max_retries:
+                    raise
+                self.ct_throttled += 1
+                retry_after = response.headers.get('Retry-After', '')
+                time.sleep(int(retry_after) if retry_after.isdigit()
+                           else self.backoff_secs * 2 ** attempt)
+
+    def push_batch_operations(self, pg_data_iter):
+        """
+        Package the chunks as batch subscribe operations, submit them
+            self.ops_per_batch at a time, then wait for and read the results
+        :param pg_data_iter: as returned by read_from_pg()
+        :return: None
+        Called by: main()
+        """
+        batch_list = []  # (batch id, {operation id: (list id, members)})
+        operations = []
+        op_members = {}
+        for ix, (list_id, item) in enumerate(pg_data_iter):
+            operation_id = 'chunk-{}'.format(ix)
+            operations.append({'method': 'POST',
+                               'path': 'lists/{}'.format(list_id),
+                               'operation_id': operation_id,
+                               'body': json.dumps(item)})
+            op_members[operation_id] = (list_id, item['members'])
+            if len(operations) == self.ops_per_batch:
+                batch_list.append((self.submit_batch(operations), op_members))
+                operations = []
+                op_members = {}
+        if operations:
+            batch_list.append((self.submit_batch(operations), op_members))
+        for batch_id, op_members in batch_list:
+            batch = self.wait_for_batch(batch_id)
+            self.read_batch_results(batch, op_members)
+
+    def submit_batch(self, operations):
+        """
+        :param operations: list of batch operations
+        :return: the id of the batch created
+        Called by: push_batch_operations()
+        """
+        start = time.perf_counter()
+        batch = self.mc_client.batch_operations.create(
+            data={'operations': operations})
+        self.metrics.observe('mailchimp_batch_submit',
+                             time.perf_counter() - start)
+        print('Submitted batch {} ({} operations)'.format(batch['id'],
+                                                          len(operations)),
+              file=sys.stderr)
+        return batch['id']
+
+    def wait_for_batch(self, batch_id):
+        """
+        Poll a batch until MailChimp has finished it
+        :param batch_id: as returned by submit_batch()
+        :return: the finished batch
+        Called by: push_batch_operations()
+        """
+        start = time.perf_counter()
+        while True:
+            batch = self.mc_client.batch_operations.get(batch_id)
+            if batch['status'] == 'finished':
+                self.metrics.observe('mailchimp_batch_wait',
+                                     time.perf_counter() - start)
+                return batch
+            time.sleep(self.poll_secs)
+
+    def read_batch_results(self, batch, op_members):
+        """
+        Download a finished batch's result archive (a gzipped tar of JSON
+            files, each a list of operation results), and add each batch
+            subscribe response to the totals. The members of an operation
+            that failed as a whole are all requeued.
+        :param batch: as returned by wait_for_batch()
+        :param op_members: {operation id: (list id, members in that
+                               operation)}
+        :return: None
+        Called by: push_batch_operations()
+        """
+        start = time.perf_counter()
+        archive = requests.get(batch['response_body_url'])
+        archive.raise_for_status()
+        self.metrics.observe('mailchimp_batch_download',
+                             time.perf_counter() - start)
+        with tarfile.open(fileobj=io.BytesIO(archive.content),
+                          mode='r:gz') as tar:
+            for member in tar.getmembers():
+                if not member.isfile() or not member.name.endswith('.json'):
+                    continue
+                for result in json.load(tar.extractfile(member)):
+                    list_id, members = op_members[result['operation_id']]
+                    if result['status_code'] == 200:
+                        self.tally_response(list_id,
+                                            json.loads(result['response']))
+                    else:  # the whole operation failed
+                        self.ttl_errors += len(members)
+                        self.list_totals[list_id][2] += len(members)
+                        self.handle_member_errors(
+                            list_id,
+                            [{'email_address': member['email_address'],
+                              'error': 'operation failed with status {}'.
+                                       format(result['status_code'])}
+                             for member in members])
+
+    def export_metrics(self, finished=False):
+        """
+        Write the run's phase timings and member counts to the metrics file
+        :param finished: if True, the run is over
+        :return: None
+        Called by: tally_response(), main()
+        """
+        self.metrics.set_records({
+            'members_created': self.ttl_created,
+            'members_updated': self.ttl_updated,
+            'member_errors': self.ttl_errors,
+            'members_marked_pushed': self.ct_marked_pushed,
+            'members_requeued': self.ct_requeued,
+            'members_dead_lettered': self.ct_dead_lettered,
+            'requests_throttled': self.ct_throttled})
+        self.metrics.write(finished)
 
     def teardown_mc_client(self):
         """
@@ -132,24 +697,37 @@ class ImportAndAddSubscribers:
         self.get_env_vars()
         self.setup_mc_client()
         self.connect_pg()
-        pg_data_iter = self.read_from_pg()
-        ttl_created = 0
-        ttl_updated = 0
-        ttl_errors = 0
-        while True:
-            try:
-                item = next(pg_data_iter)
-            except StopIteration:
-                break
-            response = self.mc_client.lists.update_members(self.list_id, item)
-            ttl_created += response['total_created']
-            ttl_updated += response['total_updated']
-            ttl_errors += response['error_count']
+        if self.refresh:
+            with self.profiler.phase('refresh'):
+                self.refresh_contact_list()
+        if self.use_batch_ops:
+            push = self.push_batch_operations
+        elif self.workers > 1:
+            push = self.push_concurrently
+        else:
+            push = self.push_sequentially
+        start = time.perf_counter()
+        with self.profiler.phase('push'):
+            push(self.with_retries(self.read_from_pg()))
+            while self.retry_queue:
+                push(self.wait_for_retries())
+        self.metrics.observe('push', time.perf_counter() - start)
         self.disconnect_pg()
         self.teardown_mc_client()
-        print('Total created: {}'.format(ttl_created))
-        print('Total updated: {}'.format(ttl_updated))
-        print('Total errors: {}'.format(ttl_errors))
+        print('Total created: {}'.format(self.ttl_created))
+        print('Total updated: {}'.format(self.ttl_updated))
+        print('Total errors: {}'.format(self.ttl_errors))
+        if len(self.list_ids) > 1:
+            for list_id, list_totals in self.list_totals.items():
+                print('List {}: {} created, {} updated, {} errors'.
+                      format(list_id, *list_totals))
+        if self.delta:
+            print('Members marked pushed: {}'.format(self.ct_marked_pushed))
+        print('Members requeued: {}'.format(self.ct_requeued))
+        print('Members dead-lettered: {}'.format(self.ct_dead_lettered))
+        if self.ct_throttled:
+            print('Requests throttled (429): {}'.format(self.ct_throttled))
+        self.export_metrics(finished=True)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,157 @@
+# file: metrics.py
+
+import os
+import threading
+import time
+
+
+class Metrics:
+    """
+    One loader's metrics for a run: time spent in each phase (summaries,
+    with the longest single call), record counts, and cache hits and
+    misses, written in the Prometheus text format for node_exporter's
+    textfile collector. Point --metrics_file at a .prom file in the
+    directory given to node_exporter as --collector.textfile.directory.
+    The file is replaced whole (written aside, then renamed), after each
+    run and, during long runs, at most every flush_secs.
+    """
+    prefix = 'pn_loader_'
+    # name -> (type, help)
+    families = {
+        'phase_seconds': ('summary', 'Time spent in each phase of the run'),
+        'phase_max_seconds': ('gauge', 'Longest single call of each phase'),
+        'records_total': ('counter', 'Records handled this run, by kind'),
+        'cache_lookups_total': ('counter', 'Cache lookups this run, by result'),
+        'cache_hit_ratio': ('gauge', 'Cache hits over cache lookups this run'),
+        'run_start_timestamp_seconds': ('gauge', 'When this run started'),
+        'last_write_timestamp_seconds': ('gauge', 'When this file was written'),
+        'run_finished': ('gauge', '1 once the run has finished, else 0'),
+    }
+
+    def __init__(self, job, textfile=None, flush_secs=30):
+        self.job = job
+        self.textfile = textfile  # if None, nothing is written
+        self.flush_secs = flush_secs
+        self.phases = {}  # phase -> [calls, total secs, max secs]
+        self.records = {}  # kind -> count
+        self.caches = {}  # cache -> (hits, misses)
+        self.lock = threading.Lock()
+        self.run_start = time.time()
+        self.last_write = time.monotonic()
+
+    def reset(self):
+        """
+        Start a new run: forget the phases, records and caches so far
+        Called by: LoadOrganizations.reset_batch_counts()
+        """
+        with self.lock:
+            self.phases = {}
+            self.records = {}
+            self.caches = {}
+            self.run_start = time.time()
+
+    def observe(self, phase, secs):
+        """
+        Add one call of phase, lasting secs, to its summary
+        Called by: the loaders, around each phase
+        """
+        with self.lock:
+            stats = self.phases.setdefault(phase, [0, 0.0, 0.0])
+            stats[0] += 1
+            stats[1] += secs
+            stats[2] = max(stats[2], secs)
+
+    def set_records(self, counts):
+        """
+        :param counts: dict of kind -> records of that kind so far
+        :return: None
+        Called by: the loaders' export_metrics()
+        """
+        with self.lock:
+            self.records.update(counts)
+
+    def set_cache(self, cache, hits, misses):
+        """
+        Called by: the loaders' export_metrics()
+        """
+        with self.lock:
+            self.caches[cache] = (hits, misses)
+
+    def is_due(self):
+        """:return: True iff a textfile is set and flush_secs have passed
+                        since it was last written"""
+        return self.textfile is not None and \
+            time.monotonic() - self.last_write >= self.flush_secs
+
+    @staticmethod
+    def format_labels(labels):
+        """
+        :param labels: list of (name, value) pairs
+        :return: as in the text format, e.g. '{job="x",phase="fetch"}'
+        Called by: render()
+        """
+        return '{' + ','.join(
+            '{}="{}"'.format(name, str(value).replace('\\', '\\\\').
+                             replace('"', '\\"').replace('\n', '\\n'))
+            for name, value in labels) + '}'
+
+    def render(self, finished=False):
+        """
+        :param finished: if True, the run is over
+        :return: the metrics, in the Prometheus text format
+        Called by: write()
+        """
+        job = [('job', self.job)]
+        samples = {name: [] for name in self.families}
+        with self.lock:
+            for phase, (calls, total, most) in sorted(self.phases.items()):
+                labels = self.format_labels(job + [('phase', phase)])
+                samples['phase_seconds'].append(('_sum', labels, total))
+                samples['phase_seconds'].append(('_count', labels, calls))
+                samples['phase_max_seconds'].append(('', labels, most))
+            for kind, count in sorted(self.records.items()):
+                samples['records_total'].append(
+                    ('', self.format_labels(job + [('kind', kind)]), count))
+            for cache, (hits, misses) in sorted(self.caches.items()):
+                for result, count in (('hit', hits), ('miss', misses)):
+                    samples['cache_lookups_total'].append(
+                        ('', self.format_labels(job + [('cache', cache),
+                                                       ('result', result)]),
+                         count))
+                if hits + misses:
+                    samples['cache_hit_ratio'].append(
+                        ('', self.format_labels(job + [('cache', cache)]),
+                         hits / (hits + misses)))
+        labels = self.format_labels(job)
+        samples['run_start_timestamp_seconds'].append(('', labels,
+                                                       self.run_start))
+        samples['last_write_timestamp_seconds'].append(('', labels,
+                                                        time.time()))
+        samples['run_finished'].append(('', labels, int(finished)))
+        lines = []
+        for name, (metric_type, help_text) in self.families.items():
+            if not samples[name]:
+                continue
+            full_name = self.prefix + name
+            lines.append('# HELP {} {}'.format(full_name, help_text))
+            lines.append('# TYPE {} {}'.format(full_name, metric_type))
+            for suffix, labels, value in samples[name]:
+                lines.append('{}{}{} {}'.format(full_name, suffix, labels,
+                                                 repr(float(value))))
+        return '\n'.join(lines) + '\n'
+
+    def write(self, finished=False):
+        """
+        Replace self.textfile with the current metrics. node_exporter reads
+            only *.prom files, so it never sees the file half written.
+        :param finished: if True, the run is over
+        :return: None
+        Called by: the loaders' export_metrics()
+        """
+        self.last_write = time.monotonic()
+        if self.textfile is None:
+            return
+        temp_file = '{}.{}.tmp'.format(self.textfile, os.getpid())
+        with open(temp_file, 'w') as outfile:
+            outfile.write(self.render(finished))
+        os.replace(temp_file, self.textfile)
@@ -0,0 +1,154 @@
+# file: pg_stats.py
+
+import sys
+import atexit
+import json
+import re
+import threading
+import time
+import psycopg2.extensions
+
+
+class PgStats:
+    """
+    Per statement template counts of calls, total and max latency, and rows
+    affected, gathered by StatsCursor. A template is the SQL as passed to
+    execute(), parameters apart; VALUES lists that execute_values() spells
+    out are folded, so that each of its pages counts as one template.
+    One instance, pg_stats, serves the whole process.
+    """
+    values_list = re.compile(r'\bVALUES\s*\(.*', re.IGNORECASE | re.DOTALL)
+    white_space = re.compile(r'\s+')
+
+    def __init__(self):
+        self.templates = {}  # template -> [calls, total secs, max secs, rows]
+        self.lock = threading.Lock()
+        self.report_registered = False
+
+    def get_template(self, query):
+        """
+        :param query: as passed to execute(): str, bytes or sql.Composable
+        :return: its template
+        Called by: record()
+        """
+        if isinstance(query, bytes):
+            query = query.decode('utf-8', 'replace')
+        elif not isinstance(query, str):
+            query = repr(query)
+        query = self.white_space.sub(' ', query).strip()
+        return self.values_list.sub('VALUES ...', query)
+
+    def record(self, query, secs, rowcount):
+        """
+        Add one statement's run to its template's stats
+        :param rowcount: from the cursor; negative if not known
+        :return: None
+        Called by: StatsCursor.execute(), StatsCursor.executemany()
+        """
+        template = self.get_template(query)
+        with self.lock:
+            stats = self.templates.setdefault(template, [0, 0.0, 0.0, 0])
+            stats[0] += 1
+            stats[1] += secs
+            stats[2] = max(stats[2], secs)
+            if rowcount > 0:
+                stats[3] += rowcount
+
+    def ct_calls(self):
+        """:return: statements run, of all templates"""
+        with self.lock:
+            return sum(stats[0] for stats in self.templates.values())
+
+    def top(self, top_n=None):
+        """
+        :return: list of dicts, one per template, by total time, longest
+                     first; top_n of them, if given
+        Called by: print_report(), write_json()
+        """
+        with self.lock:
+            items = sorted(self.templates.items(), key=lambda item: -item[1][1])
+        return [{'statement': template, 'calls': calls,
+                 'total_secs': round(total, 6), 'max_secs': round(most, 6),
+                 'rows': rows}
+                for template, (calls, total, most, rows) in items[:top_n]]
+
+    def print_report(self, top_n=10, dest=sys.stderr):
+        """
+        Print the top_n templates by total time
+        Called by: report(), client code
+        """
+        print('{} statements in {} templates; top {} by total time:'.
+              format(self.ct_calls(), len(self.templates), top_n), file=dest)
+        print('{:>8} {:>10} {:>9} {:>9} {:>9}  {}'.
+              format('calls', 'total s', 'mean ms', 'max ms', 'rows',
+                     'statement'), file=dest)
+        for item in self.top(top_n):
+            print('{:>8} {:>10.3f} {:>9.3f} {:>9.3f} {:>9}  {}'.
+                  format(item['calls'], item['total_secs'],
+                         item['total_secs'] / item['calls'] * 1000,
+                         item['max_secs'] * 1000, item['rows'],
+                         item['statement'][:100]), file=dest)
+
+    def write_json(self, json_file):
+        """
+        Write every template's stats to json_file
+        Called by: report()
+        """
+        with open(json_file, 'w') as outfile:
+            json.dump(self.top(), outfile, indent=2)
+            print(file=outfile)
+
+    def report(self, top_n=None, json_file=None):
+        """
+        Print the top_n templates, and / or write all of them to json_file
+        Called by: atexit, via report_at_exit()
+        """
+        if top_n:
+            self.print_report(top_n)
+        if json_file:
+            self.write_json(json_file)
+
+    def report_at_exit(self, top_n=None, json_file=None):
+        """
+        Arrange for report() at exit, once however often called
+        :param top_n: print the top_n templates
+        :param json_file: write all templates here, as JSON
+        :return: None
+        Called by: the loaders' command line handling
+        """
+        if (top_n or json_file) and not self.report_registered:
+            atexit.register(self.report, top_n, json_file)
+            self.report_registered = True
+
+
+pg_stats = PgStats()
+
+
+class StatsCursor(psycopg2.extensions.cursor):
+    """A cursor that adds each statement it runs to its connection's stats"""
+    def execute(self, query, vars=None):
+        start = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            self.connection.pg_stats.record(
+                query, time.perf_counter() - start, self.rowcount)
+
+    def executemany(self, query, vars_list):
+        start = time.perf_counter()
+        try:
+            return super().executemany(query, vars_list)
+        finally:
+            self.connection.pg_stats.record(
+                query, time.perf_counter() - start, self.rowcount)
+
+
+class StatsConnection(psycopg2.extensions.connection):
+    """
+    A connection whose cursors are StatsCursors; pass it to psycopg2.connect()
+    or to a pool as connection_factory
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.cursor_factory = StatsCursor
+        self.pg_stats = pg_stats
@@ -0,0 +1,169 @@
+# file: profiling.py
+
+import os
+import sys
+import cProfile
+import collections
+import contextlib
+import io
+import pstats
+import threading
+import time
+import tracemalloc
+
+
+class Profiler:
+    """
+    Profile the named phases of one loader's run, each run of a phase
+    adding to that phase's profile. Into profile_dir go:
+    <job>.<phase>.prof  cProfile stats (deterministic mode), for pstats,
+                        snakeviz, etc.
+    <job>.<phase>.txt   the top_n functions of it by cumulative time
+    <job>.folded        stacks sampled every interval secs, one
+                        'phase;frame;frame... count' line per stack, for
+                        flamegraph.pl or speedscope
+    <job>.memory.txt    with memory=True: the top_n lines by memory
+                        allocated over each run of each phase (tracemalloc)
+    In sampling mode only the stack sampler runs, which costs far less
+    than cProfile. Only the thread that enters a phase is profiled, and a
+    phase entered while another is being profiled is not profiled itself.
+    """
+    modes = ('deterministic', 'sampling')
+
+    def __init__(self, job, profile_dir=None, mode='deterministic',
+                 interval=0.01, memory=False, top_n=30):
+        self.job = job
+        self.profile_dir = profile_dir  # if None, nothing is profiled
+        self.mode = mode
+        self.interval = interval
+        self.memory = memory
+        self.top_n = top_n
+        self.profiles = {}  # phase -> cProfile.Profile
+        self.stacks = collections.Counter()  # folded stack -> samples
+        self.phase_runs = collections.Counter()  # phase -> runs so far
+        self.active = None  # the phase being profiled
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """
+        Profile the body of a with statement as phase name
+        Called by: the loaders' entry points
+        """
+        if self.profile_dir is None or self.active is not None:
+            yield
+            return
+        os.makedirs(self.profile_dir, exist_ok=True)
+        self.active = name
+        self.phase_runs[name] += 1
+        if self.memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            if hasattr(tracemalloc, 'reset_peak'):  # python 3.9+
+                tracemalloc.reset_peak()
+            before = tracemalloc.take_snapshot()
+        stop_sampling = threading.Event()
+        sampler = threading.Thread(target=self.sample,
+                                   args=(threading.get_ident(), name,
+                                         stop_sampling),
+                                   daemon=True)
+        sampler.start()
+        profile = None
+        if self.mode == 'deterministic':
+            profile = self.profiles.setdefault(name, cProfile.Profile())
+            profile.enable()
+        try:
+            yield
+        finally:
+            if profile:
+                profile.disable()
+            stop_sampling.set()
+            sampler.join()
+            if self.memory:
+                self.write_memory(name, before, tracemalloc.take_snapshot())
+            self.active = None
+            self.write(name)
+
+    def sample(self, thread_id, phase, stop_sampling):
+        """
+        Until stop_sampling is set, add the stack of thread thread_id to
+            self.stacks every self.interval secs
+        Called by: phase(), in a thread of its own
+        """
+        while not stop_sampling.wait(self.interval):
+            frame = sys._current_frames().get(thread_id)
+            frames = []
+            while frame is not None:
+                code = frame.f_code
+                frames.append('{}:{}'.format(
+                    os.path.basename(code.co_filename), code.co_name))
+                frame = frame.f_back
+            if frames:
+                self.stacks[';'.join([phase] + frames[::-1])] += 1
+
+    def get_path(self, suffix):
+        """:return: path of the file <job><suffix> in self.profile_dir"""
+        return os.path.join(self.profile_dir, self.job + suffix)
+
+    def write(self, phase):
+        """
+        Write phase's profile and the folded stacks of all phases so far
+        Called by: phase()
+        """
+        profile = self.profiles.get(phase)
+        if profile:
+            profile.dump_stats(self.get_path('.{}.prof'.format(phase)))
+            summary = io.StringIO()
+            pstats.Stats(profile, stream=summary).sort_stats(
+                'cumulative').print_stats(self.top_n)
+            with open(self.get_path('.{}.txt'.format(phase)), 'w') as outfile:
+                outfile.write(summary.getvalue())
+        with open(self.get_path('.folded'), 'w') as outfile:
+            for stack, count in sorted(self.stacks.items()):
+                print('{} {}'.format(stack, count), file=outfile)
+
+    def write_memory(self, phase, before, after):
+        """
+        Add the top_n lines by memory allocated over this run of phase to
+            <job>.memory.txt
+        Called by: phase()
+        """
+        current, peak = tracemalloc.get_traced_memory()
+        with open(self.get_path('.memory.txt'), 'a') as outfile:
+            print('{} {} run {}: {:.1f} MB traced, {:.1f} MB peak'.
+                  format(time.strftime('%Y-%m-%d %H:%M:%S'), phase,
+                         self.phase_runs[phase], current / 2 ** 20,
+                         peak / 2 ** 20), file=outfile)
+            for stat in after.compare_to(before, 'lineno')[:self.top_n]:
+                print('    {}'.format(stat), file=outfile)
+            print(file=outfile)
+
+    @staticmethod
+    def add_arguments(parser):
+        """
+        Add the --profile options to a loader's argument parser
+        Called by: the loaders' command line handling
+        """
+        parser.add_argument('--profile', type=str, default=None,
+                            metavar='PROFILE_DIR',
+                            help='profile each phase of the run, writing '
+                                 'per phase profiles and a folded stack file '
+                                 '(for flamegraph.pl) to PROFILE_DIR')
+        parser.add_argument('--profile_mode', choices=Profiler.modes,
+                            default='deterministic',
+                            help='deterministic: cProfile plus stack '
+                                 'sampling; sampling: stack sampling only, '
+                                 'much cheaper')
+        parser.add_argument('--profile_interval', type=float, default=0.01,
+                            help='seconds between stack samples')
+        parser.add_argument('--profile_memory', action='store_true',
+                            help='also trace allocations with tracemalloc, '
+                                 'and write the top lines of each phase')
+
+    def set_from_args(self, args):
+        """
+        Called by: the loaders' command line handling
+        """
+        self.profile_dir = args.profile
+        self.mode = args.profile_mode
+        self.interval = args.profile_interval
+        self.memory = args.profile_memory
@@ -31,6 +31,8 @@ done
 
 source ./mktplc_export_lics/admin/set_envs.sh
 source ./crunchbase_orgs/admin/set_envs.sh
+# the loaders import the shared modules in ./common
+export PYTHONPATH="${PYTHONPATH:+${PYTHONPATH}:}$(pwd)"
 
 while true
 do
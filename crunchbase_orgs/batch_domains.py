@@ -0,0 +1,58 @@
+# file: batch_domains.py
+
+import numpy as np
+import pandas as pd
+
+
+def classify_emails(emails, isp_domains, shorten):
+    """
+    Preprocess a whole column of tech contact emails in one pass.
+    Gives the same results as calling LoadOrganizations.get_domain_from(),
+        testing the domain against the ISP list, and calling shorten(), on
+        each email in turn.
+    :param emails: sequence of email addresses
+    :param isp_domains: list of ISP domains, as read by get_isp_domain_dict()
+    :param shorten: LoadOrganizations.shorten(), applied once per distinct
+                    non-ISP domain rather than once per email
+    :return: DataFrame with one row per email, and columns
+                 'domain': as from get_domain_from(), or None
+                 'bad_email': True iff 'domain' is None
+                 'is_isp': True iff 'domain' is in isp_domains
+                 'short_domain': shorten('domain') for non-ISP domains,
+                     else None
+    Called by: LoadOrganizations.get_email_and_company(),
+               bench_batch_domains.py
+    """
+    email_col = pd.Series(emails, dtype=object).fillna('').astype(str)
+    if email_col.empty:
+        # rpartition() of an empty column has no columns to index
+        return pd.DataFrame({'domain': pd.Series([], dtype=object),
+                             'bad_email': np.array([], dtype=bool),
+                             'is_isp': np.array([], dtype=bool),
+                             'short_domain': pd.Series([], dtype=object)})
+    # get_domain_from() takes the text after the last '@', provided there is
+    # text before it, and the last '.' comes at least 2 chars after it
+    parts = email_col.str.rpartition('@')
+    local_part = parts[0]
+    domain_col = parts[2]
+    bad_email = ((local_part.str.len() == 0) |
+                 (domain_col.str.rfind('.') < 1)).to_numpy(dtype=bool)
+    domain = domain_col.to_numpy(dtype=object)
+    domain[bad_email] = None
+
+    is_isp = domain_col.isin(isp_domains).to_numpy(dtype=bool) & ~bad_email
+
+    # emails repeat domains heavily: shorten each distinct domain only once
+    needs_short = ~bad_email & ~is_isp
+    short_domain = np.full(len(domain), None, dtype=object)
+    if needs_short.any():
+        codes, uniques = pd.factorize(domain[needs_short])
+        short_uniques = np.array([shorten(item) for item in uniques],
+                                 dtype=object)
+        short_domain[needs_short] = short_uniques[codes]
+
+    # keep None (not NaN) for missing values, as the scalar functions do
+    return pd.DataFrame({'domain': pd.Series(domain, dtype=object),
+                         'bad_email': bad_email,
+                         'is_isp': is_isp,
+                         'short_domain': pd.Series(short_domain, dtype=object)})
@@ -0,0 +1,190 @@
+# file: cb_stats.py
+
+import collections
+import json
+import sys
+import time
+
+
+class CbRequestStats:
+    """
+    Accounting for the HTTP requests LoadOrganizations sends Crunchbase:
+    a latency histogram per query kind (domain or name), counts by HTTP
+    status, and a quota ledger of the requests sent in the last
+    quota_window_secs, against quota_limit. Every attempt counts,
+    retries included, since each one uses quota. The ledger outlasts
+    reset_run(), so that a resident caller keeps to the quota across runs.
+    """
+    # upper bounds, in ms, of the histogram buckets; the last is open
+    bucket_bounds_ms = (25, 50, 100, 200, 400, 800, 1600, 3200, 6400)
+
+    def __init__(self, quota_limit=None, quota_window_secs=60):
+        self.quota_limit = quota_limit  # if None, the ledger only counts
+        self.quota_window_secs = quota_window_secs
+        # kind -> bucket counts, the last for latencies over the last bound
+        self.histograms = {}
+        self.latency_totals = {}  # kind -> [requests, total secs, max secs]
+        self.status_counts = collections.Counter()  # status code, or 'error'
+        self.ledger = collections.deque()  # times of requests in the window
+        self.peak_used = 0  # most requests in any one window
+        self.ct_quota_waits = 0
+        self.quota_wait_secs = 0.0
+
+    def set_quota(self, quota_limit, quota_window_secs):
+        """
+        Called by: LoadOrganizations.get_c_l_args()
+        """
+        self.quota_limit = quota_limit
+        self.quota_window_secs = quota_window_secs
+
+    def reset_run(self):
+        """
+        Forget the last run's histograms, status counts and waits, but keep
+            the ledger of the requests still in the window
+        Called by: LoadOrganizations.reset_run_state()
+        """
+        self.histograms = {}
+        self.latency_totals = {}
+        self.status_counts = collections.Counter()
+        self.peak_used = self.get_used()
+        self.ct_quota_waits = 0
+        self.quota_wait_secs = 0.0
+
+    def prune_ledger(self, now):
+        """Drop the requests that have left the window"""
+        while self.ledger and self.ledger[0] <= now - self.quota_window_secs:
+            self.ledger.popleft()
+
+    def get_used(self):
+        """:return: requests sent in the current window"""
+        self.prune_ledger(time.monotonic())
+        return len(self.ledger)
+
+    def get_wait_secs(self):
+        """
+        :return: how long to wait before the next request keeps within
+                     the quota; 0 if there is no quota, or room in it
+        Called by: LoadOrganizations.wait_for_cb_quota()
+        """
+        if not self.quota_limit:
+            return 0.0
+        now = time.monotonic()
+        self.prune_ledger(now)
+        if len(self.ledger) < self.quota_limit:
+            return 0.0
+        return self.ledger[-self.quota_limit] + self.quota_window_secs - now
+
+    def add_wait(self, secs):
+        """Count a wait made for quota"""
+        self.ct_quota_waits += 1
+        self.quota_wait_secs += secs
+
+    def record(self, kind, secs, status):
+        """
+        Add one request to the histograms, status counts and ledger
+        :param kind: 'domain' or 'name'
+        :param secs: from sending the request to having the response
+        :param status: HTTP status code, or 'error' if there was no response
+        :return: None
+        Called by: LoadOrganizations.get_cb_response()
+        """
+        histogram = self.histograms.setdefault(
+            kind, [0] * (len(self.bucket_bounds_ms) + 1))
+        ms = secs * 1000
+        ix = 0
+        while ix < len(self.bucket_bounds_ms) and \
+                ms > self.bucket_bounds_ms[ix]:
+            ix += 1
+        histogram[ix] += 1
+        totals = self.latency_totals.setdefault(kind, [0, 0.0, 0.0])
+        totals[0] += 1
+        totals[1] += secs
+        totals[2] = max(totals[2], secs)
+        self.status_counts[status] += 1
+        now = time.monotonic()
+        self.ledger.append(now)
+        self.prune_ledger(now)
+        self.peak_used = max(self.peak_used, len(self.ledger))
+
+    def get_percentile_ms(self, kind, fraction):
+        """
+        :return: the upper bound of the bucket holding the given fraction
+                     of kind's requests; None if that is the open bucket
+        Called by: to_dict()
+        """
+        histogram = self.histograms[kind]
+        rank = fraction * sum(histogram)
+        running = 0
+        for ix, count in enumerate(histogram):
+            running += count
+            if running >= rank:
+                break
+        return self.bucket_bounds_ms[ix] \
+            if ix < len(self.bucket_bounds_ms) else None
+
+    def to_dict(self):
+        """
+        :return: all the stats, as JSON-ready dicts
+        Called by: print_report(), write_json()
+        """
+        kinds = {}
+        for kind, (requests, total, most) in sorted(self.latency_totals.items()):
+            kinds[kind] = {
+                'requests': requests,
+                'mean_ms': round(total / requests * 1000, 3),
+                'max_ms': round(most * 1000, 3),
+                'p50_ms_at_most': self.get_percentile_ms(kind, 0.5),
+                'p90_ms_at_most': self.get_percentile_ms(kind, 0.9),
+                'p99_ms_at_most': self.get_percentile_ms(kind, 0.99),
+                'buckets': [{'le_ms': bound, 'count': count}
+                            for bound, count in
+                            zip(self.bucket_bounds_ms + ('inf',),
+                                self.histograms[kind])]}
+        return {'latency': kinds,
+                'status_counts': {str(status): count for status, count in
+                                  sorted(self.status_counts.items(),
+                                         key=lambda item: str(item[0]))},
+                'quota': {'limit': self.quota_limit,
+                          'window_secs': self.quota_window_secs,
+                          'used': self.get_used(),
+                          'peak_used': self.peak_used,
+                          'waits': self.ct_quota_waits,
+                          'wait_secs': round(self.quota_wait_secs, 3)}}
+
+    def print_report(self, dest=sys.stderr):
+        """
+        Print the histograms, status counts and quota ledger
+        Called by: LoadOrganizations.print_report()
+        """
+        stats = self.to_dict()
+        print('Crunchbase request latency, ms:', file=dest)
+        print('{:>8} {:>8} {:>9} {:>9} {:>7} {:>7} {:>7}'.
+              format('kind', 'requests', 'mean', 'max', 'p50<=', 'p90<=',
+                     'p99<='), file=dest)
+        for kind, item in stats['latency'].items():
+            print('{:>8} {:>8} {:>9.1f} {:>9.1f} {:>7} {:>7} {:>7}'.
+                  format(kind, item['requests'], item['mean_ms'],
+                         item['max_ms'], *(str(item[key] or 'inf') for key in
+                                           ('p50_ms_at_most', 'p90_ms_at_most',
+                                            'p99_ms_at_most'))), file=dest)
+            print('{:>8} {}'.format('', ' '.join(
+                '<={}:{}'.format(bucket['le_ms'], bucket['count'])
+                for bucket in item['buckets'] if bucket['count'])), file=dest)
+        print('Crunchbase responses by status: {}'.format(
+            ', '.join('{}: {}'.format(status, count) for status, count in
+                      stats['status_counts'].items()) or 'none'), file=dest)
+        quota = stats['quota']
+        print('Crunchbase quota: {} used of {} per {} secs now, {} at peak; '
+              '{} waits, {:.1f} secs'.
+              format(quota['used'], quota['limit'] or 'unlimited',
+                     quota['window_secs'], quota['peak_used'], quota['waits'],
+                     quota['wait_secs']), file=dest)
+
+    def write_json(self, json_file):
+        """
+        Write all the stats to json_file
+        Called by: LoadOrganizations.print_report()
+        """
+        with open(json_file, 'w') as outfile:
+            json.dump(self.to_dict(), outfile, indent=2)
+            print(file=outfile)
@@ -0,0 +1,345 @@
+#!/usr/bin/env python3.6
+
+
+# file: load_cb_snapshot.py
+
+import os
+import sys
+import argparse
+import calendar
+import csv
+import json
+import time
+import psycopg2
+import psycopg2.extras
+
+try:
+    from src.time_string_conversion import get_now
+except ModuleNotFoundError:
+    from time_string_conversion import get_now
+
+
+class LoadCbSnapshot:
+    """
+    Loads a Crunchbase ODM bulk export (CSV or JSON) into the
+    'cb_odm_organizations' table, so that LoadOrganizations can match
+    licenses locally instead of querying '/odm-organizations' one domain
+    at a time.
+    Run as, e.g.:
+    python3 crunchbase_orgs/src/load_cb_snapshot.py -i organizations.csv
+    then
+    python3 crunchbase_orgs/src/load_organizations.py -b -i <input_file>
+    crunchbase_orgs/odm_organizations_sample.csv is a small snapshot in the
+    ODM layout, for trying it out.
+    """
+    # ODM column name -> 'properties' key used by the odm-organizations API
+    csv_to_properties = {'uuid': 'uuid',
+                         'name': 'name',
+                         'primary_role': 'primary_role',
+                         'short_description': 'short_description',
+                         'domain': 'domain',
+                         'homepage_url': 'homepage_url',
+                         'facebook_url': 'facebook_url',
+                         'twitter_url': 'twitter_url',
+                         'linkedin_url': 'linkedin_url',
+                         'api_url': 'api_url',
+                         'city': 'city_name',
+                         'region': 'region_name',
+                         'country_code': 'country_code',
+                         'combined_stock_symbols': 'combined_stock_symbols',
+                         'created_at': 'created_at',
+                         'updated_at': 'updated_at'}
+
+    # as in the ODM export, e.g. '2014-05-21 04:14:13', always UTC
+    timestamp_formats = ('%Y-%m-%d %H:%M:%S', '%Y-%m-%dT%H:%M:%SZ',
+                         '%Y-%m-%d')
+
+    def __init__(self, db_password=None, infile=None, page_size=1000):
+        self.db_host = None
+        self.db_name = None
+        self.db_user = None
+        self.db_password = db_password
+        self.infile = infile
+        self.file_format = None
+        self.truncate = False
+        self.page_size = page_size
+        self.verbose = 0
+        self.cur_time = get_now()
+        self.ct_read = 0
+        self.ct_skipped = 0
+        self.ct_no_uuid = 0
+        self.ct_stored = 0
+
+    def get_c_l_args(self, argv=None):
+        """Get command line arguments"""
+        parser = argparse.ArgumentParser()
+        parser.add_argument('-v', '--verbose', help='send extra debug info to stdout',
+                            action='count', default=0)
+        parser.add_argument('-i', '--infile', type=str, required=True,
+                            help='read Crunchbase ODM snapshot from file INFILE')
+        parser.add_argument('-f', '--format', type=str, choices=['csv', 'json'],
+                            default=None,
+                            help='format of INFILE (default: from its extension)')
+        parser.add_argument('-t', '--truncate', action='store_true',
+                            help='empty cb_odm_organizations before loading')
+        args = parser.parse_args(argv)
+        self.verbose = args.verbose
+        self.infile = args.infile
+        self.file_format = args.format
+        self.truncate = args.truncate
+
+    def get_env_vars(self):
+        """Check that environment variables have been set"""
+        try:
+            self.db_host = os.environ['DBHOST']
+            self.db_name = os.environ['DBNAME']
+            self.db_user = os.environ['DBUSER']
+            self.db_password = os.environ['DBPASSWD']
+        except KeyError:
+            print('Please set environment variables DBHOST, DBNAME, DBUSER, '
+                  'DBPASSWD', file=sys.stderr)
+            sys.exit(1)
+
+    def read_snapshot(self):
+        """
+        Yield each organization in the snapshot file as a dict shaped like
+            the 'properties' of an odm-organizations API response item
+        :return: the dict, or StopIteration
+        Called by: store_snapshot()
+        """
+        file_format = self.file_format
+        if not file_format:
+            file_format = 'json' if self.infile.lower().endswith('.json') \
+                else 'csv'
+        if file_format == 'csv':
+            yield from self.read_csv_snapshot()
+        else:
+            yield from self.read_json_snapshot()
+
+    def read_csv_snapshot(self):
+        """
+        Yield organizations from an ODM 'organizations.csv' export
+        Called by: read_snapshot()
+        """
+        with open(self.infile, newline='') as infile:
+            for row in csv.DictReader(infile):
+                self.ct_read += 1
+                yield {prop: (row.get(column) or None)
+                       for column, prop in self.csv_to_properties.items()}
+
+    def read_json_snapshot(self):
+        """
+        Yield organizations from a JSON export: either a list of API
+            response items (each holding 'properties'), or a list of flat
+            dicts keyed like the CSV export
+        Called by: read_snapshot()
+        """
+        with open(self.infile) as infile:
+            items = json.load(infile)
+        if isinstance(items, dict):  # a saved API response
+            items = items['data']['items']
+        for item in items:
+            self.ct_read += 1
+            if 'properties' in item:
+                properties = dict(item['properties'])
+                properties.setdefault('uuid', item.get('uuid'))
+                yield properties
+            else:
+                yield {prop: item.get(column)
+                       for column, prop in self.csv_to_properties.items()}
+
+    @staticmethod
+    def normalize_domain(domain):
+        """
+        Reduce a Crunchbase domain to the form extracted from an email
+            address: lower case, no scheme, no leading 'www.', no path
+        :param domain: as stored by Crunchbase, e.g. 'www.example.com/'
+        :return: e.g. 'example.com', or None
+        Called by: setup_data_item_snapshot()
+        """
+        if not domain:
+            return None
+        domain = domain.strip().lower()
+        for prefix in ('https://', 'http://', 'www.'):
+            if domain.startswith(prefix):
+                domain = domain[len(prefix):]
+        domain = domain.split('/')[0].rstrip('.')
+        return domain or None
+
+    @classmethod
+    def to_epoch_int(cls, value):
+        """
+        created_at and updated_at are seconds since the epoch in
+            pn_organizations; the ODM export holds them as UTC date-time
+            strings, e.g. '2014-05-21 04:14:13', and the API as numbers
+        :return: seconds since the epoch, or None
+        Called by: setup_data_item_snapshot()
+        """
+        if value is None or value == '':
+            return None
+        try:
+            return int(float(value))
+        except (TypeError, ValueError):
+            pass
+        for timestamp_format in cls.timestamp_formats:
+            try:
+                return calendar.timegm(time.strptime(value.strip(),
+                                                     timestamp_format))
+            except ValueError:
+                continue
+        return None
+
+    @staticmethod
+    def get_stock_exchange_and_symbol(properties):
+        """
+        The API gives stock_exchange and stock_symbol; the ODM export gives
+            combined_stock_symbols instead, e.g. 'nasdaq:AAPL', or several
+            of those separated by commas, of which the first is used
+        :param properties: one organization, as yielded by read_snapshot()
+        :return: (stock exchange, stock symbol), either of which may be None
+        Called by: setup_data_item_snapshot()
+        """
+        if properties.get('stock_exchange') or properties.get('stock_symbol'):
+            return (properties.get('stock_exchange'),
+                    properties.get('stock_symbol'))
+        combined = (properties.get('combined_stock_symbols') or '').\
+            split(',')[0].strip()
+        if not combined:
+            return None, None
+        if ':' not in combined:
+            return None, combined
+        exchange, symbol = combined.split(':', 1)
+        return exchange.strip() or None, symbol.strip() or None
+
+    def setup_data_item_snapshot(self, properties):
+        """
+        Set up data item for insertion to 'cb_odm_organizations'
+        :param properties: one organization, as yielded by read_snapshot()
+        :return: the data item, or None if the organization has no name
+        Called by: store_snapshot()
+        """
+        if not properties.get('name'):
+            return None
+        domain = properties.get('domain')
+        stock_exchange, stock_symbol = \
+            self.get_stock_exchange_and_symbol(properties)
+        return (properties.get('uuid') or None,
+                properties['name'],
+                properties.get('primary_role'),
+                properties.get('short_description'),
+                domain.rstrip('/') if domain else None,
+                self.normalize_domain(domain),
+                properties.get('homepage_url'),
+                properties.get('facebook_url'),
+                properties.get('twitter_url'),
+                properties.get('linkedin_url'),
+                properties.get('api_url'),
+                properties.get('city_name'),
+                properties.get('region_name'),
+                properties.get('country_code'),
+                stock_exchange,
+                stock_symbol,
+                self.to_epoch_int(properties.get('created_at')),
+                self.to_epoch_int(properties.get('updated_at')),
+                self.cur_time)
+
+    def store_snapshot(self):
+        """
+        Read the snapshot file and upsert it to 'cb_odm_organizations',
+            self.page_size rows per round trip
+        :return: None
+        Called by: run_load_cb_snapshot()
+        """
+        pg_conn_string = ("host = '{}' dbname = '{}' user = '{}' " +
+                          "password = '{}'").format(self.db_host, self.db_name,
+                                                    self.db_user,
+                                                    self.db_password)
+        pg_conn = psycopg2.connect(pg_conn_string)
+        cursor = pg_conn.cursor()
+        if self.truncate:
+            cursor.execute('TRUNCATE cb_odm_organizations;')
+
+        upsert = ('INSERT INTO cb_odm_organizations (cb_uuid, name, ' +
+                  'primary_role, short_description, domain, domain_key, ' +
+                  'homepage_url, facebook_url, twitter_url, linkedin_url, ' +
+                  'api_url, city, region, country, stock_exchange, ' +
+                  'stock_symbol, created_at, updated_at, ' +
+                  'pgres_last_updated) VALUES %s ' +
+                  'ON CONFLICT (cb_uuid) DO UPDATE SET (name, ' +
+                  'primary_role, short_description, domain, domain_key, ' +
+                  'homepage_url, facebook_url, twitter_url, linkedin_url, ' +
+                  'api_url, city, region, country, stock_exchange, ' +
+                  'stock_symbol, created_at, updated_at, ' +
+                  'pgres_last_updated) = (EXCLUDED.name, ' +
+                  'EXCLUDED.primary_role, EXCLUDED.short_description, ' +
+                  'EXCLUDED.domain, EXCLUDED.domain_key, ' +
+                  'EXCLUDED.homepage_url, EXCLUDED.facebook_url, ' +
+                  'EXCLUDED.twitter_url, EXCLUDED.linkedin_url, ' +
+                  'EXCLUDED.api_url, EXCLUDED.city, EXCLUDED.region, ' +
+                  'EXCLUDED.country, EXCLUDED.stock_exchange, ' +
+                  'EXCLUDED.stock_symbol, EXCLUDED.created_at, ' +
+                  'EXCLUDED.updated_at, EXCLUDED.pgres_last_updated);')
+
+        page = []
+        for properties in self.read_snapshot():
+            data_item = self.setup_data_item_snapshot(properties)
+            if not data_item:
+                self.ct_skipped += 1
+                continue
+            if not data_item[0]:
+                # with no cb_uuid it would never conflict, and so be added
+                #     again on every load
+                self.ct_no_uuid += 1
+                continue
+            page.append(data_item)
+            if len(page) == self.page_size:
+                self.store_page(cursor, upsert, page)
+                page = []
+        if page:
+            self.store_page(cursor, upsert, page)
+        pg_conn.commit()
+        cursor.execute('ANALYZE cb_odm_organizations;')
+        pg_conn.commit()
+        cursor.close()
+        pg_conn.close()
+
+    def store_page(self, cursor, upsert, page):
+        """
+        Upsert one page of data items. ON CONFLICT DO UPDATE cannot update
+            a row twice in one statement, so of the items in the page with
+            the same cb_uuid, only the last is kept.
+        Called by: store_snapshot()
+        """
+        page = list({data_item[0]: data_item for data_item in page}.values())
+        psycopg2.extras.execute_values(cursor, upsert, page,
+                                       page_size=self.page_size)
+        self.ct_stored += len(page)
+        if self.verbose:
+            print('{} organizations stored'.format(self.ct_stored))
+
+    def print_report(self):
+        """
+        Output stats at end of program run
+        :return: None
+        Called by: run_load_cb_snapshot()
+        """
+        print(('{} organizations read from {}\n' +
+               '\t{} skipped (no name)\n' +
+               '\t{} skipped (no uuid)\n' +
+               '\t{} stored or updated in cb_odm_organizations').
+              format(self.ct_read, self.infile, self.ct_skipped,
+                     self.ct_no_uuid, self.ct_stored),
+              file=sys.stderr)
+
+
+def run_load_cb_snapshot():
+    """Create LoadCbSnapshot instance and call its methods"""
+    lcs = LoadCbSnapshot()
+    lcs.get_c_l_args()
+    lcs.get_env_vars()
+    lcs.store_snapshot()
+    lcs.print_report()
+
+
+if __name__ == '__main__':
+    run_load_cb_snapshot()
@@ -11,6 +11,8 @@ import argparse
 import json
 import requests
 import logging
+import queue
+import select
 import time
 import psycopg2
 import re
@@ -20,6 +22,21 @@ try:
 except ModuleNotFoundError:
     from time_string_conversion import get_now
 
+try:
+    from crunchbase_orgs.src.batch_domains import classify_emails
+except ModuleNotFoundError:
+    from batch_domains import classify_emails
+
+try:
+    from crunchbase_orgs.src.token_index import TokenIndex
+except ModuleNotFoundError:
+    from token_index import TokenIndex
+
+try:
+    from crunchbase_orgs.src.cb_stats import CbRequestStats
+except ModuleNotFoundError:
+    from cb_stats import CbRequestStats
+
 try:
     from crunchbase_orgs.src.constants import BASE_URL, DEFAULT_DATE, \
         API_ENDPOINT, ISP_FILE, TLD_FILE, SLEEP_SECS
@@ -27,6 +44,21 @@ except ModuleNotFoundError:
     from constants import BASE_URL, DEFAULT_DATE, API_ENDPOINT, ISP_FILE, \
         TLD_FILE, SLEEP_SECS
 
+try:
+    from common.src.pg_stats import pg_stats, StatsConnection
+except ModuleNotFoundError:
+    from common.pg_stats import pg_stats, StatsConnection
+
+try:
+    from common.src.metrics import Metrics
+except ModuleNotFoundError:
+    from common.metrics import Metrics
+
+try:
+    from common.src.profiling import Profiler
+except ModuleNotFoundError:
+    from common.profiling import Profiler
+
 
 class LoadOrganizations:
     """
@@ -41,7 +73,48 @@ class LoadOrganizations:
     or
     python3 crunchbase_orgs/src/load_organizations.py -s -i \
         <input_file>
+    or, for only the licenses with new or changed contact details:
+    python3 mktplc_export_lics/src/load_licenses.py -e <feed_file> && \
+        python3 crunchbase_orgs/src/load_organizations.py -i <feed_file>
+    or, to enrich companies as the pn_* tables change:
+    python3 crunchbase_orgs/src/load_organizations.py -l
     """
+    # kept by reset_run_state(), for a resident caller such as scheduler.py
+    warm_attrs = ('resident', 'sess', 'lookup_conn', 'has_snapshot_table',
+                  'pg_pool', 'isp_domains', 'tlds', 'short_domains',
+                  'cb_stats')
+    # zeroed by reset_batch_counts() after each listen batch
+    batch_counts = ('domain_misses', 'single_domain_hits',
+                    'multiple_domain_hits', 'name_misses', 'single_name_hits',
+                    'multiple_name_hits', 'ct_isps', 'ct_name_queries',
+                    'time_used_cb', 'items_examined', 'items_skipped',
+                    'items_not_skipped', 'repeat_domains', 'ct_stored',
+                    'ct_local_name_hits', 'ct_snapshot_hits',
+                    'ct_snapshot_misses', 'ct_cb_requests', 'ct_cb_retries',
+                    'ct_cb_failures', 'ct_companies_notified')
+    # hot queries, also EXPLAINed by bench/check_query_plans.py
+    # probes the indexes once per company, rather than joining every
+    #     license of every company named, as a join on ANY(%s) planned
+    licensed_companies_query = ('SELECT c.company '
+                                'FROM unnest(%s::varchar[]) AS c (company) '
+                                'WHERE EXISTS (SELECT 1 '
+                                'FROM pn_license_contact_details lcd '
+                                'JOIN pn_licenses l '
+                                'ON l.license_contact_details_id = lcd.id '
+                                'WHERE lcd.company = c.company);')
+    org_by_domain_query = 'SELECT * FROM pn_organizations WHERE domain = %s;'
+    org_id_query = 'SELECT id FROM pn_organizations WHERE name = %s'
+    lcd_ids_query = ('(SELECT id FROM pn_license_contact_details '
+                     'WHERE company = %s);')
+    link_licenses_query = ('UPDATE pn_licenses SET organizations_id = %s '
+                           'WHERE license_contact_details_id = %s;')
+    remove_org_query = ('DELETE FROM pn_organizations o WHERE o.name = %s AND '
+                        '(SELECT DISTINCT l.organizations_id '
+                        'FROM pn_organizations o2 '
+                        'LEFT JOIN pn_licenses l '
+                        'ON l.organizations_id = o2.id '
+                        'WHERE o2.name = %s) IS NULL')
+
     def __init__(self, api_key=None,
                  base_url=BASE_URL, api_endpoint=API_ENDPOINT,
                  db_password=None,
@@ -86,6 +159,42 @@ class LoadOrganizations:
         self.ct_stored = 0
         self.cur_time = get_now()
         self.sql_update_org = ''
+        self.use_snapshot = False
+        self.lookup_conn = None  # read-only conn for local lookups
+        self.resolve_names_locally = False
+        self.has_snapshot_table = False
+        self.name_similarity_threshold = 0.4
+        self.name_candidate_limit = 10
+        self.ct_local_name_hits = 0
+        self.use_token_index = False
+        self.cb_cache_files = []  # saved domain / name search output
+        self.token_index = None
+        self.index_candidates = {}  # company -> [(org key, score), ...]
+        self.batch_preprocess = False
+        self.short_domains = {}  # domain -> shorten(domain)
+        self.ct_snapshot_hits = 0
+        self.ct_snapshot_misses = 0
+        self.ct_cb_requests = 0
+        self.ct_cb_retries = 0
+        self.ct_cb_failures = 0
+        self.cb_stats = CbRequestStats()  # latency, statuses, quota ledger
+        self.cb_stats_json = None
+        self.max_retries = 4
+        self.backoff_secs = 2
+        self.resident = False  # if True, leave sess and lookup_conn open
+        self.pg_pool = None  # psycopg2 pool; if None, connect per response
+        # if set, input comes from here rather than data_source: chunks
+        # (lists) of (email, company) pairs, then None
+        self.license_queue = None
+        self.license_queue_done = False
+        self.listen = False
+        self.listen_quiet_secs = 5  # a batch ends after this long unnotified
+        self.listen_max_secs = 60  # or this long after its first notification
+        self.listen_max_batch = 500  # or once it names this many companies
+        self.ct_companies_notified = 0
+        self.ct_listen_batches = 0
+        self.metrics = Metrics('load_organizations')
+        self.profiler = Profiler('load_organizations')
 
     def get_c_l_args(self, argv=None):
         """Get command line arguments"""
@@ -99,19 +208,98 @@ class LoadOrganizations:
                             help='send name search output to stdout',
                             action='store_true')
         parser.add_argument('-i', '--infile', type=str,
-                            help='read input from file INFILE')
+                            help='read input from file INFILE, e.g. as '
+                                 'written by load_licenses.py -o or '
+                                 '-e (--enrich_feed)')
         parser.add_argument('-o', '--domain_search_outfile', type=str,
                             help='send domain search output to file DOMAIN_SEARCH_OUTFILE')
         parser.add_argument('-p', '--name_search_outfile', type=str,
                             help='send name search output to file NAME_SEARCH_OUTFILE')
+        parser.add_argument('-b', '--use_snapshot', action='store_true',
+                            help='match against the local Crunchbase snapshot '
+                                 'in cb_odm_organizations first; query '
+                                 'Crunchbase only on a miss')
+        parser.add_argument('-r', '--resolve_names_locally', action='store_true',
+                            help='before a Crunchbase name query, look for a '
+                                 'similar name in pn_organizations and '
+                                 'cb_odm_organizations')
+        parser.add_argument('-x', '--token_index', action='store_true',
+                            help='before a Crunchbase name query, look for '
+                                 'candidates in a token index built from '
+                                 'pn_organizations and CB_CACHE files')
+        parser.add_argument('-c', '--cb_cache', type=str, nargs='*', default=[],
+                            help='domain or name search output from earlier '
+                                 'runs, to add to the token index')
+        parser.add_argument('-u', '--base_url', type=str, default=None,
+                            help='send Crunchbase queries to BASE_URL, e.g. a '
+                                 'mock server (default: {})'.format(BASE_URL))
+        parser.add_argument('-a', '--batch_preprocess', action='store_true',
+                            help='extract and classify the domains of all '
+                                 'input emails in one vectorized pass')
+        parser.add_argument('-l', '--listen', action='store_true',
+                            help='run until interrupted, enriching the '
+                                 'companies named by pn_company_changed '
+                                 'notifications, a batch at a time')
+        parser.add_argument('--listen_quiet_secs', type=float,
+                            default=self.listen_quiet_secs,
+                            help='end a batch after this many seconds with '
+                                 'no notification')
+        parser.add_argument('--listen_max_secs', type=float,
+                            default=self.listen_max_secs,
+                            help='end a batch this many seconds after its '
+                                 'first notification')
+        parser.add_argument('--listen_max_batch', type=int,
+                            default=self.listen_max_batch,
+                            help='end a batch once it names this many '
+                                 'companies')
+        parser.add_argument('--pg_stats', type=int, default=None,
+                            metavar='TOP_N',
+                            help='at exit, print the TOP_N SQL statements by '
+                                 'total time, with call counts and rows')
+        parser.add_argument('--pg_stats_json', type=str, default=None,
+                            help='at exit, write the stats of every SQL '
+                                 'statement to PG_STATS_JSON')
+        parser.add_argument('--cb_quota', type=int, default=None,
+                            help='send Crunchbase at most CB_QUOTA requests '
+                                 '(retries included) in any CB_QUOTA_WINDOW '
+                                 'secs, waiting as needed')
+        parser.add_argument('--cb_quota_window', type=float, default=60,
+                            help='length in secs of the quota window')
+        parser.add_argument('--cb_stats_json', type=str, default=None,
+                            help='with the report, write Crunchbase latency '
+                                 'histograms, status counts and quota use to '
+                                 'CB_STATS_JSON')
+        parser.add_argument('--metrics_file', type=str, default=None,
+                            help='write phase timings, record counts and '
+                                 'cache hit rates to METRICS_FILE (a .prom '
+                                 'file in the node_exporter textfile '
+                                 'directory), during and after the run')
+        Profiler.add_arguments(parser)
         args = parser.parse_args(argv)
+        pg_stats.report_at_exit(args.pg_stats, args.pg_stats_json)
+        self.metrics.textfile = args.metrics_file
+        self.cb_stats.set_quota(args.cb_quota, args.cb_quota_window)
+        self.cb_stats_json = args.cb_stats_json
+        self.profiler.set_from_args(args)
         self.verbose = args.verbose
         self.data_source = open(args.infile) if args.infile else \
             sys.stdin
+        self.listen = args.listen
+        self.listen_quiet_secs = args.listen_quiet_secs
+        self.listen_max_secs = args.listen_max_secs
+        self.listen_max_batch = args.listen_max_batch
         self.domain_search_outfile = args.domain_search_outfile
         self.name_search_outfile = args.name_search_outfile
         self.domain_search_to_stdout = args.domain_search_to_stdout
         self.name_search_to_stdout = args.name_search_to_stdout
+        self.use_snapshot = args.use_snapshot
+        self.resolve_names_locally = args.resolve_names_locally
+        self.use_token_index = args.token_index
+        self.cb_cache_files = args.cb_cache
+        self.batch_preprocess = args.batch_preprocess
+        if args.base_url:
+            self.base_url = args.base_url
+            self.url = self.base_url + self.api_endpoint
 
     def get_env_vars(self):
         """Check that environment variables have been set"""
@@ -142,7 +330,15 @@ class LoadOrganizations:
 
     def get_each_license(self):
         """Get each license in turn from PostgreSQL"""
-        self.connect_to_cb_or_die()
+        if self.sess is None:
+            self.connect_to_cb_or_die()
+        if (self.use_snapshot or self.resolve_names_locally or
+                self.use_token_index) and self.lookup_conn is None:
+            self.connect_to_lookup_db()
+        if self.use_token_index and self.token_index is None:
+            start = time.perf_counter()
+            self.build_token_index()
+            self.metrics.observe('token_index', time.perf_counter() - start)
         start_item = 0
         stop_item = float('inf')
         self.print_opening_message()
@@ -152,21 +348,29 @@ class LoadOrganizations:
             if self.items_examined and not self.items_examined % 25:
                 self.print_progress()
             # introduce delays to keep from exceeding CB request limit
-            if self.items_examined and not self.items_not_skipped % 25 \
+            # (with a snapshot, throttle_cb_requests() does this instead)
+            if not self.use_snapshot and self.items_examined and \
+                    not self.items_not_skipped % 25 \
                     and self.items_examined > start_item:
                 print('SLEEPING {}'.format(SLEEP_SECS))
                 time.sleep(SLEEP_SECS)
             try:
-                email, company = next(email_company_iter)
+                email, company, *domain_info = next(email_company_iter)
                 self.items_examined += 1
                 if self.items_examined < start_item:
                     self.items_skipped += 1
                     continue
                 self.items_not_skipped += 1
-                self.handle_company_and_email(company, email, payload)
+                self.handle_company_and_email(company, email, payload,
+                                              *domain_info)
+                if self.metrics.is_due():
+                    self.export_metrics()
             except StopIteration:
                 break
-        self.sess.close()
+        if not self.resident:
+            self.sess.close()
+            if self.lookup_conn:
+                self.lookup_conn.close()
 
         self.temp_file_to_json()
 
@@ -204,6 +408,165 @@ class LoadOrganizations:
                   file=sys.stderr)
             sys.exit(0)
 
+    def connect_to_lookup_db(self):
+        """
+        Connect to the db holding 'pn_organizations' and (optionally) the
+            'cb_odm_organizations' table loaded by load_cb_snapshot.py
+        :return: None
+        Called by: get_each_license()
+        """
+        pg_conn_string = ("host = '{}' dbname = '{}' user = '{}' " +
+                          "password = '{}'").format(self.db_host, self.db_name,
+                                                    self.db_user,
+                                                    self.db_password)
+        self.lookup_conn = psycopg2.connect(
+            pg_conn_string, connection_factory=StatsConnection)
+        self.lookup_conn.set_session(readonly=True, autocommit=True)
+        cursor = self.lookup_conn.cursor()
+        cursor.execute("SELECT to_regclass('cb_odm_organizations');")
+        self.has_snapshot_table = cursor.fetchone()[0] is not None
+        if self.resolve_names_locally:
+            cursor.execute('SET pg_trgm.similarity_threshold = %s;',
+                           (self.name_similarity_threshold,))
+        cursor.close()
+
+    def listen_for_changes(self):
+        """
+        Listener mode: LISTEN for the notifications sent by the triggers in
+            db/code/create_notify_triggers.sql, and enrich the companies
+            they name, a batch at a time, until interrupted
+        Each batch is profiled as phase 'listen', and reported, and its
+            metrics written, as a run of its own
+        Changes made while no listener runs are not seen; run once without
+            --listen to catch up
+        :return: None
+        Called by: run_load_organizations()
+        """
+        self.resident = True  # keep sess and lookup_conn between batches
+        pg_conn_string = ("host = '{}' dbname = '{}' user = '{}' " +
+                          "password = '{}'").format(self.db_host, self.db_name,
+                                                    self.db_user,
+                                                    self.db_password)
+        listen_conn = psycopg2.connect(pg_conn_string,
+                                       connection_factory=StatsConnection)
+        listen_conn.set_session(readonly=True, autocommit=True)
+        cursor = listen_conn.cursor()
+        cursor.execute('LISTEN pn_company_changed;')
+        cursor.close()
+        print('Listening for pn_company_changed...', file=sys.stderr)
+        ct_companies_notified = 0  # since listening began
+        try:
+            while True:
+                companies = self.gather_notifications(listen_conn)
+                self.ct_companies_notified += len(companies)
+                ct_companies_notified += len(companies)
+                email_company_pairs = self.get_licensed_companies(
+                    listen_conn, companies)
+                if not email_company_pairs:
+                    continue
+                self.ct_listen_batches += 1
+                print('Batch {}: enriching {} of {} companies notified'.
+                      format(self.ct_listen_batches, len(email_company_pairs),
+                             len(companies)), file=sys.stderr)
+                # a changed company may keep its domain
+                self.domains_queried = set()
+                self.license_queue = queue.Queue()
+                self.license_queue.put(email_company_pairs)
+                self.license_queue.put(None)
+                with self.profiler.phase('listen'):
+                    self.get_each_license()
+                self.print_report()
+                self.reset_batch_counts()
+        except KeyboardInterrupt:
+            print('Stopping after {} batches, {} companies notified'.
+                  format(self.ct_listen_batches, ct_companies_notified),
+                  file=sys.stderr)
+        finally:
+            listen_conn.close()
+            if self.sess:
+                self.sess.close()
+            if self.lookup_conn:
+                self.lookup_conn.close()
+
+    def gather_notifications(self, listen_conn):
+        """
+        Wait for a notification, then gather more until listen_quiet_secs
+            pass without one, listen_max_secs pass since the first, or
+            listen_max_batch companies are named. Notifications past
+            listen_max_batch stay in listen_conn.notifies for the next call.
+        :param listen_conn: connection that has run LISTEN
+        :return: dict of company -> tech contact email, as last notified
+        Called by: listen_for_changes()
+        """
+        companies = {}
+        first_notified = None
+        while len(companies) < self.listen_max_batch:
+            if first_notified is None:
+                timeout = 60
+            else:
+                timeout = min(self.listen_quiet_secs,
+                              first_notified + self.listen_max_secs -
+                              time.time())
+                if timeout <= 0:
+                    break
+            # notifications left over from the last full batch are already
+            #     read from the socket, so select() would not see them
+            if not listen_conn.notifies:
+                if select.select([listen_conn], [], [],
+                                 timeout) == ([], [], []):
+                    if first_notified is not None:
+                        break
+                    self.print_indented('Waiting for notifications...',
+                                        sys.stderr)
+                    continue
+                listen_conn.poll()
+            while listen_conn.notifies and \
+                    len(companies) < self.listen_max_batch:
+                notify = listen_conn.notifies.pop(0)
+                try:
+                    item = json.loads(notify.payload)
+                except ValueError:
+                    logging.warning('Bad notification \'%s\'' %
+                                    (notify.payload,))
+                    continue
+                if item.get('company') and item.get('email'):
+                    companies[item['company']] = item['email']
+                    if first_notified is None:
+                        first_notified = time.time()
+        return companies
+
+    @staticmethod
+    def get_licensed_companies(listen_conn, companies):
+        """
+        Keep the companies that have licenses to link to an organization;
+            the pn_licenses trigger names the others again once they do
+        :param listen_conn: connection that has run LISTEN
+        :param companies: dict of company -> tech contact email
+        :return: list of (email, company) tuples
+        Called by: listen_for_changes()
+        """
+        if not companies:
+            return []
+        cursor = listen_conn.cursor()
+        cursor.execute(LoadOrganizations.licensed_companies_query,
+                       (list(companies),))
+        licensed = {row[0] for row in cursor.fetchall()}
+        cursor.close()
+        return [(email, company) for company, email in companies.items()
+                if company in licensed]
+
+    def throttle_cb_requests(self):
+        """
+        In snapshot mode, most items never reach Crunchbase, so delay
+            after every 25th actual request rather than every 25th item
+        :return: None
+        Called by: get_cb_response()
+        """
+        self.ct_cb_requests += 1
+        if self.use_snapshot and not self.ct_cb_requests % 25:
+            print('SLEEPING {}'.format(SLEEP_SECS))
+            time.sleep(SLEEP_SECS)
+
     @staticmethod
     def print_opening_message():
         print('Querying Crunchbase odm-organizations endpoint...', file=sys.stderr)
@@ -213,16 +576,67 @@ class LoadOrganizations:
         Yield a tuple holding a tech contact email and the
             corresponding company name, from Marketplace API
             'Export licenses' endpoint
+        With --batch_preprocess, the tuple also holds the email's domain
+            and whether that domain belongs to an ISP
+        With a license_queue, the licenses come a chunk at a time, and the
+            token index and --batch_preprocess work on each chunk in turn
         :return: The above tuple, or
                  StopIteration
         Called by: get_each_license()`
         """
-        self.get_isp_domain_dict()
-        licenses = self.get_licenses_as_dict()
-        for item in licenses:
-            email = item['contactDetails']['technicalContact']['email']
-            company = item['contactDetails']['company']
-            yield email, company
+        if not self.isp_domains:
+            self.get_isp_domain_dict()
+        if self.license_queue is not None:
+            chunks = self.get_queued_email_and_company()
+        else:
+            chunks = [[(item['contactDetails']['technicalContact']['email'],
+                        item['contactDetails']['company'])
+                       for item in self.get_licenses_as_dict()]]
+        for email_company_pairs in chunks:
+            if self.token_index:
+                self.index_candidates = self.token_index.batch_candidates(
+                    company for _, company in email_company_pairs)
+            if self.batch_preprocess:
+                yield from self.get_preprocessed_email_and_company(
+                    email_company_pairs)
+            else:
+                yield from email_company_pairs
+
+    def get_queued_email_and_company(self):
+        """
+        :return: each chunk of (email, company) pairs put on
+                     self.license_queue, until None is put
+        Called by: get_email_and_company()
+        """
+        while True:
+            try:
+                email_company_pairs = self.license_queue.get(timeout=60)
+            except queue.Empty:
+                self.print_indented('Waiting for licenses...', sys.stderr)
+                continue
+            if email_company_pairs is None:
+                self.license_queue_done = True
+                return
+            yield email_company_pairs
+
+    def get_preprocessed_email_and_company(self, email_company_pairs):
+        """
+        Extract domains, flag bad emails, classify ISP domains and shorten
+            domains for all licenses at once, then yield them one by one
+        :param email_company_pairs: list of (email, company) tuples
+        :return: (email, company, domain, is_isp) tuples, or
+                 StopIteration
+        Called by: get_email_and_company()
+        """
+        emails = [email for email, _ in email_company_pairs]
+        domain_frame = classify_emails(emails, self.isp_domains, self.shorten)
+        has_short = domain_frame['short_domain'].notna()
+        self.short_domains.update(zip(domain_frame['domain'][has_short],
+                                      domain_frame['short_domain'][has_short]))
+        for (email, company), domain, is_isp in zip(email_company_pairs,
+                                                    domain_frame['domain'],
+                                                    domain_frame['is_isp']):
+            yield email, company, domain, is_isp
 
     def get_isp_domain_dict(self):
         """
@@ -276,26 +690,34 @@ class LoadOrganizations:
         :return:
         Called by: get_each_license()
         """
-        self.print_indented('{} items examined in {:.1f} secs  ({} items skipped)'.
+        self.print_indented('{} items examined in {:.1f} secs  ({} items skipped); '
+                            '{} Crunchbase requests in the quota window'.
                             format(self.items_examined,
                                    self.time_used_cb,
-                                   self.items_skipped),
+                                   self.items_skipped,
+                                   self.cb_stats.get_used()),
                             sys.stderr)
 
-    def handle_company_and_email(self, company, email, payload):
+    def handle_company_and_email(self, company, email, payload, domain=None,
+                                 is_isp=None):
         """
         Handle values retrieved by 'get_email_and_company()' from
             Marketplace 'Export licences' endpoint
         :param email: the tech contact email for a license
         :param company: associated with that email
+        :param domain: of email, if already extracted by
+                       get_preprocessed_email_and_company()
+        :param is_isp: whether domain belongs to an ISP, if already known
         :return: None
         Called by: get_each_license()
         """
-        domain = self.get_domain_from(email)
+        if is_isp is None:
+            domain = self.get_domain_from(email)
+            is_isp = domain in self.isp_domains
 
         if not domain:
             self.handle_bad_email(email)
-        elif domain in self.isp_domains:
+        elif is_isp:
             self.handle_isp_domain(company, email)
         else:
             payload['name'] = None
@@ -354,8 +776,7 @@ class LoadOrganizations:
         payload['domain_name'] = None
         payload['name'] = company
 
-        response = self.sess.get(self.url, params=payload)
-        name_query_response_dict = response.json()
+        name_query_response_dict = self.get_cb_response(payload, 'name')
         if self.name_search_outfile or self.name_search_to_stdout:
             self.output_found_name_query_response(name_query_response_dict)  # output response to temp file
         return name_query_response_dict
@@ -383,6 +804,11 @@ class LoadOrganizations:
             return False
         else:
             self.domains_queried.add(domain)
+        if self.use_snapshot:
+            stored = self.handle_snapshot_lookup(company, domain)
+            if stored is not None:
+                self.print_indented("Leaving 'handle_non_isp_domain()'")
+                return stored
         if self.verbose:
             print("In 'handle_non_isp_domain()' querying by domain")
         start = time.time()
@@ -390,6 +816,7 @@ class LoadOrganizations:
         domain_response_dict = self.query_cb_orgs_by_domain(payload)
         time_used = time.time() - start
         self.time_used_cb += time_used
+        self.metrics.observe('crunchbase_domain_query', time_used)
         domain_response_len = self.get_response_len(domain_response_dict)
         self.tally_domain_hits(domain_response_len)
         if domain_response_len:  # query yields hit(s)
@@ -402,12 +829,23 @@ class LoadOrganizations:
             if self.verbose:
                 self.print_indented('Domain query for {} yielded no hits'.
                                     format(domain))
+            if self.resolve_names_locally:
+                stored = self.resolve_name_locally(company, domain)
+                if stored is not None:
+                    self.print_indented("Leaving 'handle_non_isp_domain()'")
+                    return stored
+            if self.token_index:
+                stored = self.resolve_name_from_index(company, domain)
+                if stored is not None:
+                    self.print_indented("Leaving 'handle_non_isp_domain()'")
+                    return stored
             start = time.time()
             name_response_dict = self.query_cb_orgs_by_name(company)
             if self.verbose:
                 print("In 'handle_non_isp_domain()' querying by name")
             time_used = time.time() - start
             self.time_used_cb += time_used
+            self.metrics.observe('crunchbase_name_query', time_used)
             self.ct_name_queries += 1
             name_response_len = self.get_response_len(name_response_dict)
             self.tally_name_hits(name_response_len)
@@ -430,6 +868,293 @@ class LoadOrganizations:
         self.print_indented("Leaving 'handle_non_isp_domain()'")
         return stored
 
+    def handle_snapshot_lookup(self, company, domain):
+        """
+        Look the license up in the local Crunchbase snapshot, by domain
+            and then by company name
+        :param company: associated with the tech contact email address
+        :param domain: extracted from tech contact email address
+        :return: None if the snapshot has no hits, or none that
+                     retrieve_pick() picks, so Crunchbase should be
+                     queried; else bool 'stored', as for
+                     handle_non_isp_domain()
+        Called by: handle_non_isp_domain()
+        """
+        response_dict = self.query_snapshot_by_domain(domain)
+        if not self.get_response_len(response_dict):
+            response_dict = self.query_snapshot_by_name(company)
+        if not self.get_response_len(response_dict):
+            self.ct_snapshot_misses += 1
+            self.print_indented('Snapshot has no hits for {} / {}'.
+                                format(domain, company))
+            return None
+        pick_ix, pick_company = self.retrieve_pick(company, domain,
+                                                   response_dict)
+        if not pick_company:
+            self.ct_snapshot_misses += 1
+            self.print_indented('Snapshot has no match among its hits for '
+                                '{} / {}'.format(domain, company))
+            return None
+        self.ct_snapshot_hits += 1
+        return self.store_one_response(response_dict['data']['items'][pick_ix],
+                                       company)
+
+    def query_snapshot_by_domain(self, domain):
+        """
+        Get organizations from 'cb_odm_organizations' for the given domain
+        :param domain: extracted from tech contact email address
+        :return: the organizations, shaped like a Crunchbase response
+        Called by: handle_snapshot_lookup()
+        """
+        query = self.snapshot_query_head() + 'WHERE domain_key = %s;'
+        return self.query_snapshot(query, (domain.lower().rstrip('.'),))
+
+    def query_snapshot_by_name(self, company):
+        """
+        Get organizations from 'cb_odm_organizations' for the given name
+        :param company: associated with the tech contact email address
+        :return: the organizations, shaped like a Crunchbase response
+        Called by: handle_snapshot_lookup()
+        """
+        query = self.snapshot_query_head() + 'WHERE lower(name) = lower(%s);'
+        return self.query_snapshot(query, (company.strip(),))
+
+    @staticmethod
+    def snapshot_query_head(extra_columns=' '):
+        """
+        The columns of 'cb_odm_organizations', in the order expected by
+            query_snapshot()
+        :param extra_columns: SQL for more columns, after those
+        Called by: query_snapshot_by_domain(), query_snapshot_by_name(),
+                   query_snapshot_by_similar_name()
+        """
+        return ('SELECT name, primary_role, short_description, domain, ' +
+                'homepage_url, facebook_url, twitter_url, linkedin_url, ' +
+                'api_url, city, region, country, stock_exchange, ' +
+                'stock_symbol, created_at, updated_at' + extra_columns +
+                'FROM cb_odm_organizations ')
+
+    def query_snapshot(self, query, data, with_similarity=False):
+        """
+        Run a snapshot query; wrap the rows as odm-organizations items so
+            that retrieve_pick() and store_one_response() can use them
+        :param data: tuple of query parameters
+        :param with_similarity: if True, each row ends with a similarity
+                                    score, to go in the item's 'similarity'
+        :return: {'data': {'items': [{'properties': {...}}, ...]}}
+        Called by: query_snapshot_by_domain(), query_snapshot_by_name(),
+                   query_snapshot_by_similar_name()
+        """
+        property_names = ('name', 'primary_role', 'short_description',
+                          'domain', 'homepage_url', 'facebook_url',
+                          'twitter_url', 'linkedin_url', 'api_url',
+                          'city_name', 'region_name', 'country_code',
+                          'stock_exchange', 'stock_symbol', 'created_at',
+                          'updated_at')
+        cursor = self.lookup_conn.cursor()
+        cursor.execute(query, data)
+        items = []
+        for row in cursor.fetchall():
+            item = {'properties': dict(zip(property_names, row))}
+            if with_similarity:
+                item['similarity'] = row[-1]
+            items.append(item)
+        cursor.close()
+        return {'data': {'items': items}}
+
+    def resolve_name_locally(self, company, domain):
+        """
+        Look for organizations whose normalized name is similar to company,
+            first among those already in 'pn_organizations', then in the
+            Crunchbase snapshot. Uses the pg_trgm indexes created by
+            create_trgm_name_indexes.sql.
+        :param company: associated with the tech contact email address
+        :param domain: extracted from tech contact email address
+        :return: None if no local organization could be chosen, so
+                     Crunchbase should be queried; else bool 'stored', as for
+                     handle_non_isp_domain()
+        Called by: handle_non_isp_domain()
+        """
+        self.indent_level += 1
+        self.print_indented("Entering 'resolve_name_locally()'")
+        stored = None
+        org_id_list, response_dict = self.query_orgs_by_similar_name(company)
+        pick_ix, pick_company = self.rank_local_candidates(company, domain,
+                                                           response_dict)
+        if pick_company:
+            self.ct_local_name_hits += 1
+            stored = self.link_license_to_org(org_id_list[pick_ix], company)
+        elif self.has_snapshot_table:
+            response_dict = self.query_snapshot_by_similar_name(company)
+            pick_ix, pick_company = self.rank_local_candidates(company, domain,
+                                                               response_dict)
+            if pick_company:
+                self.ct_local_name_hits += 1
+                stored = self.store_one_response(
+                    response_dict['data']['items'][pick_ix], company)
+        self.print_indented("Leaving 'resolve_name_locally()'")
+        self.indent_level -= 1
+        return stored
+
+    def query_orgs_by_similar_name(self, company):
+        """
+        Get organizations from 'pn_organizations' with names similar to
+            company, most similar first
+        :param company: associated with the tech contact email address
+        :return: list of their ids, and the organizations shaped like a
+                     Crunchbase response (with a 'similarity' per item)
+        Called by: resolve_name_locally()
+        """
+        query = ('SELECT id, name, domain, ' +
+                 'similarity(pn_normalize_name(name), ' +
+                 'pn_normalize_name(%s)) AS sim FROM pn_organizations ' +
+                 'WHERE pn_normalize_name(name) %% pn_normalize_name(%s) ' +
+                 'ORDER BY sim DESC LIMIT %s;')
+        cursor = self.lookup_conn.cursor()
+        cursor.execute(query, (company, company, self.name_candidate_limit))
+        org_id_list = []
+        items = []
+        for org_id, name, domain, sim in cursor.fetchall():
+            org_id_list.append(org_id)
+            items.append({'properties': {'name': name, 'domain': domain},
+                          'similarity': sim})
+        cursor.close()
+        return org_id_list, {'data': {'items': items}}
+
+    def query_snapshot_by_similar_name(self, company):
+        """
+        Get organizations from 'cb_odm_organizations' with names similar to
+            company, most similar first
+        :param company: associated with the tech contact email address
+        :return: the organizations, shaped like a Crunchbase response
+        Called by: resolve_name_locally()
+        """
+        query = (self.snapshot_query_head(
+                     ', similarity(pn_normalize_name(name), ' +
+                     'pn_normalize_name(%s)) AS sim ') +
+                 'WHERE pn_normalize_name(name) %% pn_normalize_name(%s) ' +
+                 'ORDER BY sim DESC LIMIT %s;')
+        return self.query_snapshot(query, (company, company,
+                                           self.name_candidate_limit),
+                                   with_similarity=True)
+
+    def rank_local_candidates(self, company, domain, response_dict):
+        """
+        Apply the rules Crunchbase responses are held to (see pick_match()
+            and pick_by_matches()). If they leave more than one candidate,
+            take the most similar of those passing pick_by_matches(), as
+            long as it is strictly the most similar.
+        :param company: associated with the tech contact email address
+        :param domain: extracted from tech contact email address
+        :param response_dict: candidates, most similar first
+        :return: an index into response_dict['data']['items'], and the
+                     chosen name; or None, None
+        Called by: resolve_name_locally()
+        """
+        if not self.get_response_len(response_dict):
+            return None, None
+        pick_ix, pick_company = self.retrieve_pick(company, domain,
+                                                   response_dict)
+        if pick_company or len(company) < 2:
+            return pick_ix, pick_company
+        company_word_list = company.lower().split(' ')
+        ranked = []
+        for ix, item in enumerate(response_dict['data']['items']):
+            candidate_list, pick_ix_list = self.pick_by_matches(
+                ix, item, company_word_list)
+            if pick_ix_list:
+                ranked.append((item['similarity'], ix, candidate_list[0]))
+        ranked.sort(key=lambda x: x[0], reverse=True)
+        if len(ranked) == 1 or (ranked and ranked[0][0] > ranked[1][0]):
+            return ranked[0][1], ranked[0][2]
+        return None, None
+
+    def build_token_index(self):
+        """
+        Index the names of the organizations in 'pn_organizations' and in
+            the saved Crunchbase responses named by --cb_cache
+        :return: None
+        Called by: get_each_license()
+        """
+        start = time.time()
+        self.token_index = TokenIndex()
+        cursor = self.lookup_conn.cursor()
+        cursor.execute('SELECT id, name, domain FROM pn_organizations;')
+        for org_id, name, domain in cursor:
+            self.token_index.add(('pn', org_id),
+                                 {'properties': {'name': name,
+                                                 'domain': domain}})
+        cursor.close()
+        for cache_file in self.cb_cache_files:
+            with open(cache_file) as infile:
+                responses = json.load(infile)
+            for response in responses:
+                for item in response['data']['items']:
+                    properties = item['properties']
+                    self.token_index.add(('cb', properties.get('domain') or
+                                          properties.get('name')), item)
+        self.token_index.finalize()
+        self.print_indented('{} organizations indexed in {:.1f} secs'.
+                            format(len(self.token_index), time.time() - start),
+                            sys.stderr)
+
+    def resolve_name_from_index(self, company, domain):
+        """
+        Choose among the token index candidates for company
+        :param company: associated with the tech contact email address
+        :param domain: extracted from tech contact email address
+        :return: None if no candidate could be chosen, so Crunchbase should
+                     be queried; else bool 'stored', as for
+                     handle_non_isp_domain()
+        Called by: handle_non_isp_domain()
+        """
+        candidates = self.index_candidates.get(company)
+        if candidates is None:
+            candidates = self.token_index.candidates(company)
+        items = []
+        for org_key, score in candidates:
+            item = dict(self.token_index.items[org_key])
+            item['similarity'] = score
+            items.append(item)
+        response_dict = {'data': {'items': items}}
+        pick_ix, pick_company = self.rank_local_candidates(company, domain,
+                                                           response_dict)
+        if not pick_company:
+            return None
+        self.ct_local_name_hits += 1
+        source, key = candidates[pick_ix][0]
+        if source == 'pn':
+            return self.link_license_to_org(key, company)
+        return self.store_one_response(self.token_index.items[(source, key)],
+                                       company)
+
+    def link_license_to_org(self, org_id, company):
+        """
+        Point the license(s) for company at an organization already in
+            'pn_organizations'
+        :param org_id: id of the organization in 'pn_organizations'
+        :param company: from Marketplace data
+        :return: True iff the fk was stored into 'pn_licenses'
+        Called by: resolve_name_locally(), resolve_name_from_index()
+        """
+        pg_conn = self.get_pg_conn()
+        stored = False
+        license_contact_details_id_list = \
+            self.get_license_contact_details_id_list(pg_conn, company)
+        if len(license_contact_details_id_list) == 1:
+            stored = bool(self.do_store_part_2(pg_conn, org_id,
+                                               license_contact_details_id_list[0]))
+        else:
+            self.print_indented('CANNOT LINK ORG {}: {} License Contact '
+                                'Details ids returned'.
+                                format(company,
+                                       len(license_contact_details_id_list)))
+        self.release_pg_conn(pg_conn)
+        if stored:
+            self.ct_stored += 1
+            logging.info('{} linked to pn_organizations'.format(company))
+        return stored
+
     def query_cb_orgs_by_domain(self, payload):
         """
         Get response from Crunchbase for the given domain using CB's
@@ -441,14 +1166,73 @@ class LoadOrganizations:
         """
         # self.indent_level += 1
         # self.print_indented('Entering query_cb_orgs_by_domain()')
-        response = self.sess.get(self.url, params=payload)
-        domain_query_response_dict = response.json()
+        domain_query_response_dict = self.get_cb_response(payload)
         if self.domain_search_outfile or self.domain_search_to_stdout:
             self.output_found_domain_query_response(domain_query_response_dict)  # output response to temp file
         # self.print_indented('Leaving query_cb_orgs_by_domain()')
         # self.indent_level -= 1
         return domain_query_response_dict
 
+    def get_cb_response(self, payload, kind='domain'):
+        """
+        Send one query to the odm-organizations endpoint. Retry on 429 and
+            5xx responses, waiting as long as a Retry-After header asks, or
+            else backing off exponentially. Each attempt is added to
+            self.cb_stats, and waits first if the quota is used up.
+        :param payload: query parameters
+        :param kind: 'domain' or 'name', for the latency histograms
+        :return: the response as a dict; if it never succeeds, a response
+                     with no items
+        Called by: query_cb_orgs_by_domain(), query_cb_orgs_by_name()
+        """
+        self.throttle_cb_requests()
+        response = None
+        for attempt in range(self.max_retries + 1):
+            self.wait_for_cb_quota()
+            start = time.perf_counter()
+            try:
+                response = self.sess.get(self.url, params=payload)
+            except requests.ConnectionError as e:
+                logging.warning('Get url %s fails: %s' % (self.url, e))
+                response = None
+            self.cb_stats.record(kind, time.perf_counter() - start,
+                                 response.status_code if response is not None
+                                 else 'error')
+            if response is not None and response.status_code != 429 and \
+                    response.status_code < 500:
+                break
+            if attempt == self.max_retries:
+                break
+            self.ct_cb_retries += 1
+            delay = self.backoff_secs * 2 ** attempt
+            if response is not None and \
+                    response.headers.get('Retry-After', '').isdigit():
+                delay = int(response.headers['Retry-After'])
+            self.print_indented('Crunchbase returned {}: retrying in {} secs'.
+                                format(response.status_code if response
+                                       is not None else 'no response', delay),
+                                sys.stderr)
+            time.sleep(delay)
+        if response is not None and response.ok:
+            return response.json()
+        self.ct_cb_failures += 1
+        if response is not None:
+            self.log_error_response(response)
+        return {'data': {'items': []}}
+
+    def wait_for_cb_quota(self):
+        """
+        With --cb_quota, sleep until the next request fits in the quota
+        :return: None
+        Called by: get_cb_response()
+        """
+        wait_secs = self.cb_stats.get_wait_secs()
+        if wait_secs > 0:
+            self.print_indented('Crunchbase quota used up: waiting {:.1f} secs'.
+                                format(wait_secs), sys.stderr)
+            self.cb_stats.add_wait(wait_secs)
+            time.sleep(wait_secs)
+
     @staticmethod
     def get_response_len(response_dict):
         return len(response_dict['data']['items'])
@@ -548,7 +1332,7 @@ class LoadOrganizations:
                               for ix in range(len(response_dict['data']['items']))]
         self.print_indented('company: {}, domain: {}, response_name_list: {}'.
                             format(company, domain, response_name_list))
-        domain = self.shorten(domain)
+        domain = self.short_domains.get(domain) or self.shorten(domain)
 
         pick_ix, best_name = self.pick_match(company, domain, response_dict)
 
@@ -780,11 +1564,7 @@ class LoadOrganizations:
         updated_part_1 = False
         updated_part_2 = False
 
-        pg_conn_string = ("host = '{}' dbname = '{}' user = '{}' " +
-                          "password = '{}'").format(self.db_host, self.db_name,
-                                                    self.db_user,
-                                                    self.db_password)
-        pg_conn = psycopg2.connect(pg_conn_string)
+        pg_conn = self.get_pg_conn()
 
         data_item_org = self.setup_data_item_org(single_response)
 
@@ -827,7 +1607,7 @@ class LoadOrganizations:
             else:
                 pass
 
-        pg_conn.close()
+        self.release_pg_conn(pg_conn)
         self.print_indented("Leaving 'store_one_response()'")
         self.indent_level -= 1
         if stored_part_1 and stored_part_2:
@@ -839,6 +1619,30 @@ class LoadOrganizations:
             logging.info('{} *not* stored or updated in pn_organizations'.format(company))
             return False
 
+    def get_pg_conn(self):
+        """
+        :return: a connection to the db, from self.pg_pool if there is one
+        Called by: link_license_to_org(), store_one_response()
+        """
+        if self.pg_pool:
+            return self.pg_pool.getconn()
+        pg_conn_string = ("host = '{}' dbname = '{}' user = '{}' " +
+                          "password = '{}'").format(self.db_host, self.db_name,
+                                                    self.db_user,
+                                                    self.db_password)
+        return psycopg2.connect(pg_conn_string,
+                                connection_factory=StatsConnection)
+
+    def release_pg_conn(self, pg_conn):
+        """
+        Return a connection from get_pg_conn() to the pool, or close it
+        Called by: link_license_to_org(), store_one_response()
+        """
+        if self.pg_pool:
+            self.pg_pool.putconn(pg_conn)
+        else:
+            pg_conn.close()
+
     def get_already_stored(self, pg_conn):
         """
 
@@ -937,9 +1741,8 @@ class LoadOrganizations:
 
     @staticmethod
     def is_item_different(cursor, data_item_org_augmented):
-        query = 'SELECT * FROM pn_organizations WHERE domain = %s;'
         data = data_item_org_augmented[3]
-        cursor.execute(query, (data,))
+        cursor.execute(LoadOrganizations.org_by_domain_query, (data,))
         cursor_result = cursor.fetchone()
         result_list = [x for x in cursor_result[1:-1]]
         return result_list != data_item_org_augmented[:-2]
@@ -954,10 +1757,9 @@ class LoadOrganizations:
         Called by: store_one_response()
         """
         organization_id = None
-        query = 'SELECT id FROM pn_organizations WHERE name = %s'
         data = single_response['properties']['name']
         cursor = conn.cursor()
-        cursor.execute(query, (data,))
+        cursor.execute(LoadOrganizations.org_id_query, (data,))
         cursor_result = cursor.fetchone()
         cursor.close()
         if cursor_result:
@@ -966,13 +1768,10 @@ class LoadOrganizations:
 
     @staticmethod
     def get_license_contact_details_id_list(conn, company):
-        query = '(SELECT id FROM pn_license_contact_details ' \
-                'WHERE company = %s);'
-
         data = company
 
         cursor = conn.cursor()
-        cursor.execute(query, (data,))
+        cursor.execute(LoadOrganizations.lcd_ids_query, (data,))
         my_id_list = []
         my_result = cursor.fetchone()
         while my_result:
@@ -989,12 +1788,9 @@ class LoadOrganizations:
         :param lic_ct_id:
         :return:
         """
-        query = 'UPDATE pn_licenses SET organizations_id = %s ' \
-                'WHERE license_contact_details_id = %s;'
-
         data = (org_id, lic_ct_id)
         cursor = conn.cursor()
-        cursor.execute(query, data)
+        cursor.execute(self.link_licenses_query, data)
         rowcount = cursor.rowcount
         conn.commit()
         cursor.close()
@@ -1012,14 +1808,9 @@ class LoadOrganizations:
         :return:
         Called by: store_one_response()
         """
-        query = 'DELETE FROM pn_organizations o WHERE o.name = %s AND ' \
-                '(SELECT DISTINCT l.organizations_id FROM pn_organizations o2 ' \
-                'LEFT JOIN pn_licenses l ON l.organizations_id = o2.id ' \
-                'WHERE o2.name = %s) IS NULL'
-
         data = company, company
         cursor = conn.cursor()
-        cursor.execute(query, data)
+        cursor.execute(self.remove_org_query, data)
         rowcount = cursor.rowcount
         conn.commit()
         cursor.close()
@@ -1204,10 +1995,72 @@ class LoadOrganizations:
         except FileNotFoundError:
             pass
 
+    def reset_run_state(self):
+        """
+        Forget the last run's input, counts and search output settings,
+            while keeping the attributes in warm_attrs (sessions,
+            connections, lookup caches, and the Crunchbase quota ledger)
+        :return: None
+        Called by: Scheduler.run_organizations()
+        """
+        warm = {name: getattr(self, name) for name in self.warm_attrs}
+        self.__init__()
+        self.__dict__.update(warm)
+        self.cb_stats.reset_run()
+
+    def reset_batch_counts(self):
+        """
+        Zero the counts, metrics and Crunchbase request stats, so that
+            each listen batch reports its own numbers; the quota ledger is
+            kept
+        :return: None
+        Called by: listen_for_changes()
+        """
+        for name in self.batch_counts:
+            setattr(self, name, 0)
+        self.metrics.reset()
+        self.cb_stats.reset_run()
+
     def report_ok(self):
         return self.items_examined - self.items_skipped == \
                self.ct_isps + self.domain_misses + self.single_domain_hits + \
-               self.multiple_domain_hits + self.repeat_domains
+               self.multiple_domain_hits + self.repeat_domains + \
+               self.ct_snapshot_hits
+
+    def export_metrics(self, finished=False):
+        """
+        Write the run's phase timings, record counts and cache hit rates to
+            the metrics file
+        :param finished: if True, the run (or listen batch) is over
+        :return: None
+        Called by: get_each_license(), print_report()
+        """
+        self.metrics.set_records({
+            'items_examined': self.items_examined - self.items_skipped,
+            'isp_domains': self.ct_isps,
+            'domain_misses': self.domain_misses,
+            'single_domain_hits': self.single_domain_hits,
+            'multiple_domain_hits': self.multiple_domain_hits,
+            'name_queries': self.ct_name_queries,
+            'name_misses': self.name_misses,
+            'single_name_hits': self.single_name_hits,
+            'multiple_name_hits': self.multiple_name_hits,
+            'cb_requests': self.ct_cb_requests,
+            'cb_retries': self.ct_cb_retries,
+            'cb_failures': self.ct_cb_failures,
+            'orgs_stored': self.ct_stored,
+            'companies_notified': self.ct_companies_notified})
+        # a repeat domain is answered by the query already made for it
+        self.metrics.set_cache('domains_queried', self.repeat_domains,
+                               len(self.domains_queried))
+        if self.use_snapshot:
+            self.metrics.set_cache('snapshot', self.ct_snapshot_hits,
+                                   self.ct_snapshot_misses)
+        if self.resolve_names_locally or self.use_token_index:
+            # a miss is a name query that went on to Crunchbase
+            self.metrics.set_cache('local_names', self.ct_local_name_hits,
+                                   self.ct_name_queries)
+        self.metrics.write(finished)
 
     def print_report(self):
         """
@@ -1215,6 +2068,7 @@ class LoadOrganizations:
         :return: None
         Called by: get_each_license()
         """
+        self.export_metrics(finished=True)
         print(('{} domains examined:\n' +
                '\t{} domains are ISPs\n' +
                '\t{} domains not found\n' +
@@ -1227,6 +2081,9 @@ class LoadOrganizations:
                '\t{} multiple name hits found\n' +
                '{:.3f} secs spent in getting {} ' +
                'responses from crunchbase\n' +
+               '{} crunchbase retries, {} failed requests\n' +
+               '{} snapshot hits, {} snapshot misses\n' +
+               '{} names resolved locally\n' +
                '{} orgs stored or updated in pn_organizations').
               format((self.items_examined -
                       self.items_skipped),
@@ -1246,8 +2103,16 @@ class LoadOrganizations:
                       self.name_misses +
                       self.single_name_hits +
                       self.multiple_name_hits),
+                     self.ct_cb_retries,
+                     self.ct_cb_failures,
+                     self.ct_snapshot_hits,
+                     self.ct_snapshot_misses,
+                     self.ct_local_name_hits,
                      self.ct_stored),
               file=sys.stderr)
+        self.cb_stats.print_report()
+        if self.cb_stats_json:
+            self.cb_stats.write_json(self.cb_stats_json)
 
 
 def run_load_organizations():
@@ -1256,7 +2121,11 @@ def run_load_organizations():
     lo.get_c_l_args()
     lo.get_env_vars()
     lo.setup_logging()
-    lo.get_each_license()
+    if lo.listen:
+        lo.listen_for_changes()  # profiles each batch as it goes
+        return
+    with lo.profiler.phase('enrich'):
+        lo.get_each_license()
     lo.print_report()
 
 
@@ -0,0 +1,181 @@
+# file: token_index.py
+
+import heapq
+import math
+import re
+from collections import defaultdict
+import numpy as np
+
+
+class TokenIndex:
+    """
+    In-memory inverted index from name token to organization keys, with
+    IDF weights. Used by LoadOrganizations to find candidate organizations
+    for many company names at once, instead of comparing every company
+    against every known organization. The candidates still go through
+    pick_match() / pick_by_matches().
+    """
+    def __init__(self, max_postings=10000):
+        self.postings = defaultdict(set)  # token -> set of org keys
+        self.items = {}  # org key -> item shaped like a CB response item
+        self.idf = {}  # token -> inverse document frequency
+        # set by finalize(), for batch_candidates()
+        self.org_keys = []  # org keys, in str() order
+        self.posting_arrays = {}  # token -> its org keys' indexes in org_keys
+        # tokens such as 'inc' held by more orgs than this do not generate
+        # candidates; they add little weight and cost the most to walk
+        self.max_postings = max_postings
+
+    @staticmethod
+    def tokenize_name(name):
+        """
+        Split an organization name into lower case tokens. Splits on '.'
+            as well as on whitespace, so the tokens include every word
+            pick_by_matches() may see after shorten().
+        :param name: organization name
+        :return: set of tokens
+        Called by: add()
+        """
+        return set(token for token in re.split(r'[\s.]+', name.lower())
+                   if token)
+
+    @staticmethod
+    def tokenize_company(company):
+        """
+        Split a company name the way pick_match() does
+        :param company: from Marketplace data
+        :return: set of tokens
+        Called by: candidates(), batch_candidates()
+        """
+        return set(token for token in company.lower().split(' ') if token)
+
+    def add(self, org_key, item):
+        """
+        Add one organization to the index. Call finalize() once all have
+            been added.
+        :param org_key: unique key for the organization, e.g. its id
+        :param item: {'properties': {'name': ..., ...}}
+        :return: None
+        Called by: client code
+        """
+        name = item['properties'].get('name')
+        if not name:
+            return
+        self.items[org_key] = item
+        for token in self.tokenize_name(name):
+            self.postings[token].add(org_key)
+
+    def finalize(self):
+        """
+        Compute an IDF weight for each token
+        :return: None
+        Called by: client code
+        """
+        ct_orgs = len(self.items)
+        self.idf = {token: math.log((ct_orgs + 1) / len(org_keys))
+                    for token, org_keys in self.postings.items()
+                    if len(org_keys) <= self.max_postings}
+        # in str() order, so that an org key's index breaks ties as
+        #     top_candidates() does
+        self.org_keys = sorted(self.items, key=str)
+        org_ixs = {org_key: ix for ix, org_key in enumerate(self.org_keys)}
+        self.posting_arrays = {
+            token: np.array(sorted(org_ixs[org_key]
+                                   for org_key in self.postings[token]),
+                            dtype=np.int64)
+            for token in self.idf}
+
+    def __len__(self):
+        return len(self.items)
+
+    def candidates(self, company, limit=10):
+        """
+        Get the organizations sharing the most heavily weighted tokens
+            with company
+        :param company: from Marketplace data
+        :param limit: maximum number of candidates
+        :return: list of (org key, score), highest score first
+        Called by: client code
+        """
+        scores = defaultdict(float)
+        # in sorted order, so that scores match batch_candidates()'s exactly
+        for token in sorted(self.tokenize_company(company)):
+            weight = self.idf.get(token)
+            if weight is None:
+                continue
+            for org_key in self.postings[token]:
+                scores[org_key] += weight
+        return self.top_candidates(scores, limit)
+
+    def batch_candidates(self, companies, limit=10):
+        """
+        Get candidates for a whole batch of company names, as
+            candidates() would give them, scoring all the names at once:
+            each (name, token) pair contributes its token's posting array,
+            and one sort and sum over all of them gives every name's
+            scores. Names with the same indexed tokens (e.g. 'Acme Inc' and
+            'acme  inc') are scored once.
+        :param companies: iterable of company names
+        :param limit: maximum number of candidates per company
+        :return: dict: company -> list of (org key, score), highest first
+        Called by: client code
+        """
+        signatures = {}  # company -> tuple of its indexed tokens, sorted
+        for company in set(companies):
+            signatures[company] = tuple(sorted(
+                token for token in self.tokenize_company(company)
+                if token in self.idf))
+        distinct = sorted(set(signatures.values()))
+        # one row per (name, token, org): tokens in sorted order within each
+        #     name, so the sums below add up as candidates() does
+        postings = []
+        weights = []
+        for signature in distinct:
+            for token in signature:
+                postings.append(self.posting_arrays[token])
+                weights.append(self.idf[token])
+        top = {signature: [] for signature in distinct}
+        if postings:
+            lengths = np.array([len(posting) for posting in postings])
+            ct_tokens = np.array([len(signature) for signature in distinct])
+            sig_ixs = np.repeat(np.repeat(np.arange(len(distinct)),
+                                          ct_tokens), lengths)
+            keys = sig_ixs * len(self.org_keys) + np.concatenate(postings)
+            row_weights = np.repeat(np.array(weights), lengths)
+            order = np.argsort(keys, kind='stable')
+            keys, row_weights = keys[order], row_weights[order]
+            starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+            # add each (name, org)'s weights strictly left to right, as
+            #     candidates() does (np.add.reduceat need not), a token
+            #     position at a time
+            group_ixs = np.cumsum(np.r_[True, keys[1:] != keys[:-1]]) - 1
+            positions = np.arange(len(keys)) - starts[group_ixs]
+            scores = np.zeros(len(starts))
+            for position in range(positions.max() + 1):
+                at = positions == position
+                scores[group_ixs[at]] += row_weights[at]
+            keys = keys[starts]
+            sig_ixs, org_ixs = np.divmod(keys, len(self.org_keys))
+            # by name, then score, highest first, then org key
+            order = np.lexsort((org_ixs, -scores, sig_ixs))
+            sig_ixs, org_ixs, scores = \
+                sig_ixs[order], org_ixs[order], scores[order]
+            group_starts = np.searchsorted(sig_ixs, sig_ixs, side='left')
+            keep = np.arange(len(sig_ixs)) - group_starts < limit
+            for sig_ix, org_ix, score in zip(sig_ixs[keep].tolist(),
+                                             org_ixs[keep].tolist(),
+                                             scores[keep].tolist()):
+                top[distinct[sig_ix]].append((self.org_keys[org_ix], score))
+        return {company: list(top[signature])
+                for company, signature in signatures.items()}
+
+    @staticmethod
+    def top_candidates(scores, limit):
+        """
+        :param scores: dict: org key -> score
+        :param limit: maximum number of candidates
+        :return: list of (org key, score), highest score first
+        Called by: candidates(), batch_candidates()
+        """
+        return heapq.nsmallest(limit, scores.items(),
+                               key=lambda x: (-x[1], str(x[0])))
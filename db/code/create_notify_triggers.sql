@@ -0,0 +1,66 @@
+-- NOTIFY 'pn_company_changed' with {"company": ..., "email": ...} (the
+-- company and its technical contact's email) when license contact details
+-- are added or change company or technical contact, and when licenses
+-- are added or moved to other license contact details.
+-- load_organizations.py --listen enriches the companies announced.
+-- A company is announced again once its licenses are stored, which is when
+-- they can be linked to an organization; within one transaction,
+-- PostgreSQL folds identical notifications into one.
+
+CREATE OR REPLACE FUNCTION pn_notify_company_changed()
+RETURNS TRIGGER AS $$
+DECLARE
+    lcd_row pn_license_contact_details%ROWTYPE;
+    tech_email VARCHAR;
+BEGIN
+    IF TG_TABLE_NAME = 'pn_licenses' THEN
+        SELECT * INTO lcd_row FROM pn_license_contact_details
+            WHERE id = NEW.license_contact_details_id;
+        IF NOT FOUND THEN
+            RETURN NULL;
+        END IF;
+    ELSE
+        lcd_row := NEW;
+    END IF;
+    SELECT email INTO tech_email FROM pn_contacts
+        WHERE id = lcd_row.tech_contact_id;
+    PERFORM pg_notify('pn_company_changed',
+                      json_build_object('company', lcd_row.company,
+                                        'email', tech_email)::text);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+
+DROP TRIGGER IF EXISTS pn_lcd_insert_notify ON pn_license_contact_details;
+
+CREATE TRIGGER pn_lcd_insert_notify
+    AFTER INSERT ON pn_license_contact_details
+    FOR EACH ROW EXECUTE PROCEDURE pn_notify_company_changed();
+
+
+DROP TRIGGER IF EXISTS pn_lcd_update_notify ON pn_license_contact_details;
+
+CREATE TRIGGER pn_lcd_update_notify
+    AFTER UPDATE OF company, tech_contact_id ON pn_license_contact_details
+    FOR EACH ROW
+    WHEN (OLD.company IS DISTINCT FROM NEW.company OR
+          OLD.tech_contact_id IS DISTINCT FROM NEW.tech_contact_id)
+    EXECUTE PROCEDURE pn_notify_company_changed();
+
+
+DROP TRIGGER IF EXISTS pn_licenses_insert_notify ON pn_licenses;
+
+CREATE TRIGGER pn_licenses_insert_notify
+    AFTER INSERT ON pn_licenses
+    FOR EACH ROW EXECUTE PROCEDURE pn_notify_company_changed();
+
+
+DROP TRIGGER IF EXISTS pn_licenses_update_notify ON pn_licenses;
+
+CREATE TRIGGER pn_licenses_update_notify
+    AFTER UPDATE OF license_contact_details_id ON pn_licenses
+    FOR EACH ROW
+    WHEN (OLD.license_contact_details_id IS DISTINCT FROM
+          NEW.license_contact_details_id)
+    EXECUTE PROCEDURE pn_notify_company_changed();
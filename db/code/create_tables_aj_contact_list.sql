@@ -0,0 +1,148 @@
+-- aj_contact_list: the MailChimp subscribers read by
+-- chimp/import_and_add_subscribers.py, kept as a materialization of
+-- pn_contacts, pn_license_contact_details and pn_licenses.
+-- One row per contact (technical or billing) with at least one EVALUATION
+-- license; trial_exp is the latest maintenance end date among those.
+-- refresh_aj_contact_list() brings it up to date from pgres_last_updated;
+-- run it after each load (import_and_add_subscribers.py -r does).
+
+DROP TABLE IF EXISTS aj_contact_list;
+
+CREATE TABLE aj_contact_list (
+    email_address VARCHAR PRIMARY KEY,  -- the reader walks this index in order
+    contact_id UUID NOT NULL,
+    status VARCHAR NOT NULL,  -- MailChimp member status
+    trial_exp DATE NOT NULL,
+    refreshed_at TIMESTAMPTZ
+);
+
+CREATE INDEX aj_contact_list_contact_id_idx
+    ON aj_contact_list (contact_id);
+
+
+DROP TABLE IF EXISTS aj_contact_list_refresh;
+
+-- Single row: the newest pgres_last_updated the last refresh saw
+CREATE TABLE aj_contact_list_refresh (
+    id BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (id),
+    last_source_update TIMESTAMPTZ,
+    refreshed_at TIMESTAMPTZ,
+    ct_contacts_refreshed INTEGER
+);
+
+INSERT INTO aj_contact_list_refresh (last_source_update) VALUES (NULL);
+
+
+-- So that a refresh finds what changed without scanning the pn_* tables
+CREATE INDEX IF NOT EXISTS pn_contacts_pgres_last_updated_idx
+    ON pn_contacts (pgres_last_updated);
+
+CREATE INDEX IF NOT EXISTS pn_license_contact_details_pgres_last_updated_idx
+    ON pn_license_contact_details (pgres_last_updated);
+
+CREATE INDEX IF NOT EXISTS pn_licenses_pgres_last_updated_idx
+    ON pn_licenses (pgres_last_updated);
+
+CREATE INDEX IF NOT EXISTS pn_license_contact_details_tech_contact_id_idx
+    ON pn_license_contact_details (tech_contact_id);
+
+CREATE INDEX IF NOT EXISTS pn_license_contact_details_bill_contact_id_idx
+    ON pn_license_contact_details (bill_contact_id);
+
+CREATE INDEX IF NOT EXISTS pn_licenses_license_contact_details_id_idx
+    ON pn_licenses (license_contact_details_id);
+
+
+-- Recompute the aj_contact_list rows of every contact touched (directly,
+-- through its license contact details, or through their licenses) since
+-- the last refresh. The loaders stamp a whole run with its start time, so
+-- rows stamped at the previous high-water mark are looked at again.
+-- A license moved to other contact details, or deleted, is only seen by a
+-- full refresh.
+-- :param full_refresh: rebuild the whole table
+-- :return: number of contacts recomputed
+CREATE OR REPLACE FUNCTION refresh_aj_contact_list(full_refresh BOOLEAN DEFAULT FALSE)
+RETURNS INTEGER AS $$
+DECLARE
+    since TIMESTAMPTZ;
+    high_water TIMESTAMPTZ;
+    ct_contacts INTEGER;
+BEGIN
+    -- the row lock also keeps two refreshes from running at once
+    SELECT last_source_update INTO since
+        FROM aj_contact_list_refresh FOR UPDATE;
+
+    SELECT max(latest) INTO high_water FROM (
+        SELECT max(pgres_last_updated) AS latest FROM pn_contacts
+        UNION ALL
+        SELECT max(pgres_last_updated) FROM pn_license_contact_details
+        UNION ALL
+        SELECT max(pgres_last_updated) FROM pn_licenses
+    ) latest_updates;
+
+    DROP TABLE IF EXISTS aj_changed_contacts;
+    CREATE TEMP TABLE aj_changed_contacts (id UUID PRIMARY KEY)
+        ON COMMIT DROP;
+
+    IF full_refresh OR since IS NULL THEN
+        INSERT INTO aj_changed_contacts SELECT id FROM pn_contacts;
+    ELSE
+        INSERT INTO aj_changed_contacts
+            SELECT id FROM pn_contacts
+                WHERE pgres_last_updated >= since
+            UNION
+            SELECT tech_contact_id FROM pn_license_contact_details
+                WHERE pgres_last_updated >= since
+            UNION
+            SELECT bill_contact_id FROM pn_license_contact_details
+                WHERE pgres_last_updated >= since
+                AND bill_contact_id IS NOT NULL
+            UNION
+            SELECT lcd.tech_contact_id FROM pn_licenses l
+                JOIN pn_license_contact_details lcd
+                ON lcd.id = l.license_contact_details_id
+                WHERE l.pgres_last_updated >= since
+            UNION
+            SELECT lcd.bill_contact_id FROM pn_licenses l
+                JOIN pn_license_contact_details lcd
+                ON lcd.id = l.license_contact_details_id
+                WHERE l.pgres_last_updated >= since
+                AND lcd.bill_contact_id IS NOT NULL;
+    END IF;
+    ANALYZE aj_changed_contacts;
+    SELECT count(*) INTO ct_contacts FROM aj_changed_contacts;
+
+    IF full_refresh OR since IS NULL THEN
+        TRUNCATE aj_contact_list;
+    ELSE
+        DELETE FROM aj_contact_list
+            WHERE contact_id IN (SELECT id FROM aj_changed_contacts);
+    END IF;
+
+    INSERT INTO aj_contact_list
+        (email_address, contact_id, status, trial_exp, refreshed_at)
+    SELECT c.email, c.id, 'subscribed', max(l.maint_end_date)::date, now()
+    FROM aj_changed_contacts changed
+    JOIN pn_contacts c ON c.id = changed.id
+    JOIN (
+        SELECT tech_contact_id AS contact_id, id AS lcd_id
+            FROM pn_license_contact_details
+        UNION ALL
+        SELECT bill_contact_id, id
+            FROM pn_license_contact_details
+            WHERE bill_contact_id IS NOT NULL
+    ) roles ON roles.contact_id = c.id
+    JOIN pn_licenses l ON l.license_contact_details_id = roles.lcd_id
+    WHERE l.license_type = 'EVALUATION'
+    GROUP BY c.id, c.email
+    ON CONFLICT (email_address) DO UPDATE
+        SET contact_id = EXCLUDED.contact_id, status = EXCLUDED.status,
+        trial_exp = EXCLUDED.trial_exp, refreshed_at = EXCLUDED.refreshed_at;
+
+    UPDATE aj_contact_list_refresh
+        SET last_source_update = greatest(since, high_water),
+        refreshed_at = now(), ct_contacts_refreshed = ct_contacts;
+
+    RETURN ct_contacts;
+END;
+$$ LANGUAGE plpgsql;
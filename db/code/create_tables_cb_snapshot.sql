@@ -0,0 +1,31 @@
+DROP TABLE IF EXISTS cb_odm_organizations;
+
+-- Local copy of a Crunchbase ODM bulk export; loaded by load_cb_snapshot.py
+CREATE TABLE cb_odm_organizations (
+    id UUID PRIMARY KEY DEFAULT uuid_generate_v1mc(),
+    cb_uuid VARCHAR UNIQUE,
+    name VARCHAR NOT NULL,
+    primary_role VARCHAR,
+    short_description VARCHAR,
+    domain VARCHAR,  -- as given by Crunchbase
+    domain_key VARCHAR,  -- lower case, no scheme, 'www.' or path
+    homepage_url VARCHAR,
+    facebook_url VARCHAR,
+    twitter_url VARCHAR,
+    linkedin_url VARCHAR,
+    api_url VARCHAR,
+    city VARCHAR,  -- city name in API
+    region VARCHAR,  -- region_name in API
+    country VARCHAR,  -- country code in API
+    stock_exchange VARCHAR,
+    stock_symbol VARCHAR,
+    created_at INTEGER,  -- seconds since the epoch
+    updated_at INTEGER,  -- seconds since the epoch
+    pgres_last_updated TIMESTAMPTZ
+);
+
+CREATE INDEX cb_odm_organizations_domain_key_idx
+    ON cb_odm_organizations (domain_key);
+
+CREATE INDEX cb_odm_organizations_lower_name_idx
+    ON cb_odm_organizations (lower(name));
@@ -0,0 +1,27 @@
+DROP TABLE IF EXISTS aj_chimp_sync_state;
+
+-- What import_and_add_subscribers.py last pushed to each MailChimp list,
+-- and MailChimp confirmed; read and written by its --delta mode
+CREATE TABLE aj_chimp_sync_state (
+    list_id VARCHAR NOT NULL,
+    email_address VARCHAR NOT NULL,  -- lower case
+    payload_hash VARCHAR NOT NULL,  -- md5 of 'status|TRIALEXP'
+    pushed_at TIMESTAMPTZ,
+    PRIMARY KEY (list_id, email_address)
+);
+
+
+DROP TABLE IF EXISTS aj_chimp_dead_letter;
+
+-- Members MailChimp rejected permanently, or that kept failing; written by
+-- import_and_add_subscribers.py and kept for inspection
+CREATE TABLE aj_chimp_dead_letter (
+    list_id VARCHAR NOT NULL,
+    email_address VARCHAR NOT NULL,  -- lower case
+    error_code VARCHAR,
+    error VARCHAR,
+    attempts INTEGER,
+    member JSONB,  -- the member as last sent
+    failed_at TIMESTAMPTZ,
+    PRIMARY KEY (list_id, email_address)
+);
@@ -1,3 +1,6 @@
+-- After creating the tables, run db/migrate.py to add the indexes and
+-- other changes in db/migrations/.
+
 DROP TABLE IF EXISTS pn_contacts CASCADE;
 
 CREATE TABLE pn_contacts (
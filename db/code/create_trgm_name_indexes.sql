@@ -0,0 +1,29 @@
+-- Trigram indexes on normalized organization names, used by
+-- load_organizations.py -r to resolve company names locally before
+-- falling back to a Crunchbase name query.
+-- Run after create_tables_licenses.sql (and create_tables_cb_snapshot.sql,
+-- if a Crunchbase snapshot is kept).
+
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
+-- lower case; runs of anything but letters and digits become one space
+CREATE OR REPLACE FUNCTION pn_normalize_name(name VARCHAR)
+    RETURNS VARCHAR AS $$
+    SELECT btrim(regexp_replace(lower(name), '[^a-z0-9]+', ' ', 'g'));
+$$ LANGUAGE SQL IMMUTABLE STRICT;
+
+DROP INDEX IF EXISTS pn_organizations_name_trgm_idx;
+
+CREATE INDEX pn_organizations_name_trgm_idx
+    ON pn_organizations USING gin (pn_normalize_name(name) gin_trgm_ops);
+
+DO $$
+BEGIN
+    IF to_regclass('cb_odm_organizations') IS NOT NULL THEN
+        DROP INDEX IF EXISTS cb_odm_organizations_name_trgm_idx;
+        CREATE INDEX cb_odm_organizations_name_trgm_idx
+            ON cb_odm_organizations
+            USING gin (pn_normalize_name(name) gin_trgm_ops);
+    END IF;
+END
+$$;
@@ -0,0 +1,259 @@
+#!/usr/bin/env python3.6
+
+
+# file: migrate.py
+
+import os
+import sys
+import argparse
+import hashlib
+import re
+import time
+import psycopg2
+
+
+class Migrate:
+    """
+    Bring the schema up to date: apply, in order, each db/migrations/
+    NNNN_<name>.sql file whose version is not yet in schema_migrations,
+    each in its own transaction, and record it there.
+    A migration is applied again if a table or index it creates is
+    missing, e.g. after a create_tables_*.sql file has remade the tables
+    it touched; so each migration must be safe to apply again (CREATE
+    INDEX IF NOT EXISTS, etc.).
+    Run after the db/code/create_tables_*.sql files, e.g.:
+    python3 db/migrate.py
+    or, to list applied and pending migrations:
+    python3 db/migrate.py -l
+    """
+    migrations_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                  'migrations')
+    file_pattern = re.compile(r'^(\d{4})_(\w+)\.sql$')
+    # the relations a migration creates, checked by get_missing()
+    creates_pattern = re.compile(
+        r'\bCREATE\s+(?:UNIQUE\s+)?(?:MATERIALIZED\s+)?'
+        r'(?:INDEX|TABLE|VIEW|SEQUENCE)\s+(?:CONCURRENTLY\s+)?'
+        r'(?:IF\s+NOT\s+EXISTS\s+)?(\w+)', re.IGNORECASE)
+    create_table_query = (
+        'CREATE TABLE IF NOT EXISTS schema_migrations (' +
+        'version VARCHAR PRIMARY KEY, ' +
+        'name VARCHAR NOT NULL, ' +
+        'checksum VARCHAR NOT NULL, ' +  # md5 of the file as applied
+        'applied_at TIMESTAMPTZ NOT NULL DEFAULT now(), ' +
+        'duration_secs REAL);')
+
+    def __init__(self, db_password=None):
+        self.db_host = None
+        self.db_name = None
+        self.db_user = None
+        self.db_password = db_password
+        self.list_only = False
+        self.target = None  # apply no version after this one
+        self.ct_applied = 0
+
+    def get_c_l_args(self, argv=None):
+        """Get command line arguments"""
+        parser = argparse.ArgumentParser()
+        parser.add_argument('-l', '--list', action='store_true',
+                            help='list applied and pending migrations, and '
+                                 'apply none')
+        parser.add_argument('-t', '--target', type=str, default=None,
+                            help='apply migrations up to version TARGET only')
+        args = parser.parse_args(argv)
+        self.list_only = args.list
+        self.target = args.target
+
+    def get_env_vars(self):
+        """Check that environment variables have been set"""
+        try:
+            self.db_host = os.environ['DBHOST']
+            self.db_name = os.environ['DBNAME']
+            self.db_user = os.environ['DBUSER']
+            self.db_password = os.environ['DBPASSWD']
+        except KeyError:
+            print('Please set environment variables DBHOST, DBNAME, DBUSER, '
+                  'DBPASSWD', file=sys.stderr)
+            sys.exit(1)
+
+    def connect(self):
+        """
+        :return: a connection to the db
+        Called by: main()
+        """
+        pg_conn_string = ("host = '{}' dbname = '{}' user = '{}' " +
+                          "password = '{}'").format(self.db_host, self.db_name,
+                                                    self.db_user,
+                                                    self.db_password)
+        return psycopg2.connect(pg_conn_string)
+
+    def find_migrations(self):
+        """
+        :return: list of (version, name, path) tuples, in version order
+        Called by: apply_pending(), list_migrations()
+        """
+        migrations = []
+        for file_name in sorted(os.listdir(self.migrations_dir)):
+            match = self.file_pattern.match(file_name)
+            if match:
+                migrations.append((match.group(1), match.group(2),
+                                   os.path.join(self.migrations_dir,
+                                                file_name)))
+        return migrations
+
+    def get_applied(self, conn):
+        """
+        :param conn: to the db
+        :return: dict of version -> checksum, of the applied migrations
+        Called by: apply_pending(), list_migrations()
+        """
+        cursor = conn.cursor()
+        cursor.execute(self.create_table_query)
+        cursor.execute('SELECT version, checksum FROM schema_migrations;')
+        applied = dict(cursor.fetchall())
+        cursor.close()
+        conn.commit()
+        return applied
+
+    @staticmethod
+    def read_migration(path):
+        """
+        :param path: of a migration file
+        :return: (its SQL, the md5 of its SQL)
+        Called by: apply_pending(), list_migrations()
+        """
+        with open(path) as infile:
+            sql = infile.read()
+        return sql, hashlib.md5(sql.encode('utf-8')).hexdigest()
+
+    def get_missing(self, conn, sql):
+        """
+        :param conn: to the db
+        :param sql: of a migration
+        :return: list of the tables, indexes, etc. it creates that are not
+                     in the db, as found on the search path
+        Called by: apply_pending(), list_migrations()
+        """
+        cursor = conn.cursor()
+        missing = []
+        for name in self.creates_pattern.findall(sql):
+            cursor.execute('SELECT to_regclass(%s);', (name,))
+            if cursor.fetchone()[0] is None:
+                missing.append(name)
+        cursor.close()
+        conn.commit()
+        return missing
+
+    def apply_pending(self, conn):
+        """
+        Apply each migration not yet applied, up to self.target, and apply
+            again each applied one whose tables or indexes are missing.
+            Warn of applied migrations whose files have changed since.
+        :param conn: to the db
+        :return: list of the versions applied
+        Called by: main(), BenchLookupIndexes.run()
+        """
+        applied = self.get_applied(conn)
+        versions = []
+        for version, name, path in self.find_migrations():
+            if self.target and version > self.target:
+                break
+            sql, checksum = self.read_migration(path)
+            reapply = False
+            if version in applied:
+                if applied[version] != checksum:
+                    print('Migration {}_{} has changed since it was applied'.
+                          format(version, name), file=sys.stderr)
+                missing = self.get_missing(conn, sql)
+                if not missing:
+                    continue
+                print('Migration {}_{} was applied, but {} missing; '
+                      'applying it again'.format(version, name,
+                                                 ', '.join(missing) +
+                                                 (' is' if len(missing) == 1
+                                                  else ' are')),
+                      file=sys.stderr)
+                reapply = True
+            if self.apply_one(conn, version, name, sql, checksum, reapply):
+                versions.append(version)
+        return versions
+
+    def apply_one(self, conn, version, name, sql, checksum, reapply=False):
+        """
+        Run one migration and record it, in one transaction; the table lock
+            keeps two runs of this script from applying it twice
+        :param conn: to the db
+        :param reapply: if True, it is recorded as applied already; run it
+                            again, and update its record
+        :return: True iff this call applied it
+        Called by: apply_pending()
+        """
+        cursor = conn.cursor()
+        try:
+            cursor.execute('LOCK TABLE schema_migrations IN EXCLUSIVE MODE;')
+            cursor.execute('SELECT 1 FROM schema_migrations '
+                           'WHERE version = %s;', (version,))
+            if cursor.fetchone() and not reapply:
+                conn.rollback()
+                return False
+            start = time.perf_counter()
+            cursor.execute(sql)
+            duration = time.perf_counter() - start
+            cursor.execute('INSERT INTO schema_migrations (version, name, ' +
+                           'checksum, duration_secs) VALUES (%s, %s, %s, %s) ' +
+                           'ON CONFLICT (version) DO UPDATE SET (checksum, ' +
+                           'applied_at, duration_secs) = (EXCLUDED.checksum, ' +
+                           'now(), EXCLUDED.duration_secs);',
+                           (version, name, checksum, duration))
+            conn.commit()
+        except psycopg2.Error:
+            conn.rollback()
+            print('Migration {}_{} failed; nothing of it was applied'.
+                  format(version, name), file=sys.stderr)
+            raise
+        finally:
+            cursor.close()
+        self.ct_applied += 1
+        print('Applied {}_{} in {:.3f} secs'.format(version, name, duration),
+              file=sys.stderr)
+        return True
+
+    def list_migrations(self, conn):
+        """
+        Print each migration, and whether it has been applied
+        :param conn: to the db
+        :return: None
+        Called by: main()
+        """
+        applied = self.get_applied(conn)
+        for version, name, path in self.find_migrations():
+            sql, checksum = self.read_migration(path)
+            missing = self.get_missing(conn, sql) if version in applied \
+                else []
+            if version not in applied:
+                state = 'pending'
+            elif missing:
+                state = 'applied, but {} missing; to be applied again'.format(
+                    ', '.join(missing))
+            elif applied[version] != checksum:
+                state = 'applied, file changed since'
+            else:
+                state = 'applied'
+            print('{}_{}: {}'.format(version, name, state))
+
+    def main(self):
+        self.get_c_l_args()
+        self.get_env_vars()
+        conn = self.connect()
+        try:
+            if self.list_only:
+                self.list_migrations(conn)
+            else:
+                self.apply_pending(conn)
+                print('{} migrations applied'.format(self.ct_applied),
+                      file=sys.stderr)
+        finally:
+            conn.close()
+
+
+if __name__ == '__main__':
+    Migrate().main()
@@ -0,0 +1,24 @@
+-- Indexes for the columns the loaders look rows up by, beyond the primary
+-- keys and UNIQUE constraints of create_tables_licenses.sql.
+
+-- load_organizations.py get_organization_id(): SELECT id ... WHERE name;
+-- with id in the index, an index-only scan. Also remove_company_from_orgs().
+CREATE INDEX IF NOT EXISTS pn_organizations_name_id_idx
+    ON pn_organizations (name, id);
+
+-- load_organizations.py get_license_contact_details_id_list():
+-- SELECT id ... WHERE company. UNIQUE (company, country, region) can find
+-- the rows, but only this one answers from the index alone.
+CREATE INDEX IF NOT EXISTS pn_license_contact_details_company_id_idx
+    ON pn_license_contact_details (company, id);
+
+-- load_organizations.py do_store_part_2(): UPDATE ... WHERE
+-- license_contact_details_id. Same name as in
+-- create_tables_aj_contact_list.sql, which may have made it already.
+CREATE INDEX IF NOT EXISTS pn_licenses_license_contact_details_id_idx
+    ON pn_licenses (license_contact_details_id);
+
+-- load_organizations.py remove_company_from_orgs(): the subquery joining
+-- pn_licenses on organizations_id
+CREATE INDEX IF NOT EXISTS pn_licenses_organizations_id_idx
+    ON pn_licenses (organizations_id);
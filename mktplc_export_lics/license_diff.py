@@ -0,0 +1,231 @@
+# file: license_diff.py
+
+import numpy as np
+import pandas as pd
+from psycopg2.extras import execute_values
+
+
+class LicenseDiff:
+    """
+    Reconcile a batch of Marketplace licenses with pn_licenses in one pass,
+    instead of a duplicate check query, and four foreign key lookups, per
+    license. The current rows for the batch's license ids come from one
+    query, and the addon and license contact details ids from one query
+    each. A column-by-column comparison then sorts the batch into inserts,
+    updates and unchanged licenses.
+    The results match LoadLicenses.get_license_id(), run on each license in
+    turn:
+    - a license id seen twice in the batch is compared, the second time,
+      with its first occurrence, as the row that occurrence left behind
+    - partner_details_id comes from get_partner_details_id(), which looks
+      for 'partnerName' at the top level of the license. Marketplace puts
+      it under 'partnerDetails', so in practice it is NULL.
+    - dates are compared as 'YYYY-MM-DD' strings
+    """
+    # compared, in this order, by is_license_id_item_duplicate()
+    columns = ['license_id', 'addons_id', 'license_contact_details_id',
+               'partner_details_id', 'organizations_id', 'addon_key',
+               'hosting', 'host_license_id', 'last_updated', 'license_type',
+               'maint_start_date', 'maint_end_date', 'status', 'tier']
+    current_rows_query = (
+        "SELECT license_id, addons_id::text, " +
+        "license_contact_details_id::text, partner_details_id::text, " +
+        "organizations_id::text, addon_key, hosting, host_license_id, " +
+        "to_char(last_updated, 'YYYY-MM-DD'), license_type, " +
+        "to_char(maint_start_date::date, 'YYYY-MM-DD'), " +
+        "to_char(maint_end_date::date, 'YYYY-MM-DD'), status, tier " +
+        "FROM pn_licenses WHERE license_id = ANY(%s);")
+    addons_query = 'SELECT key, id::text FROM pn_addons WHERE key = ANY(%s);'
+    lcd_query = ('SELECT lcd.company, lcd.country, lcd.region, lcd.id::text ' +
+                 'FROM pn_license_contact_details lcd ' +
+                 'JOIN unnest(%s::varchar[], %s::varchar[], %s::varchar[]) ' +
+                 'AS k (company, country, region) ' +
+                 'ON (lcd.company, lcd.country, lcd.region) = ' +
+                 '(k.company, k.country, k.region);')
+    insert_query = ('INSERT INTO pn_licenses (license_id, ' +
+                    'addons_id, license_contact_details_id, ' +
+                    'partner_details_id, organizations_id, ' +
+                    'addon_key, hosting, host_license_id, ' +
+                    'last_updated, license_type, ' +
+                    'maint_start_date, maint_end_date, ' +
+                    'status, tier, pgres_last_updated) VALUES %s;')
+    update_query = ('UPDATE pn_licenses AS l SET (addons_id, ' +
+                    'license_contact_details_id, partner_details_id, ' +
+                    'organizations_id, addon_key, hosting, host_license_id, ' +
+                    'last_updated, license_type, maint_start_date, ' +
+                    'maint_end_date, status, tier, pgres_last_updated) = ' +
+                    '(v.addons_id::uuid, v.license_contact_details_id::uuid, ' +
+                    'v.partner_details_id::uuid, v.organizations_id::uuid, ' +
+                    'v.addon_key, v.hosting, v.host_license_id, ' +
+                    'v.last_updated::date, v.license_type, ' +
+                    'v.maint_start_date::timestamptz, ' +
+                    'v.maint_end_date::timestamptz, v.status, v.tier, ' +
+                    'v.pgres_last_updated::timestamptz) ' +
+                    'FROM (VALUES %s) AS v (license_id, addons_id, ' +
+                    'license_contact_details_id, partner_details_id, ' +
+                    'organizations_id, addon_key, hosting, host_license_id, ' +
+                    'last_updated, license_type, maint_start_date, ' +
+                    'maint_end_date, status, tier, pgres_last_updated) ' +
+                    'WHERE l.license_id = v.license_id;')
+
+    def __init__(self, pn_cursor):
+        self.pn_cursor = pn_cursor
+
+    @staticmethod
+    def make_batch_frame(items, resolve_partner):
+        """
+        :param items: licenses from Marketplace
+        :param resolve_partner: called with an item's index into items
+                                    when the item has a top level
+                                    'partnerName'; returns its
+                                    partner_details_id
+        :return: DataFrame of the items' columns; the foreign keys that
+                     need the db still empty
+        Called by: diff()
+        """
+        rows = []
+        for ix, item in enumerate(items):
+            contact_details = item['contactDetails']
+            rows.append((ix, item['licenseId'], item['addonKey'],
+                         item.get('hosting', None),
+                         item.get('hostLicenseId', None),
+                         item['lastUpdated'], item['licenseType'],
+                         item['maintenanceStartDate'],
+                         item['maintenanceEndDate'], item['status'],
+                         item['tier'],
+                         contact_details.get('company', None),
+                         contact_details.get('country', None),
+                         contact_details.get('region', None),
+                         resolve_partner(ix) if item.get('partnerName', None)
+                         else None))
+        return pd.DataFrame(rows, dtype=object,
+                            columns=['ix', 'license_id', 'addon_key',
+                                     'hosting', 'host_license_id',
+                                     'last_updated', 'license_type',
+                                     'maint_start_date', 'maint_end_date',
+                                     'status', 'tier', 'company', 'country',
+                                     'region', 'partner_details_id'])
+
+    def get_current_frame(self, license_ids):
+        """
+        :param license_ids: of the batch, each once
+        :return: DataFrame of their rows in pn_licenses, as the
+                     duplicate check sees them
+        Called by: diff()
+        """
+        self.pn_cursor.execute(self.current_rows_query, (list(license_ids),))
+        return pd.DataFrame(self.pn_cursor.fetchall(), dtype=object,
+                            columns=self.columns)
+
+    def resolve_keys(self, batch):
+        """
+        Fill in the batch's addons_id and license_contact_details_id, as
+            get_addons_id() and get_lcd_id() would
+        :param batch: as from make_batch_frame()
+        :return: None
+        Called by: diff()
+        """
+        self.pn_cursor.execute(self.addons_query,
+                               (list(batch['addon_key'].unique()),))
+        batch['addons_id'] = batch['addon_key'].map(
+            dict(self.pn_cursor.fetchall()))
+        lcd_key_cols = ['company', 'country', 'region']
+        # get_lcd_id() looks up only keys with all three parts
+        has_key = batch[lcd_key_cols].fillna('').astype(bool).all(axis=1)
+        keys = batch.loc[has_key, lcd_key_cols].drop_duplicates()
+        self.pn_cursor.execute(self.lcd_query,
+                               tuple(keys[col].tolist() for col in lcd_key_cols))
+        lcd_ids = pd.DataFrame(self.pn_cursor.fetchall(), dtype=object,
+                               columns=lcd_key_cols +
+                               ['license_contact_details_id'])
+        batch['license_contact_details_id'] = batch[lcd_key_cols].merge(
+            lcd_ids, how='left', on=lcd_key_cols)[
+            'license_contact_details_id'].to_numpy()
+        batch.loc[~has_key, 'license_contact_details_id'] = None
+
+    @staticmethod
+    def is_equal(left, right):
+        """
+        :return: bool array, True where the two frames' rows are equal in
+                     every column, None equalling None
+        Called by: diff()
+        """
+        left_values = left.to_numpy(dtype=object)
+        right_values = right.to_numpy(dtype=object)
+        both_missing = pd.isna(left_values) & pd.isna(right_values)
+        return ((left_values == right_values) | both_missing).all(axis=1)
+
+    def diff(self, items, resolve_partner):
+        """
+        :param items: licenses from Marketplace
+        :param resolve_partner: as for make_batch_frame()
+        :return: DataFrame of the batch, one row per item in item order,
+                     with self.columns and
+                     'ix': the item's index into items
+                     'change': 'insert', 'update' or 'unchanged'
+                     'write': True for the row to write for each license
+                         id with an insert or update: its last occurrence
+        Called by: LoadLicenses.fill_licenses_by_diff()
+        """
+        batch = self.make_batch_frame(items, resolve_partner)
+        current = self.get_current_frame(batch['license_id'].unique())
+        self.resolve_keys(batch)
+        # a license keeps the organization load_organizations.py gave it
+        org_ids = dict(zip(current['license_id'], current['organizations_id']))
+        batch['organizations_id'] = batch['license_id'].map(org_ids)
+
+        batch = batch.sort_values(['license_id', 'ix'], kind='stable')
+        is_first = ~batch['license_id'].duplicated().to_numpy()
+        # each occurrence is compared with the row before it: for the
+        # first, the one in pn_licenses; for later ones, the one before
+        value_cols = self.columns[1:]
+        previous = batch.groupby('license_id', sort=False)[value_cols].shift(1)
+        from_db = batch[['license_id']].merge(current, how='left',
+                                              on='license_id')
+        previous.loc[is_first, value_cols] = \
+            from_db.loc[is_first, value_cols].to_numpy(dtype=object)
+        in_db = batch['license_id'].isin(current['license_id']).to_numpy()
+
+        is_insert = is_first & ~in_db
+        is_same = self.is_equal(batch[value_cols], previous[value_cols])
+        batch['change'] = np.where(is_insert, 'insert',
+                                   np.where(is_same, 'unchanged', 'update'))
+        is_written = batch['license_id'].isin(
+            batch.loc[batch['change'] != 'unchanged', 'license_id']).to_numpy()
+        is_last = ~batch['license_id'].duplicated(keep='last').to_numpy()
+        batch['write'] = is_written & is_last
+        return batch.sort_values('ix')
+
+    @staticmethod
+    def to_rows(frame, cur_time):
+        """
+        :return: list of tuples of frame's self.columns values, then
+                     cur_time, with None for missing values
+        Called by: write()
+        """
+        values = frame[LicenseDiff.columns].to_numpy(dtype=object)
+        values[pd.isna(values)] = None
+        return [tuple(row) + (cur_time,) for row in values.tolist()]
+
+    def write(self, batch, cur_time):
+        """
+        Insert and update the rows of batch marked 'write'
+        :param batch: as from diff()
+        :param cur_time: for pgres_last_updated
+        :return: (rows inserted, rows updated)
+        Called by: LoadLicenses.fill_licenses_by_diff()
+        """
+        counts = []
+        to_write = batch[batch['write']]
+        is_new = to_write['license_id'].isin(
+            batch.loc[batch['change'] == 'insert', 'license_id'])
+        for query, frame in ((self.insert_query, to_write[is_new]),
+                             (self.update_query, to_write[~is_new])):
+            rows = self.to_rows(frame, cur_time)
+            if not rows:
+                counts.append(0)
+                continue
+            # one page, so rowcount covers every row
+            execute_values(self.pn_cursor, query, rows, page_size=len(rows))
+            counts.append(self.pn_cursor.rowcount)
+        return tuple(counts)
@@ -13,6 +13,7 @@ import os
 import psycopg2
 import requests
 import datetime
+import time
 
 try:
     from src.time_string_conversion import get_now
@@ -24,6 +25,26 @@ try:
 except ModuleNotFoundError:
     from constants import BASE_URL, DEFAULT_DATE
 
+try:
+    from mktplc_export_lics.src.license_diff import LicenseDiff
+except ModuleNotFoundError:
+    from license_diff import LicenseDiff
+
+try:
+    from common.src.pg_stats import pg_stats, StatsConnection
+except ModuleNotFoundError:
+    from common.pg_stats import pg_stats, StatsConnection
+
+try:
+    from common.src.metrics import Metrics
+except ModuleNotFoundError:
+    from common.metrics import Metrics
+
+try:
+    from common.src.profiling import Profiler
+except ModuleNotFoundError:
+    from common.profiling import Profiler
+
 
 class LoadLicenses:
     """
@@ -38,6 +59,57 @@ class LoadLicenses:
     If a record returned from API is already present in the Postgres db,
     and is not identical to the record in Postgres, Postgres will be updated.
     """
+    # kept by reset_run_state(), for a resident caller such as scheduler.py
+    warm_attrs = ('sess', 'pg_pool')
+    # hot queries, also EXPLAINed by bench/check_query_plans.py
+    contact_id_query = 'SELECT id FROM pn_contacts WHERE email = %s;'
+    contact_query = 'SELECT * FROM pn_contacts WHERE email = %s;'
+    update_contact_query = ('UPDATE pn_contacts SET (email, ' +
+                            'addr_1, addr_2, city, ' +
+                            'name, phone, postcode, state, ' +
+                            'pgres_last_updated) = ' +
+                            '(%s, %s, %s, %s, %s, %s, %s, %s,' +
+                            '%s) WHERE email = %s;')
+    addons_id_query = 'SELECT id FROM pn_addons WHERE key = %s;'
+    partner_details_id_query = 'SELECT id FROM pn_partner_details WHERE name = %s;'
+    lcd_id_query = ('SELECT id FROM pn_license_contact_details WHERE (company, ' +
+                    'country, region) = (%s, %s, %s)')
+    lcd_query = ('SELECT * FROM ' +
+                 'pn_license_contact_details WHERE ' +
+                 '(company, country, region) = (%s, %s, %s);')
+    update_lcd_query = (
+        'UPDATE pn_license_contact_details SET (bill_contact_id, ' +
+        'tech_contact_id, pgres_last_updated) = (%s, %s, %s) WHERE' +
+        '(company, country, region) = (%s, %s, %s);'
+    )
+    organizations_id_query = ('SELECT organizations_id FROM pn_licenses WHERE ' +
+                              'license_id = %s;')
+    license_duplicate_query = (
+        'SELECT license_id, addons_id, ' +
+        'license_contact_details_id, ' +
+        'partner_details_id, organizations_id, addon_key, ' +
+        'hosting, host_license_id, last_updated::date, ' +
+        'license_type, maint_start_date::date,'
+        'maint_end_date::date, status, tier FROM pn_licenses ' +
+        'WHERE license_id = %s AND (license_id, ' +
+        'addons_id, license_contact_details_id, ' +
+        'partner_details_id, organizations_id, ' +
+        'addon_key, hosting, host_license_id, ' +
+        'last_updated::date, license_type, ' +
+        'maint_start_date::date, maint_end_date::date, ' +
+        'status, tier) IS NOT DISTINCT FROM ' +
+        '(%s, %s, %s, %s, %s, ' +
+        '%s, %s, %s, %s, %s, %s, %s, %s, %s);')
+    update_license_query = (
+        'UPDATE pn_licenses SET (license_id, ' +
+        'addons_id, license_contact_details_id, ' +
+        'partner_details_id, organizations_id, ' +
+        'addon_key, hosting, host_license_id, ' +
+        'last_updated, license_type, ' +
+        'maint_start_date, maint_end_date, ' +
+        'status, tier, pgres_last_updated) = (%s, %s, %s, ' +
+        '%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s) ' +
+        'WHERE license_id = %s;')
 
     def __init__(self, api_password=None, vendor_id=None, api_user=None,
                  db_password=None, base_url=BASE_URL,
@@ -74,6 +146,26 @@ class LoadLicenses:
         self.ct_update_lcd = 0
         self.ct_insert_license = 0
         self.ct_update_license = 0
+        self.max_retries = 4
+        self.backoff_secs = 5
+        self.sess = None  # requests session; if None, use a new connection
+        self.pg_pool = None  # psycopg2 pool; if None, connect per run
+        # if set, called with each chunk of (email, company) pairs as
+        # their licenses are committed
+        self.license_sink = None
+        self.sink_chunk_size = 200
+        self.enrich_feed = None  # file for licenses with new or changed lcds
+        self.sink_changed_only = False  # pass license_sink only those, too
+        self.changed_lcd_keys = set()  # (company, country, region)
+        self.license_diff = False  # reconcile pn_licenses with LicenseDiff
+        # resolved once per run, then reused for comparison, insert and update
+        self.contact_ids = {}  # email -> pn_contacts id
+        self.lcd_rows = {}  # ix -> lcd key as list
+        self.license_rows = {}  # ix -> license insert list
+        self.cache_stats = {'contact_ids': [0, 0], 'lcd_rows': [0, 0],
+                            'license_rows': [0, 0]}  # cache -> [hits, misses]
+        self.metrics = Metrics('load_licenses')
+        self.profiler = Profiler('load_licenses')
 
     def get_args(self, argv=None):
         """Get command line arguments"""
@@ -84,6 +176,14 @@ class LoadLicenses:
                             action='store_true')
         parser.add_argument('-o', '--outfile', type=str,
                             help='Send output to file OUTFILE.')
+        parser.add_argument('-u', '--base_url', type=str, default=None,
+                            help='Query the Marketplace API at BASE_URL, e.g. '
+                                 'a mock server.')
+        parser.add_argument('-e', '--enrich_feed', type=str, default=None,
+                            help='Also send to file ENRICH_FEED one license '
+                                 'for each license contact details item '
+                                 'inserted or updated by this run, as input '
+                                 'for load_organizations.py -i.')
         parser.add_argument('-m', '--modified_date', type=str,
                             default=None,
                             help='Retrieve only items altered on or '
@@ -92,11 +192,36 @@ class LoadLicenses:
                                  'Insert any items which have not been seen before. '
                                  'Update items whose key value '
                                  'already exists in the db, and which have been altered.')
+        parser.add_argument('-d', '--license_diff', action='store_true',
+                            help='Sort licenses into inserts, updates and '
+                                 'unchanged in one vectorized pass per '
+                                 'chunk, rather than with queries per '
+                                 'license.')
+        parser.add_argument('--pg_stats', type=int, default=None,
+                            metavar='TOP_N',
+                            help='at exit, print the TOP_N SQL statements by '
+                                 'total time, with call counts and rows')
+        parser.add_argument('--pg_stats_json', type=str, default=None,
+                            help='at exit, write the stats of every SQL '
+                                 'statement to PG_STATS_JSON')
+        parser.add_argument('--metrics_file', type=str, default=None,
+                            help='write phase timings and record counts to '
+                                 'METRICS_FILE (a .prom file in the '
+                                 'node_exporter textfile directory), during '
+                                 'and after the run')
+        Profiler.add_arguments(parser)
         args = parser.parse_args(argv)
+        pg_stats.report_at_exit(args.pg_stats, args.pg_stats_json)
+        self.metrics.textfile = args.metrics_file
+        self.profiler.set_from_args(args)
         self.outfile = args.outfile
+        self.enrich_feed = args.enrich_feed
+        self.license_diff = args.license_diff
         self.to_stdout = args.stdout
         self.modified_date = args.modified_date
         self.verbose = args.verbose
+        if args.base_url:
+            self.base_url = args.base_url
 
     def get_env_vars(self):
         """Check that environment variables have been set"""
@@ -116,14 +241,30 @@ class LoadLicenses:
     def get_licenses(self):
         """
         Get licenses from Marketplace API using the 'Export licenses' endpoint.
+        Retry on 429 and 5xx responses, waiting as long as a Retry-After
+            header asks, or else backing off exponentially.
         :return: JSON response
         Called by: main()
         """
         print('Querying Marketplace \'Export licenses\' endpoint...',
               file=sys.stderr)
         url, user, payload = self.get_request_args()
-        return requests.get(url, auth=(user, self.api_password),
-                            params=payload)
+        start = time.perf_counter()
+        for attempt in range(self.max_retries + 1):
+            response = (self.sess or requests).get(
+                url, auth=(user, self.api_password), params=payload)
+            if response.status_code != 429 and response.status_code < 500 \
+                    or attempt == self.max_retries:
+                break
+            delay = self.backoff_secs * 2 ** attempt
+            if response.headers.get('Retry-After', '').isdigit():
+                delay = int(response.headers['Retry-After'])
+            self.print_if_verbose('Marketplace returned {}: retrying in {} '
+                                  'secs'.format(response.status_code, delay),
+                                  file=sys.stderr)
+            time.sleep(delay)
+        self.metrics.observe('fetch', time.perf_counter() - start)
+        return response
 
     def get_request_args(self):
         """
@@ -162,7 +303,9 @@ class LoadLicenses:
         """
         num_retrieved = 0
         if mkt_response.ok:
+            start = time.perf_counter()
             curr_data = mkt_response.json()
+            self.metrics.observe('parse', time.perf_counter() - start)
             num_retrieved = len(curr_data)
             self.mkt_data.extend(curr_data)
             self.dump_data()
@@ -195,6 +338,53 @@ class LoadLicenses:
                       separators=(',', ': '))
             print(file=of)  # make output match that of dump_to_stdout()
 
+    def dump_enrich_feed(self):
+        """
+        Dump to self.enrich_feed the first license of each license contact
+            details item that this run inserted or updated, in the format of
+            dump_to_file(); the other licenses have nothing new for
+            LoadOrganizations
+        :return: None
+        Called by: store_licenses()
+        """
+        feed = []
+        lcd_keys_left = set(self.changed_lcd_keys)
+        for item in self.mkt_data:
+            if self.is_lcd_changed(item, lcd_keys_left):
+                lcd_keys_left.discard(self.get_item_lcd_key(item))
+                feed.append(item)
+        with open(self.enrich_feed, 'w') as of:
+            json.dump(feed, of, sort_keys=True, indent=4,
+                      separators=(',', ': '))
+            print(file=of)
+        self.print_if_verbose('{} of {} licenses sent to enrichment feed'.
+                              format(len(feed), len(self.mkt_data)),
+                              file=sys.stderr)
+
+    def is_lcd_changed(self, item, lcd_keys=None):
+        """
+        :param item: a license from Marketplace API
+        :param lcd_keys: set of lcd keys; default self.changed_lcd_keys
+        :return: True iff this run inserted or updated item's license
+                     contact details
+        Called by: dump_enrich_feed(), send_to_sink()
+        """
+        if lcd_keys is None:
+            lcd_keys = self.changed_lcd_keys
+        return self.get_item_lcd_key(item) in lcd_keys
+
+    @staticmethod
+    def get_item_lcd_key(item):
+        """
+        :param item: a license from Marketplace API
+        :return: the (company, country, region) key of its license
+                     contact details
+        Called by: dump_enrich_feed(), is_lcd_changed()
+        """
+        return (item['contactDetails']['company'],
+                item['contactDetails']['country'],
+                item['contactDetails']['region'])
+
     def dump_to_stdout(self):
         """
         Dump prettified JSON data to stdout
@@ -213,18 +403,27 @@ class LoadLicenses:
         self.print_if_verbose('Storing Marketplace license data in db...',
                               file=sys.stderr)
 
-        pn_conn_string = ("host = '{}' dbname = '{}' user = '{}' " +
-                          "password = '{}'").format(self.db_host, self.db_name,
-                                                    self.db_user,
-                                                    self.db_password)
-        pn_conn = psycopg2.connect(pn_conn_string)
+        if self.pg_pool:
+            pn_conn = self.pg_pool.getconn()
+        else:
+            pn_conn_string = ("host = '{}' dbname = '{}' user = '{}' " +
+                              "password = '{}'").format(self.db_host,
+                                                        self.db_name,
+                                                        self.db_user,
+                                                        self.db_password)
+            pn_conn = psycopg2.connect(pn_conn_string,
+                                       connection_factory=StatsConnection)
 
         # the following will let us tell if an item has already been seen
+        start = time.perf_counter()
         pn_cursor = pn_conn.cursor()
         self.get_primary_key_sets(pn_cursor)
         pn_cursor.close()
+        self.metrics.observe('key_sets', time.perf_counter() - start)
 
         self.fill_pn_tables(pn_conn)
+        if self.enrich_feed:
+            self.dump_enrich_feed()
 
     def fill_pn_tables(self, pn_conn):
         """
@@ -236,32 +435,115 @@ class LoadLicenses:
         :return: None
         Called by: store_licenses()
         """
+        start = time.perf_counter()
         pn_cursor = pn_conn.cursor()
         for ix in range(len(self.mkt_data)):
             self.get_billing_contact(pn_cursor, ix)
             self.get_technical_contact(pn_cursor, ix)
             self.get_addons_key(pn_cursor, ix)
             self.get_partner_details_key(pn_cursor, ix)
+            if self.metrics.is_due():
+                self.export_metrics()
         pn_conn.commit()
         pn_cursor.close()
+        self.metrics.observe('fill_contacts_addons_partners',
+                             time.perf_counter() - start)
 
         # Next load data for pn_license_contact_details.
+        start = time.perf_counter()
         pn_cursor = pn_conn.cursor()
         for ix in range(len(self.mkt_data)):
             self.get_lcd_key(pn_cursor, ix)
+            if self.metrics.is_due():
+                self.export_metrics()
         pn_conn.commit()
         pn_cursor.close()
+        self.metrics.observe('fill_license_contact_details',
+                             time.perf_counter() - start)
 
         # Finally load data for pn_licenses.
+        # With a license_sink, commit and hand on each chunk as it is done.
+        start = time.perf_counter()
         pn_cursor = pn_conn.cursor()
-        for ix in range(len(self.mkt_data)):
-            self.get_license_id(pn_cursor, ix)
-        pn_conn.commit()
+        if self.license_diff:
+            self.fill_licenses_by_diff(pn_conn, pn_cursor)
+        else:
+            chunk_start = 0
+            for ix in range(len(self.mkt_data)):
+                self.get_license_id(pn_cursor, ix)
+                if self.license_sink and \
+                        ix + 1 - chunk_start == self.sink_chunk_size:
+                    pn_conn.commit()
+                    self.send_to_sink(chunk_start, ix + 1)
+                    chunk_start = ix + 1
+                if self.metrics.is_due():
+                    self.export_metrics()
+            pn_conn.commit()
+            if self.license_sink and chunk_start < len(self.mkt_data):
+                self.send_to_sink(chunk_start, len(self.mkt_data))
         pn_cursor.close()
+        self.metrics.observe('fill_licenses', time.perf_counter() - start)
 
-        pn_conn.close()
+        if self.pg_pool:
+            self.pg_pool.putconn(pn_conn)
+        else:
+            pn_conn.close()
         self.print_if_verbose('License data stored', file=sys.stderr)
 
+    def fill_licenses_by_diff(self, pn_conn, pn_cursor):
+        """
+        Load pn_licenses a chunk at a time, each chunk sorted into inserts,
+            updates and unchanged licenses by LicenseDiff in one pass.
+            Chunks are self.sink_chunk_size licenses with a license_sink,
+            else the whole run.
+        :param pn_conn: conn to Postgre db
+        :param pn_cursor: on pn_conn
+        :return: None
+        Called by: fill_pn_tables()
+        """
+        license_diff = LicenseDiff(pn_cursor)
+        chunk_size = self.sink_chunk_size if self.license_sink else \
+            max(len(self.mkt_data), 1)
+        for chunk_start in range(0, len(self.mkt_data), chunk_size):
+            chunk_stop = min(chunk_start + chunk_size, len(self.mkt_data))
+            batch = license_diff.diff(
+                self.mkt_data[chunk_start:chunk_stop],
+                lambda ix: self.get_partner_details_id(
+                    pn_cursor, chunk_start + ix, self.mkt_data))
+            ct_inserted, ct_updated = license_diff.write(batch, self.cur_time)
+            changes = batch['change'].value_counts()
+            if ct_inserted + ct_updated != batch['write'].sum():
+                self.print_if_verbose('ERROR WRITING LICENSE CHANGES: {} '
+                                      'rows written of {}'.
+                                      format(ct_inserted + ct_updated,
+                                             batch['write'].sum()))
+            self.ct_insert_license += int(changes.get('insert', 0))
+            self.ct_update_license += int(changes.get('update', 0))
+            self.license_key_set.update(
+                batch.loc[batch['change'] == 'insert', 'license_id'])
+            pn_conn.commit()
+            if self.license_sink:
+                self.send_to_sink(chunk_start, chunk_stop)
+            if self.metrics.is_due():
+                self.export_metrics()
+
+    def send_to_sink(self, start, stop):
+        """
+        Pass the (tech contact email, company) pairs of a run of
+            committed licenses to self.license_sink; nothing, if there are
+            none (e.g. with sink_changed_only, when no lcd changed)
+        :param start: index into self.mkt_data of the first license
+        :param stop: index of the one after the last
+        :return: None
+        Called by: fill_pn_tables(), fill_licenses_by_diff()
+        """
+        pairs = [(item['contactDetails']['technicalContact']['email'],
+                  item['contactDetails']['company'])
+                 for item in self.mkt_data[start:stop]
+                 if not self.sink_changed_only or self.is_lcd_changed(item)]
+        if pairs:
+            self.license_sink(pairs)
+
     def get_primary_key_sets(self, pn_cursor):
         """
         Get a set of primary key values from each table.
@@ -359,17 +641,10 @@ class LoadLicenses:
         :return: None
         Called by: get_billing_contact()
         """
-        update_query = ('UPDATE pn_contacts SET (email, ' +
-                        'addr_1, addr_2, city, ' +
-                        'name, phone, postcode, state, ' +
-                        'pgres_last_updated) = ' +
-                        '(%s, %s, %s, %s, %s, %s, %s, %s,' +
-                        '%s) WHERE email = %s;')
-
         update_data = self.make_contact_update_list(
             self.mkt_data[ix]['contactDetails']['billingContact'])
         data = tuple(update_data)
-        pn_cursor.execute(update_query, data)
+        pn_cursor.execute(self.update_contact_query, data)
         rowcount = pn_cursor.rowcount
         if rowcount != 1:
             self.print_if_verbose('ERROR EXECUTING BILL CONTACT UPDATE QUERY')
@@ -435,16 +710,9 @@ class LoadLicenses:
         :param ix: into license data retrieved from Marketplace API
         :return: None
         """
-        update_query = ('UPDATE pn_contacts SET (email, ' +
-                        'addr_1, addr_2, city, ' +
-                        'name, phone, postcode, state, ' +
-                        'pgres_last_updated) = ' +
-                        '(%s, %s, %s, %s, %s, %s, %s, %s,' +
-                        '%s) WHERE email = %s;')
-
         update_data = tuple(self.make_contact_update_list(self.mkt_data[ix]['contactDetails']
                                                      ['technicalContact']))
-        pn_cursor.execute(update_query, update_data)
+        pn_cursor.execute(self.update_contact_query, update_data)
         rowcount = pn_cursor.rowcount
         if rowcount != 1:
             self.print_if_verbose('ERROR EXECUTING TECH CONTACT UPDATE QUERY')
@@ -626,6 +894,7 @@ class LoadLicenses:
         else:
             self.print_if_verbose('INSERT LICENSE CONTACT DETAILS QUERY EXECUTED SUCCESSFULLY')
             self.lcd_key_set.add(lcd_key[:3])
+            self.changed_lcd_keys.add(lcd_key[:3])
             self.ct_insert_lcd += 1
 
     def update_lcd(self, pn_cursor, lcd_key):
@@ -636,55 +905,69 @@ class LoadLicenses:
         :return: None
         Called by: get_lcd_key()
         """
-        update_lcd_query = (
-            'UPDATE pn_license_contact_details SET (bill_contact_id, ' +
-            'tech_contact_id, pgres_last_updated) = (%s, %s, %s) WHERE' +
-            '(company, country, region) = (%s, %s, %s);'
-        )
-
         update_lcd_data = lcd_key[3:5] + tuple([self.cur_time]) + lcd_key[:3]
 
-        pn_cursor.execute(update_lcd_query, update_lcd_data)
+        pn_cursor.execute(self.update_lcd_query, update_lcd_data)
         rowcount = pn_cursor.rowcount
         if rowcount != 1:
             self.print_if_verbose('ERROR EXECUTING UPDATE LICENSE CONTACT DETAILS QUERY')
         else:
             self.print_if_verbose('UPDATE LICENSE CONTACT DETAILS QUERY EXECUTED SUCCESSFULLY')
             self.lcd_key_set.add(lcd_key[:3])
+            self.changed_lcd_keys.add(lcd_key[:3])
             self.ct_update_lcd += 1
 
     def build_lcd_key_as_list(self, pn_cursor, ix):
         """
-
+        Resolved once per run for each item, then taken from self.lcd_rows
         :param pn_cursor: on conn to Postgre db
         :param ix: into license data retrieved from Marketplace API
         :return: lcd key as list
+        Called by: get_lcd_key(), make_lcd_insert_list()
         """
+        stats = self.cache_stats['lcd_rows']
+        if ix in self.lcd_rows:
+            stats[0] += 1
+            return list(self.lcd_rows[ix])
+        stats[1] += 1
         lcd_key_as_list = [
             self.mkt_data[ix]['contactDetails']['company'],
             self.mkt_data[ix]['contactDetails']['country'],
             self.mkt_data[ix]['contactDetails']['region']]
 
-        id_query = 'SELECT id FROM pn_contacts WHERE email = %s;'
-
         if self.mkt_data[ix]['contactDetails'].get('billingContact'):
             bill_email = self.mkt_data[ix]['contactDetails']['billingContact'].get('email')
             if bill_email:
-                bill_id_data = bill_email
-                pn_cursor.execute(id_query, (bill_id_data,))
-                rslt = pn_cursor.fetchone()[0]
-                lcd_key_as_list.append(rslt)
+                lcd_key_as_list.append(self.get_contact_id(pn_cursor,
+                                                           bill_email))
             else:
                 lcd_key_as_list.append(None)
         else:
             lcd_key_as_list.append(None)
 
         tech_email = self.mkt_data[ix]['contactDetails']['technicalContact']['email']
-        tech_id_data = tech_email
-        pn_cursor.execute(id_query, (tech_id_data,))
-        rslt = pn_cursor.fetchone()[0]
-        lcd_key_as_list.append(rslt)
-        return lcd_key_as_list
+        lcd_key_as_list.append(self.get_contact_id(pn_cursor, tech_email))
+        self.lcd_rows[ix] = lcd_key_as_list
+        return list(lcd_key_as_list)
+
+    def get_contact_id(self, pn_cursor, email):
+        """
+        Contacts are all stored before any lcd, and keep their ids, so
+            each email is looked up once per run
+        :param pn_cursor: on conn to Postgre db
+        :param email: of a contact in pn_contacts
+        :return: its id
+        Called by: build_lcd_key_as_list()
+        """
+        stats = self.cache_stats['contact_ids']
+        if email in self.contact_ids:
+            stats[0] += 1
+            return self.contact_ids[email]
+        stats[1] += 1
+        pn_cursor.execute(self.contact_id_query, (email,))
+        contact_id = pn_cursor.fetchone()[0]
+        self.contact_ids[email] = contact_id
+        return contact_id
 
     # =================
 
@@ -731,21 +1014,11 @@ class LoadLicenses:
             self.ct_insert_license += 1
 
     def update_license(self, pn_cursor, ix):
-        update_license_id_query = \
-            ('UPDATE pn_licenses SET (license_id, ' +
-             'addons_id, license_contact_details_id, ' +
-             'partner_details_id, organizations_id, ' +
-             'addon_key, hosting, host_license_id, ' +
-             'last_updated, license_type, ' +
-             'maint_start_date, maint_end_date, ' +
-             'status, tier, pgres_last_updated) = (%s, %s, %s, ' +
-             '%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s) ' +
-             'WHERE license_id = %s;')
         update_license_id_list = self.make_license_id_update_list(
             self.mkt_data, pn_cursor, ix)
         # update_license_id_list.append(self.mkt_data[ix]['licenseId'])
         update_license_id_data = tuple(update_license_id_list)
-        pn_cursor.execute(update_license_id_query, update_license_id_data)
+        pn_cursor.execute(self.update_license_query, update_license_id_data)
         rowcount = pn_cursor.rowcount
         if rowcount != 1:
             self.print_if_verbose('ERROR EXECUTING UPDATE LICENSE ID QUERY')
@@ -805,31 +1078,11 @@ class LoadLicenses:
 
         :param pn_cursor: on conn to Postgre db
         :param ix: into license data retrieved from Marketplace API
-        :return:
+        :return: the lcd key, as resolved by build_lcd_key_as_list(), and
+                     cur_time
+        Called by: is_lcd_item_duplicate()
         """
-        output_list = [self.mkt_data[ix]['contactDetails']['company'],
-                       self.mkt_data[ix]['contactDetails']['country'],
-                       self.mkt_data[ix]['contactDetails']['region']]
-
-        query = 'SELECT id FROM pn_contacts WHERE email = %s;'
-
-        if self.mkt_data[ix]['contactDetails'].get('billingContact') and \
-                self.mkt_data[ix]['contactDetails']['billingContact'].get('email'):
-            data = self.mkt_data[ix]['contactDetails']['billingContact']['email']
-            data_tuple = tuple([data])
-            pn_cursor.execute(query, data_tuple)
-            rslt = pn_cursor.fetchone()
-            output_list.append(rslt[0])
-        else:
-            output_list.append(None)
-
-        query = 'SELECT id FROM pn_contacts WHERE email = %s;'
-        data = self.mkt_data[ix]['contactDetails']['technicalContact']['email']
-        data_tuple = tuple([data])
-        pn_cursor.execute(query, data_tuple)
-        rslt = pn_cursor.fetchone()
-        output_list.append(rslt[0])
-
+        output_list = self.build_lcd_key_as_list(pn_cursor, ix)
         output_list.append(self.cur_time)
 
         return output_list
@@ -850,11 +1103,21 @@ class LoadLicenses:
     def make_license_id_insert_list(self, mkt_input_dict, pn_cursor, ix):
         """
 
+        Resolved once per run for each item of self.mkt_data, then taken
+            from self.license_rows, as the duplicate check and the update
+            of an existing license both need it
         :param mkt_input_dict:
         :param pn_cursor: on conn to Postgre db
         :param ix: into license data retrieved from Marketplace API
         :return:
-        """
+        Called by: insert_license(), make_license_id_update_list(),
+                   is_license_id_item_duplicate()
+        """
+        is_cached = mkt_input_dict is self.mkt_data
+        stats = self.cache_stats['license_rows']
+        if is_cached and ix in self.license_rows:
+            stats[0] += 1
+            return list(self.license_rows[ix])
         output = [mkt_input_dict[ix]['licenseId'],
                   self.get_addons_id(pn_cursor, ix, mkt_input_dict),
                   self.get_lcd_id(pn_cursor, ix, mkt_input_dict),
@@ -870,6 +1133,10 @@ class LoadLicenses:
                   mkt_input_dict[ix]['maintenanceEndDate'],
                   mkt_input_dict[ix]['status'],
                   mkt_input_dict[ix]['tier'], self.cur_time]
+        if is_cached:
+            stats[1] += 1
+            self.license_rows[ix] = output
+            return list(output)
         return output
 
     def make_license_id_update_list(self, mkt_input_dict, pn_cursor, ix):
@@ -893,10 +1160,9 @@ class LoadLicenses:
         :param pn_cursor: on conn to Postgre db
         :return:
         """
-        query = 'SELECT id FROM pn_contacts WHERE email = %s'
         if contact:
             data = contact['email']
-            pn_cursor.execute(query, (data,))
+            pn_cursor.execute(LoadLicenses.contact_id_query, (data,))
             contact_id = pn_cursor.fetchone()[0]
             return contact_id
         else:
@@ -911,9 +1177,8 @@ class LoadLicenses:
         :param mkt_input_dict:
         :return:
         """
-        query = 'SELECT id FROM pn_addons WHERE key = %s;'
         data = mkt_input_dict[ix]['addonKey']
-        pn_cursor.execute(query, (data,))
+        pn_cursor.execute(LoadLicenses.addons_id_query, (data,))
         addons_id = pn_cursor.fetchone()[0]
         return addons_id
 
@@ -930,9 +1195,7 @@ class LoadLicenses:
                 mkt_input_dict[ix]['contactDetails'].get('country', None),
                 mkt_input_dict[ix]['contactDetails'].get('region', None))
         if all(data):
-            query = ('SELECT id FROM pn_license_contact_details WHERE (company, ' +
-                     'country, region) = (%s, %s, %s)')
-            pn_cursor.execute(query, data)
+            pn_cursor.execute(LoadLicenses.lcd_id_query, data)
             lcd_id = pn_cursor.fetchone()[0]
             return lcd_id
         else:
@@ -949,8 +1212,7 @@ class LoadLicenses:
         data = (mkt_input_dict[ix].get('partnerName', None))
         if data and all(data):
             self.print_if_verbose('**** have partner name ****')
-            query = 'SELECT id FROM pn_partner_details WHERE name = %s;'
-            pn_cursor.execute(query, (data,))
+            pn_cursor.execute(self.partner_details_id_query, (data,))
             result = pn_cursor.fetchone()
             if result:
                 partner_details_id = pn_cursor.fetchone()[0]
@@ -969,10 +1231,8 @@ class LoadLicenses:
         :param mkt_input_dict:
         :return:
         """
-        query = ('SELECT organizations_id FROM pn_licenses WHERE ' +
-                 'license_id = %s;')
         data = tuple([mkt_input_dict[ix]['licenseId']])
-        pn_cursor.execute(query, data)
+        pn_cursor.execute(LoadLicenses.organizations_id_query, data)
         result = pn_cursor.fetchone()
         if result:
             return result[0]
@@ -1000,9 +1260,8 @@ class LoadLicenses:
                                                              ['contactDetails']
                                                              ['billingContact'])
         mkt_contact_data_tuple = tuple(mkt_contact_data)
-        query = 'SELECT * FROM pn_contacts WHERE email = %s;'
         data = mkt_contact_data[0]
-        pn_cursor.execute(query, (data,))
+        pn_cursor.execute(self.contact_query, (data,))
         pn_cursor_result = pn_cursor.fetchone()
         return pn_cursor_result[1:9] == mkt_contact_data_tuple[:8]
 
@@ -1046,10 +1305,7 @@ class LoadLicenses:
         """
         self.lcd_data = self.make_lcd_insert_list(pn_cursor, ix)
         lcd_tuple = tuple(self.lcd_data)
-        query = ('SELECT * FROM ' +
-                 'pn_license_contact_details WHERE ' +
-                 '(company, country, region) = (%s, %s, %s);')
-        pn_cursor.execute(query, lcd_tuple[:3])
+        pn_cursor.execute(self.lcd_query, lcd_tuple[:3])
         pn_cursor_result = pn_cursor.fetchone()
         if pn_cursor_result[1:6] != lcd_tuple[:5]:
             self.print_if_verbose('**** NOT SAME ****' * 5)
@@ -1069,28 +1325,26 @@ class LoadLicenses:
         )
         license_data_dates = license_data[:14]
         license_data_tuple = tuple(license_data_dates)
-        query01 = ('SELECT license_id, addons_id, ' +
-                   'license_contact_details_id, ' +
-                   'partner_details_id, organizations_id, addon_key, ' +
-                   'hosting, host_license_id, last_updated::date, ' +
-                   'license_type, maint_start_date::date,'
-                   'maint_end_date::date, status, tier FROM pn_licenses ' +
-                   'WHERE (license_id, ' +
-                   'addons_id, license_contact_details_id, ' +
-                   'partner_details_id, organizations_id, ' +
-                   'addon_key, hosting, host_license_id, ' +
-                   'last_updated::date, license_type, ' +
-                   'maint_start_date::date, maint_end_date::date, ' +
-                   'status, tier) IS NOT DISTINCT FROM ' +
-                   '(%s, %s, %s, %s, %s, ' +
-                   '%s, %s, %s, %s, %s, %s, %s, %s, %s);')
-        pn_cursor.execute(query01, license_data_tuple)
+        # license_id = %s lets the license_id index find the row
+        pn_cursor.execute(self.license_duplicate_query,
+                          license_data_tuple[:1] + license_data_tuple)
         pn_cursor_result = pn_cursor.fetchone()
         if not pn_cursor_result:
             return False
         pn_cursor_result_w_dates = self.datetimes_to_dates_list(pn_cursor_result)
         return tuple(pn_cursor_result_w_dates) == license_data_tuple
 
+    def reset_run_state(self):
+        """
+        Forget the last run's licenses, key sets and counts, and restamp
+            cur_time, while keeping the attributes in warm_attrs
+        :return: None
+        Called by: Scheduler.run_licenses()
+        """
+        warm = {name: getattr(self, name) for name in self.warm_attrs}
+        self.__init__()
+        self.__dict__.update(warm)
+
     @staticmethod
     def datetimes_to_dates_list(sequence):
         w_dates = []
@@ -1099,6 +1353,32 @@ class LoadLicenses:
                            else item.strftime('%Y-%m-%d'))
         return w_dates
 
+    def export_metrics(self, finished=False):
+        """
+        Write the run's phase timings, record counts and cache hit rates to
+            the metrics file
+        :param finished: if True, the run is over
+        :return: None
+        Called by: fill_pn_tables(), output_stats()
+        """
+        self.metrics.set_records({
+            'licenses_read': len(self.mkt_data),
+            'bill_contact_inserts': self.ct_insert_bill_contacts,
+            'bill_contact_updates': self.ct_update_bill_contacts,
+            'tech_contact_inserts': self.ct_insert_tech_contacts,
+            'tech_contact_updates': self.ct_update_tech_contacts,
+            'addon_inserts': self.ct_insert_addons,
+            'addon_updates': self.ct_update_addons,
+            'partner_details_inserts': self.ct_insert_partner_det,
+            'partner_details_updates': self.ct_update_partner_det,
+            'lcd_inserts': self.ct_insert_lcd,
+            'lcd_updates': self.ct_update_lcd,
+            'license_inserts': self.ct_insert_license,
+            'license_updates': self.ct_update_license})
+        for cache, (hits, misses) in self.cache_stats.items():
+            self.metrics.set_cache(cache, hits, misses)
+        self.metrics.write(finished)
+
     def output_stats(self):
         print(self.ct_insert_bill_contacts, 'bill ct inserts')
         print(self.ct_update_bill_contacts, 'bill ct updates')
@@ -1112,13 +1392,17 @@ class LoadLicenses:
         print(self.ct_update_lcd, 'lcd updates')
         print(self.ct_insert_license, 'license inserts')
         print(self.ct_update_license, 'license updates')
+        self.export_metrics(finished=True)
 
     def main(self):
         self.get_args()
         self.get_env_vars()
-        mkt_response = self.get_licenses()
-        self.handle_mkt_response(mkt_response)
-        self.store_licenses()
+        with self.profiler.phase('fetch'):
+            mkt_response = self.get_licenses()
+        with self.profiler.phase('parse'):
+            self.handle_mkt_response(mkt_response)
+        with self.profiler.phase('store'):
+            self.store_licenses()
         self.output_stats()
 
 
@@ -0,0 +1,217 @@
+# file: fake_data.py
+
+import datetime
+import random
+
+
+class FakeData:
+    """
+    Deterministic fake Marketplace licenses and Crunchbase organizations,
+    shaped like the responses of the 'Export licenses' and
+    '/odm-organizations' endpoints. The same seed always gives the same
+    records, so a mock server and a benchmark can agree on them.
+    Ratios: isp_ratio of the tech contacts use an ISP domain; duplicate_ratio
+    of an export's records repeat an earlier record of the same export; in
+    each run after the first (run=1, 2, ...), update_ratio of the licenses
+    change.
+    """
+    words = ['acme', 'globex', 'initech', 'umbrella', 'hooli', 'stark',
+             'wayne', 'wonka', 'cyberdyne', 'tyrell', 'soylent', 'vandelay',
+             'pied', 'piper', 'aperture', 'black', 'mesa', 'oscorp', 'gringotts',
+             'monarch', 'dunder', 'mifflin', 'nakatomi', 'weyland', 'yutani',
+             'blue', 'sun', 'bright', 'north', 'river', 'stone', 'cloud',
+             'data', 'logic', 'works', 'systems', 'labs', 'digital', 'soft']
+    suffixes = ['', '', '', ' Inc', ' LLC', ' Ltd', ' GmbH', ' Corp']
+    tlds = ['com', 'com', 'com', 'io', 'net', 'org', 'co.uk', 'de']
+    isp_domains = ['gmail.com', 'yahoo.com', 'hotmail.com', 'outlook.com',
+                   'aol.com', 'comcast.net']
+    countries = [('United States', 'CA'), ('United States', 'NY'),
+                 ('Germany', 'Berlin'), ('United Kingdom', 'London'),
+                 ('France', 'Ile-de-France'), ('Japan', 'Tokyo')]
+    addons = [('com.example.addon-{}'.format(ix), 'Example Add-on {}'.format(ix))
+              for ix in range(20)]
+
+    def __init__(self, seed=0, ct_companies=1000, isp_ratio=0.2,
+                 cb_hit_ratio=0.7, duplicate_ratio=0.0, update_ratio=0.0):
+        self.seed = seed
+        self.ct_companies = ct_companies
+        self.isp_ratio = isp_ratio
+        self.cb_hit_ratio = cb_hit_ratio
+        self.duplicate_ratio = duplicate_ratio
+        self.update_ratio = update_ratio
+
+    def company(self, company_ix):
+        """
+        :param company_ix: 0 <= company_ix < self.ct_companies
+        :return: (company name, company domain)
+        Called by: license(), organizations_for_domain(),
+                   organizations_for_name()
+        """
+        rng = random.Random('{}-company-{}'.format(self.seed, company_ix))
+        name_words = rng.sample(self.words, rng.randint(1, 2))
+        stem = ''.join(name_words) + str(company_ix)
+        name = ' '.join(word.title() for word in name_words) + \
+            ' {}'.format(company_ix) + rng.choice(self.suffixes)
+        return name, '{}.{}'.format(stem, rng.choice(self.tlds))
+
+    def contact(self, rng, domain):
+        first = rng.choice(['ann', 'bob', 'cy', 'dee', 'eve', 'fay', 'gus'])
+        last = rng.choice(['ng', 'ortiz', 'park', 'quinn', 'roy', 'shah'])
+        return {'email': '{}.{}{}@{}'.format(first, last, rng.randint(1, 999),
+                                             domain),
+                'name': '{} {}'.format(first.title(), last.title()),
+                'address1': '{} Main St'.format(rng.randint(1, 999)),
+                'city': rng.choice(['Springfield', 'Shelbyville', 'Ogdenville']),
+                'phone': '555-{:04d}'.format(rng.randint(0, 9999)),
+                'postcode': '{:05d}'.format(rng.randint(0, 99999)),
+                'state': rng.choice(['CA', 'NY', 'TX'])}
+
+    def license(self, license_ix, version=0):
+        """
+        One license as returned by the 'Export licenses' endpoint
+        :param license_ix: which license
+        :param version: bump to get the same license with changed values
+        :return: the license dict
+        Called by: licenses()
+        """
+        rng = random.Random('{}-license-{}'.format(self.seed, license_ix))
+        company_ix = rng.randrange(self.ct_companies)
+        company, domain = self.company(company_ix)
+        crng = random.Random('{}-contact-{}'.format(self.seed, company_ix))
+        if rng.random() < self.isp_ratio:
+            domain = rng.choice(self.isp_domains)
+        tech_contact = self.contact(crng, domain)
+        country, region = self.countries[company_ix % len(self.countries)]
+        addon_key, addon_name = rng.choice(self.addons)
+        start = datetime.date(2017, 1, 1) + \
+            datetime.timedelta(days=rng.randrange(365))
+        end = start + datetime.timedelta(days=rng.choice([30, 365]) + version)
+        item = {'licenseId': 'SEN-L{}'.format(1000000 + license_ix),
+                'addonKey': addon_key,
+                'addonName': addon_name,
+                'hosting': rng.choice(['Server', 'Cloud', 'Data Center']),
+                'lastUpdated': (end - datetime.timedelta(days=7)).isoformat(),
+                'licenseType': rng.choice(['COMMERCIAL', 'EVALUATION',
+                                           'ACADEMIC']),
+                'maintenanceStartDate': start.isoformat(),
+                'maintenanceEndDate': end.isoformat(),
+                'status': rng.choice(['active', 'active', 'inactive']),
+                'tier': rng.choice(['10 Users', '25 Users', 'Unlimited Users']),
+                'contactDetails': {'company': company,
+                                   'country': country,
+                                   'region': region,
+                                   'technicalContact': tech_contact}}
+        if rng.random() < 0.5:
+            item['contactDetails']['billingContact'] = self.contact(crng, domain)
+        if rng.random() < 0.1:
+            item['partnerDetails'] = {'partnerName': 'Partner {}'.format(
+                                          rng.randrange(10)),
+                                      'partnerType': 'EXPERT',
+                                      'billingContact': self.contact(
+                                          rng, 'partner.example.com')}
+        return item
+
+    def licenses(self, ct_licenses, start_ix=0, run=0):
+        """
+        An export of ct_licenses records, duplicates included
+        :param start_ix: index of the first license
+        :param run: which run's export; each license is as it was when it
+                        last changed, at or before this run
+        :return: list of ct_licenses licenses
+        Called by: client code
+        """
+        items = []
+        license_ix = start_ix
+        for position in range(ct_licenses):
+            rng = random.Random('{}-export-{}-{}'.format(self.seed, start_ix,
+                                                         position))
+            if items and rng.random() < self.duplicate_ratio:
+                items.append(dict(items[rng.randrange(len(items))]))
+            else:
+                items.append(self.license(license_ix,
+                                          self.last_changed(license_ix, run)))
+                license_ix += 1
+        return items
+
+    def last_changed(self, license_ix, run):
+        """
+        :return: the last run, no later than run, in which the license
+                     changed; 0 if none did
+        Called by: licenses()
+        """
+        for version in range(run, 0, -1):
+            rng = random.Random('{}-update-{}-{}'.format(self.seed, license_ix,
+                                                         version))
+            if rng.random() < self.update_ratio:
+                return version
+        return 0
+
+    def organization(self, company_ix):
+        """
+        One '/odm-organizations' response item
+        Called by: organizations_for_domain(), organizations_for_name()
+        """
+        name, domain = self.company(company_ix)
+        return {'type': 'OrganizationSummary',
+                'uuid': '{:032x}'.format(company_ix),
+                'properties': {'name': name,
+                               'primary_role': 'company',
+                               'short_description': '{} makes things.'.
+                                                    format(name),
+                               'domain': domain,
+                               'homepage_url': 'http://www.{}'.format(domain),
+                               'facebook_url': None,
+                               'twitter_url': None,
+                               'linkedin_url': None,
+                               'api_url': 'https://api.crunchbase.com/v3.1/'
+                                          'organizations/{}'.format(company_ix),
+                               'city_name': 'Springfield',
+                               'region_name': None,
+                               'country_code': 'USA',
+                               'stock_exchange': None,
+                               'stock_symbol': None,
+                               'created_at': 1400000000 + company_ix,
+                               'updated_at': 1500000000 + company_ix}}
+
+    def is_known_to_cb(self, company_ix):
+        rng = random.Random('{}-cb-{}'.format(self.seed, company_ix))
+        return rng.random() < self.cb_hit_ratio
+
+    def company_ix_from_domain(self, domain):
+        """
+        Recover the company index from a domain made by company()
+        :return: the index, or None
+        """
+        stem = (domain or '').split('.')[0]
+        digits = len(stem) - len(stem.rstrip('0123456789'))
+        if not digits:
+            return None
+        company_ix = int(stem[-digits:])
+        if company_ix >= self.ct_companies or \
+                self.company(company_ix)[1] != domain:
+            return None
+        return company_ix
+
+    def organizations_for_domain(self, domain):
+        """
+        :return: the response items a 'domain_name' query would find
+        Called by: the mock Crunchbase server
+        """
+        company_ix = self.company_ix_from_domain(domain)
+        if company_ix is None or not self.is_known_to_cb(company_ix):
+            return []
+        return [self.organization(company_ix)]
+
+    def organizations_for_name(self, name):
+        """
+        :return: the response items a 'name' query would find
+        Called by: the mock Crunchbase server
+        """
+        words = (name or '').split()
+        for word in reversed(words):
+            if word.isdigit() and int(word) < self.ct_companies:
+                company_ix = int(word)
+                if self.company(company_ix)[0] == name and \
+                        self.is_known_to_cb(company_ix):
+                    return [self.organization(company_ix)]
+        return []
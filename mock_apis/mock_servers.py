@@ -0,0 +1,447 @@
+#!/usr/bin/env python3.6
+
+
+# file: mock_servers.py
+
+import sys
+import argparse
+import io
+import json
+import tarfile
+import random
+import re
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import urlparse, parse_qs
+
+try:
+    from mock_apis.src.fake_data import FakeData
+except ModuleNotFoundError:
+    from fake_data import FakeData
+
+
+class FaultInjector:
+    """
+    Latency, error and rate-limit behaviour shared by the mock endpoints.
+    Latency is drawn per request from:
+        'fixed:MS', 'uniform:LO_MS,HI_MS' or 'lognormal:MEDIAN_MS,SIGMA'
+    """
+    def __init__(self, latency='fixed:0', error_rate=0.0, throttle_rate=0.0,
+                 rate_limit=0, rate_window=60.0, seed=0):
+        self.latency_kind, self.latency_args = self.parse_latency(latency)
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.rate_limit = rate_limit  # requests per rate_window; 0: no limit
+        self.rate_window = rate_window
+        self.rng = random.Random(seed)
+        self.request_times = deque()
+        self.lock = threading.Lock()
+        self.ct_requests = 0
+        self.ct_errors = 0
+        self.ct_throttled = 0
+
+    @staticmethod
+    def parse_latency(spec):
+        kind, _, args = spec.partition(':')
+        if kind not in ('fixed', 'uniform', 'lognormal'):
+            raise ValueError('bad latency spec {}'.format(spec))
+        return kind, [float(arg) for arg in args.split(',') if arg]
+
+    def draw_latency(self):
+        """:return: seconds to sleep before responding"""
+        if self.latency_kind == 'fixed':
+            millis = self.latency_args[0] if self.latency_args else 0
+        elif self.latency_kind == 'uniform':
+            millis = self.rng.uniform(*self.latency_args[:2])
+        else:
+            median, sigma = self.latency_args[:2]
+            millis = self.rng.lognormvariate(0, sigma) * median
+        return millis / 1000
+
+    def check(self):
+        """
+        Decide the fate of one request
+        :return: (status code to send, seconds to delay, Retry-After secs)
+                     where the status is 200, 429 or 500
+        Called by: MockHandler.send_mock_response()
+        """
+        with self.lock:
+            self.ct_requests += 1
+            delay = self.draw_latency()
+            now = time.time()
+            while self.request_times and \
+                    self.request_times[0] <= now - self.rate_window:
+                self.request_times.popleft()
+            if self.rate_limit and len(self.request_times) >= self.rate_limit:
+                self.ct_throttled += 1
+                # until the oldest request leaves the window
+                return 429, delay, max(1, int(self.request_times[0] +
+                                              self.rate_window - now) + 1)
+            self.request_times.append(now)
+            roll = self.rng.random()
+            if roll < self.throttle_rate:
+                self.ct_throttled += 1
+                return 429, delay, 1
+            if roll < self.throttle_rate + self.error_rate:
+                self.ct_errors += 1
+                return 500, delay, None
+            return 200, delay, None
+
+
+class MockMailChimp:
+    """
+    In-memory MailChimp lists: batch subscribe ('POST lists/{list_id}') and
+    batch operations ('POST batches', 'GET batches/{batch_id}', and the
+    gzipped tar of results at each batch's response_body_url)
+    """
+    def __init__(self, batch_secs=1.0, member_error_rate=0.0, seed=0):
+        self.batch_secs = batch_secs  # time a batch takes to finish
+        self.member_error_rate = member_error_rate  # share of members refused
+        self.rng = random.Random(seed)
+        self.lists = {}  # list id -> {email: member}
+        self.batches = {}  # batch id -> batch dict
+        self.archives = {}  # batch id -> archive bytes
+        self.lock = threading.Lock()
+
+    def update_members(self, list_id, body):
+        """
+        :param list_id: created on first use
+        :param body: {'members': [...], 'update_existing': bool}
+        :return: the batch subscribe response
+        """
+        response = {'new_members': [], 'updated_members': [], 'errors': [],
+                    'total_created': 0, 'total_updated': 0, 'error_count': 0}
+        with self.lock:
+            members = self.lists.setdefault(list_id, {})
+            for member in body.get('members', []):
+                email = member.get('email_address', '')
+                if '@' not in email:
+                    response['errors'].append(
+                        {'email_address': email, 'error_code': 'ERROR_GENERIC',
+                         'error': '{} looks fake or invalid, please enter a '
+                                  'real email address.'.format(email)})
+                    continue
+                if self.rng.random() < self.member_error_rate:
+                    response['errors'].append(
+                        {'email_address': email, 'error_code': 'ERROR_GENERIC',
+                         'error': '{} has signed up to a lot of lists very '
+                                  'recently; we\'re not allowing more signups '
+                                  'for now'.format(email)})
+                    continue
+                key = email.lower()
+                if key in members and not body.get('update_existing'):
+                    response['errors'].append(
+                        {'email_address': email,
+                         'error_code': 'ERROR_CONTACT_EXISTS',
+                         'error': '{} is already a list member.'.format(email)})
+                    continue
+                outcome = 'updated_members' if key in members else 'new_members'
+                members[key] = dict(member, id=key, list_id=list_id)
+                response[outcome].append(members[key])
+        response['total_created'] = len(response['new_members'])
+        response['total_updated'] = len(response['updated_members'])
+        response['error_count'] = len(response['errors'])
+        return response
+
+    def create_batch(self, body, archive_base_url):
+        with self.lock:
+            batch_id = 'batch{:06d}'.format(len(self.batches))
+            self.batches[batch_id] = {
+                'id': batch_id, 'status': 'pending',
+                'total_operations': len(body.get('operations', [])),
+                'finished_operations': 0, 'errored_operations': 0,
+                'submitted_at': time.time(), 'response_body_url': '',
+                'operations': body.get('operations', []),
+                'archive_url': '{}/archives/{}.tar.gz'.format(archive_base_url,
+                                                              batch_id)}
+            return self.batch_view(self.batches[batch_id])
+
+    def get_batch(self, batch_id):
+        """
+        :return: the batch, run to completion once batch_secs have passed;
+                     or None if there is no such batch
+        """
+        with self.lock:
+            batch = self.batches.get(batch_id)
+        if batch is None:
+            return None
+        if batch['status'] != 'finished':
+            if time.time() - batch['submitted_at'] < self.batch_secs:
+                batch['status'] = 'started'
+            else:
+                self.run_batch(batch)
+        return self.batch_view(batch)
+
+    def run_batch(self, batch):
+        results = []
+        for operation in batch['operations']:
+            path = operation.get('path', '').strip('/')
+            if operation.get('method') == 'POST' and path.startswith('lists/') \
+                    and path.count('/') == 1:
+                response = self.update_members(path.split('/')[1],
+                                               json.loads(operation['body']))
+                results.append({'status_code': 200,
+                                'operation_id': operation.get('operation_id'),
+                                'response': json.dumps(response)})
+            else:
+                batch['errored_operations'] += 1
+                results.append({'status_code': 404,
+                                'operation_id': operation.get('operation_id'),
+                                'response': json.dumps(
+                                    {'status': 404,
+                                     'detail': 'not mocked: ' + path})})
+        archive = io.BytesIO()
+        with tarfile.open(fileobj=archive, mode='w:gz') as tar:
+            payload = json.dumps(results).encode()
+            info = tarfile.TarInfo('{}/0.json'.format(batch['id']))
+            info.size = len(payload)
+            tar.addfile(info, io.BytesIO(payload))
+        with self.lock:
+            self.archives[batch['id']] = archive.getvalue()
+            batch['finished_operations'] = len(results)
+            batch['response_body_url'] = batch['archive_url']
+            batch['status'] = 'finished'
+
+    @staticmethod
+    def batch_view(batch):
+        return {key: value for key, value in batch.items()
+                if key not in ('operations', 'archive_url')}
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    """One thread per connection, as http.server has from Python 3.7"""
+    daemon_threads = True
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    """
+    Serves the Marketplace 'Export licenses' endpoint and the Crunchbase
+    '/odm-organizations' endpoint from FakeData, and the MailChimp
+    endpoints used by import_and_add_subscribers.py from MockMailChimp
+    """
+    protocol_version = 'HTTP/1.1'
+    export_path = re.compile(r'^/rest/2/vendors/[^/]+/reporting/licenses/export$')
+    mc_list_path = re.compile(r'^/3\.0/lists/([^/]+)/?$')
+    mc_batch_path = re.compile(r'^/3\.0/batches/([^/]+)/?$')
+    archive_path = re.compile(r'^/archives/([^/]+)\.tar\.gz$')
+
+    def log_message(self, fmt, *args):
+        if self.server.verbose:
+            super().log_message(fmt, *args)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        if self.export_path.match(url.path):
+            self.send_mock_response(self.server.mkt_faults,
+                                    lambda: self.export_licenses(query))
+        elif url.path == self.server.cb_endpoint:
+            self.send_mock_response(self.server.cb_faults,
+                                    lambda: self.odm_organizations(query))
+        elif self.mc_batch_path.match(url.path):
+            batch = self.server.mailchimp.get_batch(
+                self.mc_batch_path.match(url.path).group(1))
+            if batch is None:
+                self.send_json(404, {'status': 404, 'detail': 'no such batch'})
+            else:
+                self.send_mock_response(self.server.mc_faults, lambda: batch)
+        elif self.archive_path.match(url.path):
+            archive = self.server.mailchimp.archives.get(
+                self.archive_path.match(url.path).group(1))
+            if archive is None:
+                self.send_json(404, {'error': 'no such archive'})
+            else:
+                self.send_bytes(200, archive, 'application/x-gzip')
+        else:
+            self.send_json(404, {'error': 'no such endpoint'})
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        length = int(self.headers.get('Content-Length') or 0)
+        body = json.loads(self.rfile.read(length) or b'{}')
+        mailchimp = self.server.mailchimp
+        if self.mc_list_path.match(url.path):
+            list_id = self.mc_list_path.match(url.path).group(1)
+            self.send_mock_response(
+                self.server.mc_faults,
+                lambda: mailchimp.update_members(list_id, body))
+        elif url.path.rstrip('/') == '/3.0/batches':
+            base_url = 'http://{}:{}'.format(*self.server.server_address[:2])
+            self.send_mock_response(
+                self.server.mc_faults,
+                lambda: mailchimp.create_batch(body, base_url))
+        else:
+            self.send_json(404, {'error': 'no such endpoint'})
+
+    def export_licenses(self, query):
+        """
+        :return: the configured number of licenses
+        Called by: do_GET()
+        """
+        return self.server.fake_data.licenses(self.server.ct_licenses,
+                                              run=self.server.run)
+
+    def odm_organizations(self, query):
+        """
+        :return: a CB response for a 'domain_name' or 'name' query
+        Called by: do_GET()
+        """
+        fake_data = self.server.fake_data
+        if query.get('domain_name'):
+            items = fake_data.organizations_for_domain(query['domain_name'])
+        else:
+            items = fake_data.organizations_for_name(query.get('name'))
+        return {'metadata': {'version': 31},
+                'data': {'paging': {'total_items': len(items),
+                                    'number_of_pages': 1,
+                                    'current_page': 1},
+                         'items': items}}
+
+    def send_mock_response(self, faults, make_body):
+        status, delay, retry_after = faults.check()
+        time.sleep(delay)
+        if status == 429:
+            self.send_json(429, {'error': 'rate limit exceeded'},
+                           {'Retry-After': str(retry_after)})
+        elif status == 500:
+            self.send_json(500, {'error': 'injected failure'})
+        else:
+            self.send_json(200, make_body())
+
+    def send_json(self, status, body, headers=None):
+        self.send_bytes(status, json.dumps(body).encode(), 'application/json',
+                        headers)
+
+    def send_bytes(self, status, payload, content_type, headers=None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(payload)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+
+class MockServers:
+    """
+    Local stand-ins for the Marketplace, Crunchbase and MailChimp APIs, for
+    load and latency testing of the loaders and of the subscriber sync.
+    Point them here with their base_url (--mc_base_url for the sync).
+    Run as, e.g.:
+    python3 mock_apis/src/mock_servers.py -l 100000 --cb_latency lognormal:120,0.5 \
+        --cb_rate_limit 200 --cb_throttle_rate 0.01
+    then
+    python3 mktplc_export_lics/src/load_licenses.py -u http://127.0.0.1:8001 ...
+    python3 crunchbase_orgs/src/load_organizations.py -u http://127.0.0.1:8001 ...
+    """
+    def __init__(self, host='127.0.0.1', port=8001):
+        self.host = host
+        self.port = port
+        self.args = None
+        self.httpd = None
+
+    def get_c_l_args(self, argv=None):
+        """Get command line arguments"""
+        parser = argparse.ArgumentParser()
+        parser.add_argument('-v', '--verbose', action='store_true',
+                            help='log each request to stderr')
+        parser.add_argument('--host', type=str, default=self.host)
+        parser.add_argument('-p', '--port', type=int, default=self.port)
+        parser.add_argument('-s', '--seed', type=int, default=0)
+        parser.add_argument('-l', '--licenses', type=int, default=1000,
+                            help='number of licenses the export returns')
+        parser.add_argument('-c', '--companies', type=int, default=None,
+                            help='number of distinct companies '
+                                 '(default: LICENSES / 2)')
+        parser.add_argument('--isp_ratio', type=float, default=0.2)
+        parser.add_argument('--duplicate_ratio', type=float, default=0.0,
+                            help='share of exported records that repeat '
+                                 'an earlier one')
+        parser.add_argument('--update_ratio', type=float, default=0.0,
+                            help='share of licenses that change in each run')
+        parser.add_argument('--run', type=int, default=0,
+                            help='export the licenses as of this run')
+        parser.add_argument('--cb_hit_ratio', type=float, default=0.7,
+                            help='share of companies Crunchbase knows')
+        parser.add_argument('--cb_endpoint', type=str,
+                            default='/odm-organizations')
+        parser.add_argument('--mc_batch_secs', type=float, default=1.0,
+                            help='seconds a MailChimp batch takes to finish')
+        parser.add_argument('--mc_member_error_rate', type=float, default=0.0,
+                            help='share of members MailChimp refuses, for now')
+        for api in ('mkt', 'cb', 'mc'):
+            parser.add_argument('--{}_latency'.format(api), type=str,
+                                default='fixed:0',
+                                help='fixed:MS, uniform:LO,HI or '
+                                     'lognormal:MEDIAN,SIGMA')
+            parser.add_argument('--{}_error_rate'.format(api), type=float,
+                                default=0.0, help='share of 500 responses')
+            parser.add_argument('--{}_throttle_rate'.format(api), type=float,
+                                default=0.0, help='share of 429 responses')
+            parser.add_argument('--{}_rate_limit'.format(api), type=int,
+                                default=0,
+                                help='requests allowed per window; 0 for none')
+            parser.add_argument('--{}_rate_window'.format(api), type=float,
+                                default=60.0, help='window length in seconds')
+        self.args = parser.parse_args(argv)
+
+    def make_faults(self, api):
+        args = vars(self.args)
+        return FaultInjector(latency=args[api + '_latency'],
+                             error_rate=args[api + '_error_rate'],
+                             throttle_rate=args[api + '_throttle_rate'],
+                             rate_limit=args[api + '_rate_limit'],
+                             rate_window=args[api + '_rate_window'],
+                             seed=self.args.seed)
+
+    def setup_server(self):
+        """
+        Build the server, and hang its configuration off it for the handler
+        :return: None
+        Called by: main()
+        """
+        args = self.args
+        self.httpd = ThreadingHTTPServer((args.host, args.port), MockHandler)
+        self.httpd.verbose = args.verbose
+        self.httpd.ct_licenses = args.licenses
+        self.httpd.run = args.run
+        self.httpd.fake_data = FakeData(
+            seed=args.seed,
+            ct_companies=args.companies or max(1, args.licenses // 2),
+            isp_ratio=args.isp_ratio, cb_hit_ratio=args.cb_hit_ratio,
+            duplicate_ratio=args.duplicate_ratio,
+            update_ratio=args.update_ratio)
+        self.httpd.cb_endpoint = args.cb_endpoint
+        self.httpd.mkt_faults = self.make_faults('mkt')
+        self.httpd.cb_faults = self.make_faults('cb')
+        self.httpd.mc_faults = self.make_faults('mc')
+        self.httpd.mailchimp = MockMailChimp(
+            batch_secs=args.mc_batch_secs,
+            member_error_rate=args.mc_member_error_rate, seed=args.seed)
+
+    def print_report(self):
+        for api in ('mkt', 'cb', 'mc'):
+            faults = getattr(self.httpd, api + '_faults')
+            print('{}: {} requests, {} 429s, {} 500s'.format(
+                api, faults.ct_requests, faults.ct_throttled, faults.ct_errors),
+                file=sys.stderr)
+
+    def main(self):
+        self.get_c_l_args()
+        self.setup_server()
+        print('Mock APIs listening on http://{}:{}'.format(self.args.host,
+                                                           self.args.port),
+              file=sys.stderr)
+        try:
+            self.httpd.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        self.httpd.server_close()
+        self.print_report()
+
+
+if __name__ == '__main__':
+    MockServers().main()
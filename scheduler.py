@@ -0,0 +1,347 @@
+#!/usr/bin/env python3.6
+
+
+# file: scheduler.py
+
+import os
+import sys
+import argparse
+import datetime
+import json
+import queue
+import shlex
+import threading
+import time
+import traceback
+from psycopg2.pool import ThreadedConnectionPool
+import requests
+
+try:
+    from common.src.pg_stats import StatsConnection
+except ModuleNotFoundError:
+    from common.pg_stats import StatsConnection
+
+try:
+    from mktplc_export_lics.src.load_licenses import LoadLicenses
+    from crunchbase_orgs.src.load_organizations import LoadOrganizations
+except ModuleNotFoundError:
+    from mktplc_export_lics.load_licenses import LoadLicenses
+    from crunchbase_orgs.load_organizations import LoadOrganizations
+
+
+class Scheduler:
+    """
+    Resident replacement for control_script_bash.sh: every --every
+    minutes, runs LoadLicenses and then LoadOrganizations in this process.
+    The HTTP sessions, a PostgreSQL connection pool, the Crunchbase
+    lookup connection and the ISP / TLD / short domain caches are set up
+    once and kept warm between cycles; each loader's per-run state is
+    reset at the start of its run.
+    With --pipeline, the two loaders run side by side, with no licenses
+    file between them: see run_pipeline().
+    Set the environment variables of both loaders first, e.g.:
+    source ./mktplc_export_lics/admin/set_envs.sh
+    source ./crunchbase_orgs/admin/set_envs.sh
+    python3 scheduler.py -n 2026-10-18T02:00:00 -m 2026-10-17 \
+        --org_args='-b -a'
+    """
+    def __init__(self):
+        self.next_run = None  # datetime of the next cycle
+        self.modified_since = '2000-01-01'
+        self.every = datetime.timedelta(minutes=30)
+        self.pause_secs = 0  # between the two loaders
+        self.json_file = './json_files/crunchbase_orgs_input_3.json'
+        self.lic_args = []  # extra command line args for LoadLicenses
+        self.org_args = []  # extra command line args for LoadOrganizations
+        self.max_cycles = None
+        self.timing_file = None
+        self.pool_size = 4
+        self.pipeline = False
+        self.queue_chunks = 8  # pipeline queue bound, in chunks of licenses
+        self.changed_only = False
+        self.pg_pool = None
+        self.ll = LoadLicenses()
+        self.lo = LoadOrganizations()
+        self.ct_cycles = 0
+        self.ct_failed_cycles = 0
+
+    def get_c_l_args(self, argv=None):
+        """Get command line arguments"""
+        parser = argparse.ArgumentParser()
+        parser.add_argument('-n', '--next_run', type=str, default=None,
+                            help='time of the first run, as '
+                                 'YYYY-MM-DDTHH:MM:SS (default: now)')
+        parser.add_argument('-m', '--modified_since', type=str,
+                            default=self.modified_since,
+                            help='modified date for the first run; each later '
+                                 'run uses the date of the run before it')
+        parser.add_argument('-e', '--every', type=float, default=30,
+                            help='minutes from the start of one run to the '
+                                 'start of the next')
+        parser.add_argument('--pause_secs', type=float,
+                            default=self.pause_secs,
+                            help='seconds to wait between the two loaders')
+        parser.add_argument('-o', '--json_file', type=str,
+                            default=self.json_file,
+                            help='licenses file written by LoadLicenses and '
+                                 'read by LoadOrganizations')
+        parser.add_argument('--lic_args', type=str, default='',
+                            help='more arguments for load_licenses.py')
+        parser.add_argument('--org_args', type=str, default='',
+                            help='more arguments for load_organizations.py')
+        parser.add_argument('-c', '--cycles', type=int, default=None,
+                            help='stop after CYCLES runs (default: never)')
+        parser.add_argument('-t', '--timing_file', type=str, default=None,
+                            help='append the timings of each run to '
+                                 'TIMING_FILE, one JSON object per line')
+        parser.add_argument('--pool_size', type=int, default=self.pool_size,
+                            help='most PostgreSQL connections kept open')
+        parser.add_argument('-p', '--pipeline', action='store_true',
+                            help='stream licenses from LoadLicenses to '
+                                 'LoadOrganizations as they are stored, '
+                                 'through a bounded queue')
+        parser.add_argument('--queue_chunks', type=int,
+                            default=self.queue_chunks,
+                            help='most chunks of licenses waiting in the '
+                                 'pipeline queue')
+        parser.add_argument('-d', '--changed_only', action='store_true',
+                            help='pass LoadOrganizations only licenses whose '
+                                 'license contact details were inserted or '
+                                 'updated in the run')
+        args = parser.parse_args(argv)
+        self.next_run = datetime.datetime.strptime(
+            args.next_run, '%Y-%m-%dT%H:%M:%S') if args.next_run else \
+            datetime.datetime.now().replace(microsecond=0)
+        self.modified_since = args.modified_since
+        self.every = datetime.timedelta(minutes=args.every)
+        self.pause_secs = args.pause_secs
+        self.json_file = args.json_file
+        self.lic_args = shlex.split(args.lic_args)
+        self.org_args = shlex.split(args.org_args)
+        self.max_cycles = args.cycles
+        self.timing_file = args.timing_file
+        self.pool_size = args.pool_size
+        self.pipeline = args.pipeline
+        self.queue_chunks = args.queue_chunks
+        self.changed_only = args.changed_only
+
+    def setup(self):
+        """
+        Check the environment of both loaders, and open the resources
+            they keep between cycles
+        :return: None
+        Called by: main()
+        """
+        self.ll.get_env_vars()
+        self.lo.get_env_vars()
+        pg_conn_string = ("host = '{}' dbname = '{}' user = '{}' " +
+                          "password = '{}'").format(self.ll.db_host,
+                                                    self.ll.db_name,
+                                                    self.ll.db_user,
+                                                    self.ll.db_password)
+        self.pg_pool = ThreadedConnectionPool(
+            1, self.pool_size, pg_conn_string,
+            connection_factory=StatsConnection)
+        self.ll.sess = requests.Session()
+        self.ll.pg_pool = self.pg_pool
+        self.lo.pg_pool = self.pg_pool
+        self.lo.resident = True
+        self.lo.setup_logging()
+
+    def teardown(self):
+        """
+        Close what setup() and the loaders left open
+        :return: None
+        Called by: main()
+        """
+        if self.ll.sess:
+            self.ll.sess.close()
+        if self.lo.sess:
+            self.lo.sess.close()
+        if self.lo.lookup_conn:
+            self.lo.lookup_conn.close()
+        if self.pg_pool:
+            self.pg_pool.closeall()
+
+    def wait_until(self, when):
+        """
+        Sleep until when, reporting every 2 minutes
+        :param when: a datetime
+        :return: None
+        Called by: main()
+        """
+        print('Next run will be at: {}'.format(when.isoformat()))
+        print('Next run modified date will be: {}'.format(self.modified_since))
+        while True:
+            secs_left = (when - datetime.datetime.now()).total_seconds()
+            if secs_left <= 0:
+                return
+            time.sleep(min(secs_left, 120))
+
+    def run_licenses(self, timings, license_sink=None):
+        """
+        One LoadLicenses run, as load_licenses.py -o <json_file>
+            -m <modified_since> would do it (-e <json_file>, with
+            --changed_only)
+        :param timings: dict to record phase times in
+        :param license_sink: if given, LoadLicenses passes it the stored
+                                 licenses, and writes no file
+        :return: None
+        Called by: run_cycle(), run_pipeline()
+        """
+        self.ll.reset_run_state()
+        outfile_args = [] if license_sink else \
+            ['-e' if self.changed_only else '-o', self.json_file]
+        self.ll.get_args(self.lic_args + outfile_args +
+                         ['-m', self.modified_since])
+        self.ll.get_env_vars()
+        self.ll.license_sink = license_sink
+        self.ll.sink_changed_only = self.changed_only
+        start = time.perf_counter()
+        # the phases of LoadLicenses.main(), for --profile in --lic_args
+        with self.ll.profiler.phase('fetch'):
+            mkt_response = self.ll.get_licenses()
+        with self.ll.profiler.phase('parse'):
+            self.ll.handle_mkt_response(mkt_response)
+        timings['fetch_licenses'] = time.perf_counter() - start
+        timings['ct_licenses'] = len(self.ll.mkt_data)
+        start = time.perf_counter()
+        with self.ll.profiler.phase('store'):
+            self.ll.store_licenses()
+        timings['store_licenses'] = time.perf_counter() - start
+        self.ll.output_stats()
+
+    def run_organizations(self, timings, license_queue=None):
+        """
+        One LoadOrganizations run, as load_organizations.py -i <json_file>
+            would do it
+        :param timings: dict to record phase times in
+        :param license_queue: if given, read the licenses from here rather
+                                  than from the file
+        :return: None
+        Called by: run_cycle(), consume_licenses()
+        """
+        self.lo.reset_run_state()
+        infile_args = [] if license_queue else ['-i', self.json_file]
+        self.lo.get_c_l_args(self.org_args + infile_args)
+        self.lo.get_env_vars()
+        self.lo.license_queue = license_queue
+        start = time.perf_counter()
+        try:
+            # the phase of run_load_organizations(), for --profile in
+            # --org_args
+            with self.lo.profiler.phase('enrich'):
+                self.lo.get_each_license()
+        finally:
+            if self.lo.data_source is not sys.stdin:
+                self.lo.data_source.close()
+        timings['organizations'] = time.perf_counter() - start
+        self.lo.print_report()
+
+    def run_pipeline(self, timings):
+        """
+        Run both loaders at once. As LoadLicenses commits each chunk of
+            licenses, it puts their (email, company) pairs on a bounded
+            queue; LoadOrganizations, in a second thread, looks them up in
+            Crunchbase meanwhile. A full queue holds LoadLicenses back.
+        :param timings: dict to record phase times in
+        :return: None
+        Called by: run_cycle()
+        """
+        license_queue = queue.Queue(maxsize=self.queue_chunks)
+        consumer = threading.Thread(target=self.consume_licenses,
+                                    args=(license_queue, timings))
+        consumer.start()
+        try:
+            self.run_licenses(timings, license_sink=license_queue.put)
+        finally:
+            license_queue.put(None)
+            consumer.join()
+        if timings.get('organizations_failed'):
+            raise RuntimeError('LoadOrganizations failed')
+
+    def consume_licenses(self, license_queue, timings):
+        """
+        The LoadOrganizations side of run_pipeline(). If it fails, keep
+            emptying the queue, so that LoadLicenses can finish.
+        Called by: run_pipeline(), in its own thread
+        """
+        try:
+            self.run_organizations(timings, license_queue=license_queue)
+        except (Exception, SystemExit):
+            traceback.print_exc()
+            timings['organizations_failed'] = True
+            while not self.lo.license_queue_done and \
+                    license_queue.get() is not None:
+                pass
+
+    def run_cycle(self):
+        """
+        Run both loaders once, and report how long each phase took
+        :return: dict of timings
+        Called by: main()
+        """
+        timings = {'cycle': self.ct_cycles + 1,
+                   'started': datetime.datetime.now().isoformat(),
+                   'modified_since': self.modified_since}
+        start = time.perf_counter()
+        try:
+            os.remove(self.json_file)
+        except OSError:
+            pass
+        try:
+            if self.pipeline:
+                self.run_pipeline(timings)
+            else:
+                self.run_licenses(timings)
+                print('\n' + '=' * 79 + '\n')
+                time.sleep(self.pause_secs)
+                self.run_organizations(timings)
+            print('\n' + '=' * 79 + '\n')
+        except (Exception, SystemExit):
+            # a bad cycle should not stop the schedule
+            traceback.print_exc()
+            timings['failed'] = True
+            self.ct_failed_cycles += 1
+        timings['total'] = time.perf_counter() - start
+        self.ct_cycles += 1
+        self.report_timings(timings)
+        return timings
+
+    def report_timings(self, timings):
+        """
+        Print one cycle's timings, and append them to self.timing_file
+        :param timings: as made by run_cycle()
+        :return: None
+        Called by: run_cycle()
+        """
+        print('Cycle {}: {}{:.3f} secs (fetch licenses {:.3f}, store '
+              'licenses {:.3f}, organizations {:.3f})'.
+              format(timings['cycle'],
+                     'FAILED after ' if timings.get('failed') else '',
+                     timings['total'], timings.get('fetch_licenses', 0),
+                     timings.get('store_licenses', 0),
+                     timings.get('organizations', 0)),
+              file=sys.stderr)
+        if self.timing_file:
+            with open(self.timing_file, 'a') as timing_file:
+                print(json.dumps(timings, sort_keys=True), file=timing_file)
+
+    def main(self):
+        self.get_c_l_args()
+        self.setup()
+        try:
+            while self.max_cycles is None or self.ct_cycles < self.max_cycles:
+                self.wait_until(self.next_run)
+                self.run_cycle()
+                self.modified_since = self.next_run.strftime('%Y-%m-%d')
+                self.next_run += self.every
+        except KeyboardInterrupt:
+            print('Stopping after {} runs'.format(self.ct_cycles),
+                  file=sys.stderr)
+        finally:
+            self.teardown()
+
+
+if __name__ == '__main__':
+    Scheduler().main()
@@ -0,0 +1,20 @@
+try:
+    from crunchbase_orgs.src.batch_domains import classify_emails
+except ModuleNotFoundError:
+    from crunchbase_orgs.batch_domains import classify_emails
+
+
+def test_classify_emails_empty():
+    frame = classify_emails([], ['gmail.com'], lambda domain: domain)
+    assert len(frame) == 0
+    assert list(frame.columns) == ['domain', 'bad_email', 'is_isp',
+                                   'short_domain']
+
+
+def test_classify_emails():
+    frame = classify_emails(['a@www.example.com', 'b@gmail.com', 'bad'],
+                            ['gmail.com'], lambda domain: domain[4:])
+    assert frame['domain'].tolist() == ['www.example.com', 'gmail.com', None]
+    assert frame['bad_email'].tolist() == [False, False, True]
+    assert frame['is_isp'].tolist() == [False, True, False]
+    assert frame['short_domain'].tolist() == ['example.com', None, None]
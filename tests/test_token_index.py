@@ -0,0 +1,26 @@
+try:
+    from crunchbase_orgs.src.token_index import TokenIndex
+except ModuleNotFoundError:
+    from crunchbase_orgs.token_index import TokenIndex
+
+
+def make_index():
+    token_index = TokenIndex()
+    for org_key, name in enumerate(['Acme Inc', 'Acme Labs', 'Widget Co',
+                                    'Acme Widget Inc', 'Beta.io', 'Gamma']):
+        token_index.add(org_key, {'properties': {'name': name}})
+    token_index.finalize()
+    return token_index
+
+
+def test_batch_candidates_match_candidates():
+    token_index = make_index()
+    companies = ['acme inc', 'Acme  Inc', 'widget', 'beta', 'unknown', '']
+    batch = token_index.batch_candidates(companies, limit=2)
+    assert set(batch) == set(companies)
+    for company in companies:
+        assert batch[company] == token_index.candidates(company, limit=2)
+
+
+def test_batch_candidates_empty():
+    assert make_index().batch_candidates([]) == {}